@@ -0,0 +1,566 @@
+# /// script
+# dependencies = [
+#     "flask>=2.0",
+#     "requests>=2.20",
+# ]
+# ///
+#
+# ################################################################################
+# # Knot Resolver Stats Dashboard Benchmark
+# ################################################################################
+#
+# Measures what the dashboard costs: /api/stats latency, throughput under
+# concurrent clients, memory growth over time and how often it scrapes the
+# resolver. The resolver is replaced by a local stand-in for kresd's webmgmt
+# `/stats` and `/metrics/json` endpoints with evolving counters, configurable
+# instance count and payload size, and injectable latency and failures.
+#
+# ## Usage
+#
+# 1. Benchmark the v6 dashboard: `uv run knotstats-bench.py`
+# 2. Benchmark the v5 dashboard: `uv run knotstats-bench.py --dashboard knotstats.py`
+# 3. Soak for memory growth: `uv run knotstats-bench.py --soak 3600`
+# 4. Only run the stand-in, e.g. to point a dashboard at it by hand:
+#    `uv run knotstats-bench.py --fake-only --fake-port 8453`
+# 5. Also stand in for kresd's control sockets, e.g. to try HOSTS_APPLY = 'control'
+#    with KRESD_CONTROL_DIR pointing at the same directory:
+#    `uv run knotstats-bench.py --fake-only --fake-control /tmp/kresd-control`
+#
+# Every run is appended to bench-results.jsonl together with the commit it
+# ran against and compared with the previous run of the same scenario.
+#
+
+import argparse
+import collections
+import json
+import math
+import os
+import random
+import re
+import socketserver
+import struct
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+# --- Configuration ---
+RESULTS_FILE = "bench-results.jsonl"
+DASHBOARD_PORT = 5001 # Port of dashboards that don't have a LISTEN_PORT setting
+STARTUP_TIMEOUT = 30 # Seconds to wait for the dashboard to answer its first request
+# Share of answers per kresd latency bucket, fastest first
+LATENCY_SHARES = [('1ms', 0.55), ('10ms', 0.2), ('50ms', 0.12), ('100ms', 0.06), ('250ms', 0.04),
+                  ('500ms', 0.015), ('1000ms', 0.01), ('1500ms', 0.004), ('slow', 0.001)]
+RCODE_SHARES = [('noerror', 0.82), ('nodata', 0.06), ('nxdomain', 0.1), ('servfail', 0.02)]
+PROTOCOL_SHARES = [('udp', 0.85), ('tcp', 0.08), ('dot', 0.05), ('doh', 0.02)]
+
+# --- Fake kresd ---
+
+class FakeInstance:
+    """One kresd worker whose counters grow at a fluctuating query rate."""
+
+    def __init__(self, name, qps, extra_keys):
+        self.name = name
+        self.base_qps = qps * random.uniform(0.5, 1.5)
+        self.phase = random.uniform(0, 2 * math.pi)
+        self.extra_keys = extra_keys
+        self.queries = 0.0
+        self.updated = time.monotonic()
+        self.rss = random.randint(40, 80) * 1024 * 1024
+
+    def restart(self):
+        self.queries = 0.0
+
+    def advance(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        # A slow daily-like swell plus noise, never negative
+        qps = self.base_qps * (1 + 0.3 * math.sin(now / 60 + self.phase)) * random.uniform(0.9, 1.1)
+        self.queries += max(0.0, qps) * elapsed
+        self.rss = max(20 * 1024 * 1024, self.rss + random.randint(-65536, 65536))
+
+    def stats(self):
+        """Returns this instance's stats as {section: {key: value}}."""
+        total = int(self.queries)
+        cached = int(total * 0.62)
+        answer = {"total": total, "cached": cached, "stale": int(total * 0.01)}
+        answer.update({key: int(total * share) for key, share in RCODE_SHARES})
+        answer.update({key: int(total * share) for key, share in LATENCY_SHARES})
+        request = {key: int(total * share) for key, share in PROTOCOL_SHARES}
+        request.update({"internal": int(total * 0.03), "xdp": 0})
+        data = {
+            "answer": answer,
+            "request": request,
+            "cache": {"lookup": total, "hit": cached, "miss": total - cached, "insert": total - cached},
+            "worker": {"rss": self.rss, "concurrent": random.randint(0, 20), "queries": total},
+        }
+        if self.extra_keys:
+            data["extra"] = {f"counter{i:04d}": total + i for i in range(self.extra_keys)}
+        return data
+
+
+class FakeKresd:
+    """A stand-in for kresd's webmgmt endpoints on a local port.
+
+    /metrics/json returns every instance as {instance: {section: {key: value}}}
+    like the v6 dashboard expects; /stats returns the first instance flattened
+    to {"section.key": value} like kresd 5. Responses can be delayed and a
+    share of them fail, and instances can be restarted to exercise counter
+    reset handling. Requests are counted per path.
+    """
+
+    def __init__(self, port=0, instances=4, qps=500, extra_keys=0, latency_ms=0, jitter_ms=0,
+                 failure_rate=0.0, restart_interval=0):
+        self.instances = [FakeInstance(f"kresd{i}", qps, extra_keys) for i in range(instances)]
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.restart_interval = restart_interval
+        self.requests = collections.Counter() # path -> requests served
+        self._last_restart = time.monotonic()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name="fake-kresd", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+    def payload(self, path):
+        """Returns the JSON body for `path`, or None if it isn't served."""
+        now = time.monotonic()
+        with self._lock:
+            if self.restart_interval and now - self._last_restart >= self.restart_interval:
+                self._last_restart = now
+                random.choice(self.instances).restart()
+            for instance in self.instances:
+                instance.advance(now)
+            if path == '/metrics/json':
+                return {instance.name: instance.stats() for instance in self.instances}
+            if path == '/stats':
+                stats = self.instances[0].stats()
+                return {f"{section}.{key}": value for section, values in stats.items() for key, value in values.items()}
+        return None
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                path = self.path.split('?', 1)[0]
+                with fake._lock:
+                    fake.requests[path] += 1
+                delay = fake.latency_ms + random.uniform(-fake.jitter_ms, fake.jitter_ms)
+                if delay > 0:
+                    time.sleep(delay / 1000)
+                if random.random() < fake.failure_rate:
+                    self.send_error(500, "Injected failure")
+                    return
+                payload = fake.payload(path)
+                if payload is None:
+                    self.send_error(404)
+                    return
+                body = json.dumps(payload).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+
+class FakeControl:
+    """A stand-in for kresd's control sockets: one Unix socket per fake instance in `directory`.
+
+    Speaks the part of the protocol the dashboard uses: lines of Lua, answered
+    as text or, after `__binary`, each prefixed with its 4-byte big-endian
+    length. Bare hints.set(), hints.del() and hints.get() calls are understood,
+    as are several set and del calls in a `(function() ... return '...' end)()`
+    wrapper, which answers with the returned string; anything else gets an
+    error like kresd's. Each instance keeps its own hints, so tests can check
+    what reached every worker. Replies can be delayed and a share of them fail.
+    """
+
+    CALL = re.compile(r"hints\.(set|del|get)\('((?:[^'\\]|\\.)*)'\)")
+    WRAPPED = re.compile(r"\(function\(\) (.*)return '((?:[^'\\]|\\.)*)' end\)\(\)")
+
+    def __init__(self, directory, names, latency_ms=0, failure_rate=0.0):
+        self.directory = directory
+        self.latency_ms = latency_ms
+        self.failure_rate = failure_rate
+        self.hints = {name: collections.defaultdict(set) for name in names} # instance -> {hostname: addresses}
+        self.lines = collections.Counter() # instance -> lines evaluated
+        self._lock = threading.Lock()
+        self._servers = []
+        os.makedirs(directory, exist_ok=True)
+        for name in names:
+            path = os.path.join(directory, name)
+            if os.path.exists(path):
+                os.unlink(path)
+            server = socketserver.ThreadingUnixStreamServer(path, self._handler(name))
+            server.daemon_threads = True
+            self._servers.append(server)
+
+    def start(self):
+        for server in self._servers:
+            threading.Thread(target=server.serve_forever, name="fake-control", daemon=True).start()
+        return self
+
+    def stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+            os.unlink(server.server_address)
+
+    def evaluate(self, name, line):
+        """Runs one line of Lua against instance `name`'s hints; returns the reply."""
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        with self._lock:
+            self.lines[name] += 1
+            if random.random() < self.failure_rate:
+                return "error: injected failure"
+            wrapped = self.WRAPPED.fullmatch(line)
+            body, returned = (wrapped[1], self._unquote(wrapped[2])) if wrapped else (line, None)
+            calls = self.CALL.findall(body)
+            if not calls or self.CALL.sub('', body).strip() or (len(calls) > 1 and not wrapped) or \
+                    (wrapped and any(action == 'get' for action, _ in calls)):
+                return f"error: [string \"{line[:40]}\"]:1: unsupported by the fake control socket"
+            hints = self.hints[name]
+            for action, argument in calls:
+                hostname, _, address = self._unquote(argument).partition(' ')
+                if action == 'set':
+                    hints[hostname].add(address)
+                elif action == 'del':
+                    if address:
+                        hints[hostname].discard(address)
+                    if not address or not hints[hostname]:
+                        hints.pop(hostname, None)
+                else:
+                    return json.dumps({hostname: sorted(hints.get(hostname, ()))})
+            return returned if wrapped else "true"
+
+    @staticmethod
+    def _unquote(text):
+        return re.sub(r"\\(.)", lambda escape: "\n" if escape[1] == 'n' else escape[1], text)
+
+    def _handler(self, name):
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                binary = False
+                for line in self.rfile:
+                    line = line.decode(errors='replace').strip()
+                    if line == '__binary':
+                        binary = True
+                        continue
+                    if not line:
+                        continue
+                    reply = fake.evaluate(name, line).encode()
+                    self.wfile.write(struct.pack('>I', len(reply)) + reply if binary else reply + b"\n> ")
+
+        return Handler
+
+# --- Dashboard Process ---
+
+def serve_dashboard(script, overrides):
+    """Runs a dashboard script as __main__ with its configuration constants overridden.
+
+    The script's configuration block (everything before "# --- Flask App ---")
+    runs first, then `overrides` replace its values, then the rest runs.
+    """
+    with open(script) as file:
+        source = file.read()
+    config, marker, rest = source.partition("# --- Flask App ---")
+    if not marker:
+        sys.exit(f"{script} has no '# --- Flask App ---' section to apply overrides before")
+    namespace = {"__name__": "__main__", "__file__": os.path.abspath(script)}
+    exec(compile(config, script, 'exec'), namespace)
+    namespace.update(overrides)
+    # Pad with newlines so tracebacks point at the right lines of the script
+    exec(compile("\n" * config.count("\n") + marker + rest, script, 'exec'), namespace)
+
+
+class Dashboard:
+    """A dashboard script running in a child process against the fake resolver."""
+
+    def __init__(self, script, overrides, port):
+        self.url = f"http://127.0.0.1:{port}"
+        command = [sys.executable, os.path.abspath(__file__), "--serve-dashboard", script, json.dumps(overrides)]
+        self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def wait_ready(self, timeout=STARTUP_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                sys.exit(f"Dashboard exited with status {self.process.returncode} during startup")
+            try:
+                if requests.get(f"{self.url}/api/stats", timeout=1).status_code == 200:
+                    return
+            except requests.exceptions.RequestException:
+                pass
+            time.sleep(0.2)
+        self.stop()
+        sys.exit(f"Dashboard did not serve stats within {timeout}s")
+
+    def rss(self):
+        """Returns the resident memory of the dashboard and its children in bytes."""
+        pids = [self.process.pid]
+        try:
+            with open(f"/proc/{self.process.pid}/task/{self.process.pid}/children") as file:
+                pids += [int(pid) for pid in file.read().split()]
+        except OSError:
+            pass
+        total = 0
+        for pid in pids:
+            try:
+                with open(f"/proc/{pid}/status") as file:
+                    for line in file:
+                        if line.startswith('VmRSS:'):
+                            total += int(line.split()[1]) * 1024
+            except OSError:
+                pass
+        return total
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+# --- Measurements ---
+
+def percentiles(samples):
+    """Summarizes latency samples in seconds as milliseconds."""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def at(fraction):
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 3)
+
+    return {"count": len(ordered), "p50_ms": at(0.5), "p90_ms": at(0.9), "p99_ms": at(0.99),
+            "max_ms": round(ordered[-1] * 1000, 3), "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3)}
+
+
+def measure_latency(url, requests_count):
+    """Times sequential requests from one client."""
+    session = requests.Session()
+    samples = []
+    errors = 0
+    for _ in range(requests_count):
+        started = time.perf_counter()
+        response = session.get(url, timeout=10)
+        samples.append(time.perf_counter() - started)
+        errors += response.status_code != 200
+    return {**percentiles(samples), "errors": errors}
+
+
+def measure_throughput(url, clients, duration):
+    """Runs `clients` concurrent clients in a closed loop for `duration` seconds."""
+    samples = []
+    errors = collections.Counter()
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client():
+        session = requests.Session()
+        local_samples = []
+        local_errors = collections.Counter()
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                status = session.get(url, timeout=10).status_code
+            except requests.exceptions.RequestException as e:
+                status = type(e).__name__
+            local_samples.append(time.perf_counter() - started)
+            if status != 200:
+                local_errors[str(status)] += 1
+        with lock:
+            samples.extend(local_samples)
+            errors.update(local_errors)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    return {"requests_per_second": round(len(samples) / elapsed, 1),
+            **percentiles(samples), "errors": dict(errors)}
+
+
+def measure_soak(dashboard, url, duration, sample_interval):
+    """Polls like one dashboard tab for `duration` seconds, sampling the dashboard's memory."""
+    session = requests.Session()
+    started = time.monotonic()
+    samples = [(0.0, dashboard.rss())]
+    next_sample = started + sample_interval
+    while time.monotonic() - started < duration:
+        session.get(url, timeout=10)
+        now = time.monotonic()
+        if now >= next_sample:
+            samples.append((now - started, dashboard.rss()))
+            next_sample += sample_interval
+        time.sleep(1)
+    samples.append((time.monotonic() - started, dashboard.rss()))
+    # Growth from the least-squares slope, so one GC pause doesn't dominate
+    n = len(samples)
+    mean_t = sum(t for t, _ in samples) / n
+    mean_rss = sum(rss for _, rss in samples) / n
+    variance = sum((t - mean_t) ** 2 for t, _ in samples)
+    slope = sum((t - mean_t) * (rss - mean_rss) for t, rss in samples) / variance if variance else 0.0
+    mib = 1024 * 1024
+    return {"duration": round(samples[-1][0], 1), "start_rss_mib": round(samples[0][1] / mib, 2),
+            "end_rss_mib": round(samples[-1][1] / mib, 2), "max_rss_mib": round(max(rss for _, rss in samples) / mib, 2),
+            "growth_mib_per_hour": round(slope * 3600 / mib, 3)}
+
+# --- Results ---
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_result(path, scenario):
+    """Returns the last stored result of the same scenario, or None."""
+    previous = None
+    try:
+        with open(path) as file:
+            for line in file:
+                result = json.loads(line)
+                if result.get("scenario") == scenario:
+                    previous = result
+    except FileNotFoundError:
+        pass
+    return previous
+
+
+def print_comparison(results, previous):
+    """Prints each measured number next to the previous run's."""
+    def walk(current, before, prefix=''):
+        for key, value in current.items():
+            old = before.get(key) if isinstance(before, dict) else None
+            if isinstance(value, dict):
+                walk(value, old, f"{prefix}{key}.")
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                change = ''
+                if isinstance(old, (int, float)) and old:
+                    change = f"  ({(value - old) / old * 100:+.1f}% vs {old})"
+                print(f"  {prefix}{key}: {value}{change}")
+
+    if previous is not None:
+        print(f"Compared with {previous['revision']} at {previous['date']}:")
+    walk(results, previous["results"] if previous else {})
+
+# --- Main Execution ---
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Knot Resolver stats dashboard against a fake kresd.")
+    parser.add_argument('--dashboard', default='knotstats-v6.py', help="dashboard script to benchmark")
+    parser.add_argument('--instances', type=int, default=4, help="kresd instances the fake reports")
+    parser.add_argument('--qps', type=float, default=500, help="mean queries per second per fake instance")
+    parser.add_argument('--extra-keys', type=int, default=0, help="extra counters per instance, to grow the payload")
+    parser.add_argument('--latency-ms', type=float, default=0, help="delay before each fake response")
+    parser.add_argument('--jitter-ms', type=float, default=0, help="random +/- variation of that delay")
+    parser.add_argument('--failure-rate', type=float, default=0, help="share of fake responses that fail with 500")
+    parser.add_argument('--restart-interval', type=float, default=0, help="seconds between fake instance restarts")
+    parser.add_argument('--requests', type=int, default=500, help="sequential requests for the latency measurement")
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8, 32], help="concurrent client counts")
+    parser.add_argument('--duration', type=float, default=10, help="seconds per throughput measurement")
+    parser.add_argument('--soak', type=float, default=0, help="seconds of memory soak (0 to skip)")
+    parser.add_argument('--soak-sample', type=float, default=60, help="seconds between memory samples")
+    parser.add_argument('--query', default='', help="query string for /api/stats, e.g. 'group_by=all'")
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=JSON',
+                        help="override a dashboard setting, e.g. --set WORKERS=4")
+    parser.add_argument('--results', default=RESULTS_FILE, help="JSON lines file results are appended to")
+    parser.add_argument('--fake-only', action='store_true', help="only run the fake kresd until interrupted")
+    parser.add_argument('--fake-port', type=int, default=0, help="port for the fake kresd (default: any free port)")
+    parser.add_argument('--fake-control', metavar='DIR',
+                        help="also serve a fake kresd control socket per instance in DIR")
+    args = parser.parse_args()
+
+    fake = FakeKresd(args.fake_port, args.instances, args.qps, args.extra_keys, args.latency_ms, args.jitter_ms,
+                     args.failure_rate, args.restart_interval).start()
+    control = None
+    if args.fake_control:
+        control = FakeControl(args.fake_control, [instance.name for instance in fake.instances], args.latency_ms,
+                              args.failure_rate).start()
+    if args.fake_only:
+        print(f"Fake kresd serving http://127.0.0.1:{fake.port}/metrics/json and /stats; Ctrl+C to stop")
+        if control is not None:
+            print(f"Fake kresd control sockets in {args.fake_control}: {', '.join(sorted(control.hints))}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            if control is not None:
+                control.stop()
+            return
+
+    upstream_path = '/metrics/json' if 'v6' in os.path.basename(args.dashboard) else '/stats'
+    overrides = {"KNOT_RESOLVER_STATS_URL": f"http://127.0.0.1:{fake.port}{upstream_path}", "HISTORY_STORE_DIR": None}
+    if control is not None:
+        overrides["KRESD_CONTROL_DIR"] = args.fake_control
+    for setting in args.set:
+        name, _, value = setting.partition('=')
+        overrides[name] = json.loads(value)
+    port = overrides.get("LISTEN_PORT", DASHBOARD_PORT)
+    if "LISTEN_PORT" not in overrides:
+        with open(args.dashboard) as file:
+            if "\nLISTEN_PORT = " in file.read():
+                overrides["LISTEN_PORT"] = port
+
+    dashboard = Dashboard(args.dashboard, overrides, port)
+    url = f"{dashboard.url}/api/stats" + (f"?{args.query}" if args.query else '')
+    try:
+        dashboard.wait_ready()
+        fake.requests.clear()
+        measured_from = time.monotonic()
+        results = {"latency": measure_latency(url, args.requests)}
+        results["throughput"] = {f"{clients}_clients": measure_throughput(url, clients, args.duration)
+                                 for clients in args.clients}
+        if args.soak > 0:
+            results["memory"] = measure_soak(dashboard, url, args.soak, args.soak_sample)
+        results["rss_mib"] = round(dashboard.rss() / (1024 * 1024), 2)
+        elapsed = time.monotonic() - measured_from
+        results["upstream"] = {"scrapes": sum(fake.requests.values()),
+                               "scrapes_per_second": round(sum(fake.requests.values()) / elapsed, 3)}
+    finally:
+        dashboard.stop()
+        fake.stop()
+        if control is not None:
+            control.stop()
+
+    scenario = {key: value for key, value in vars(args).items() if key not in ('results', 'fake_only', 'fake_port', 'fake_control')}
+    previous = previous_result(args.results, scenario)
+    record = {"date": time.strftime('%Y-%m-%dT%H:%M:%S%z'), "revision": git_revision(), "scenario": scenario,
+              "results": results}
+    with open(args.results, 'a') as file:
+        file.write(json.dumps(record) + '\n')
+    print(f"Results for {args.dashboard} at {record['revision']} appended to {args.results}")
+    print_comparison(results, previous)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--serve-dashboard':
+        serve_dashboard(sys.argv[2], json.loads(sys.argv[3]))
+    else:
+        main()
@@ -29,20 +29,129 @@
 # 2. Run the dashboard: `uv run knotstats.py`
 # 3. Open http://127.0.0.1:5001 in your browser
 #
+# The page's third-party assets (Chart.js, the Inter font) are served from the
+# static/ directory next to the script once fetched with `--vendor`; run that
+# on a machine with internet access and copy static/ along for offline hosts.
+#
+# Hosts edits reach Knot Resolver through `systemctl reload` by default. With
+# HOSTS_APPLY = 'control' only the changed hints are pushed to each running
+# kresd over its control socket instead, which keeps caches warm; kresd must
+# load the file with the hints module and the dashboard must be able to open
+# the sockets:
+#
+# ```kresd.conf
+# modules = { 'hints' }
+# hints.add_hosts('/etc/knot-resolver/hosts.local')
+# ```
+#
 
 import requests
+import array
+import atexit
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import fcntl
+import functools
+import gzip
+import base64
+import hashlib
 import json
+import logging
+import mimetypes
+import mmap
 import os
+import random
+import re
+import select
+import signal
+import socket
+import stat
+import struct
 import subprocess
-from flask import Flask, render_template_string, jsonify
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+try:
+    import zstandard # Optional: offered as Content-Encoding: zstd when installed
+except ImportError:
+    zstandard = None
+try:
+    import orjson # Optional: faster JSON encoding and decoding of stats bodies when installed
+except ImportError:
+    orjson = None
+try:
+    import gunicorn.app.base # Optional: only needed to serve with WORKERS > 1
+except ImportError:
+    gunicorn = None
+from flask import Flask, Response, abort, g, jsonify, request, stream_with_context
 
 # --- Configuration ---
 KNOT_RESOLVER_STATS_URL = "http://192.168.1.22:8888/metrics/json"
+# Resolvers to scrape concurrently, as {"name": ..., "url": ..., "timeout": ...} dicts (name and timeout
+# optional; names default to the URL's host, or host:port if shared, and must be distinct). With more
+# than one, instance ids become "name/instance". Empty means KNOT_RESOLVER_STATS_URL.
+KNOT_RESOLVER_TARGETS = []
 HOSTS_FILE_PATH = "/etc/knot-resolver/hosts.local"
+HOSTS_PAGE_SIZE = 100 # Default and maximum (x10) number of hosts per /api/hosts page
+RELOAD_COMMAND = ['/usr/bin/sudo', '/usr/bin/systemctl', 'reload', 'knot-resolver']
+RELOAD_DEBOUNCE = 2.0 # Seconds without further hosts edits before Knot Resolver is reloaded for them
+RELOAD_MAX_DELAY = 10.0 # Longest an edit waits for its reload while further edits keep arriving
+RELOAD_TIMEOUT = 30 # Seconds a reload may take before it counts as failed
+# File the workers share reload status through, in a directory only this user can write to; None uses a
+# private directory under /dev/shm when WORKERS > 1 and keeps the status in memory otherwise
+RELOAD_STATE_PATH = None
+HOSTS_APPLY = 'reload' # 'reload' runs RELOAD_COMMAND; 'control' pushes changed hints over each kresd's control socket
+KRESD_CONTROL_DIR = "/run/knot-resolver/control" # One control socket per running kresd
+KRESD_CONTROL_TIMEOUT = 5.0 # Seconds a kresd gets to accept and answer the hints pushed to it
+KRESD_CONTROL_BATCH = 200 # Hint changes sent to kresd per line of Lua
+POLL_INTERVAL = 1.0 # Seconds between upstream scrapes, shared by all connected clients
+POLL_TIMEOUT = 0.5 # Default per-target scrape timeout
+SERVE_STALE_FOR = 86400 # Seconds the last good stats keep being served, flagged stale, while scrapes fail
+OVERDUE_POLLS = 3 # Polls without any scrape attempt after which the last stats are served as stale
+BREAKER_THRESHOLD = 3 # Consecutive failed scrapes after which a target is left alone for a while
+BACKOFF_INITIAL = 2.0 # Seconds before the first probe of a target left alone; doubles per failed probe
+BACKOFF_MAX = 60.0
+LOG_REPEAT_INTERVAL = 60 # Seconds an identical scrape error stays out of the log once logged
+DELTA_HISTORY = 30 # Recent snapshots kept so clients can fetch deltas with ?since=<seq>
+HISTORY_WINDOW = 900 # Seconds of per-poll history kept in memory for /api/history
+HISTORY_STORE_DIR = "/var/lib/knotstats/history" # Persists history across restarts; None keeps it in memory only
+# On-disk tiers as (resolution, retention, segment file span) in seconds, finest first
+STORE_TIERS = [(1, 3600, 3600), (60, 30 * 86400, 86400), (3600, 730 * 86400, 30 * 86400)]
+STORE_FLUSH_INTERVAL = 10 # Seconds between batched writes of history segments to disk
+SSE_KEEPALIVE = 15 # Seconds between keep-alive comments on idle event streams
+LISTEN_HOST = '0.0.0.0'
+LISTEN_PORT = 5001
+# HTTP worker processes. With more than one, a single collector process scrapes and publishes
+# each snapshot through SNAPSHOT_CHANNEL_PATH, and gunicorn runs the workers (pip install gunicorn)
+WORKERS = 1
+WORKER_THREADS = 32 # Threads per worker; each open event stream holds one
+SNAPSHOT_CHANNEL_PATH = "/dev/shm/knotstats-snapshot"
+COLLECTOR_STALL_INTERVALS = 3 # Polls without a new snapshot after which workers serve the last one as stale
+# Page assets served by the app itself; third-party ones are fetched into it with --vendor
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+# Vendored file name -> where --vendor downloads it from (also used as a fallback until it has)
+VENDOR_ASSETS = {
+    "chart.umd.min.js": "https://cdn.jsdelivr.net/npm/chart.js@4.4.0/dist/chart.umd.min.js",
+    "inter-latin-400-normal.woff2": "https://cdn.jsdelivr.net/npm/@fontsource/inter@5.0.16/files/inter-latin-400-normal.woff2",
+    "inter-latin-600-normal.woff2": "https://cdn.jsdelivr.net/npm/@fontsource/inter@5.0.16/files/inter-latin-600-normal.woff2",
+    "inter-latin-700-normal.woff2": "https://cdn.jsdelivr.net/npm/@fontsource/inter@5.0.16/files/inter-latin-700-normal.woff2",
+}
+LATENCY_WINDOW = 60 # Seconds of recent answers the latency percentiles are estimated from
+LATENCY_QUANTILES = (50, 90, 99) # Percentiles estimated from the answer.* latency buckets
+METRICS_PREFIX = "knot_resolver" # Prefix of every metric name on the Prometheus /metrics endpoint
+COMPRESS_MIN_SIZE = 1024 # Bodies smaller than this many bytes are always sent uncompressed
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+# Upper bounds in seconds of the histogram buckets stage timings are counted in
+TIMING_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
 # --- Flask App ---
-app = Flask(__name__)
+app = Flask(__name__, static_folder=None) # Static assets are served by StaticAssets
 
-# --- HTML Template with Tailwind CSS, Chart.js, and JavaScript ---
+# --- HTML Template with prebuilt Tailwind CSS, Chart.js, and JavaScript ---
 HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html lang="en">
@@ -50,14 +159,12 @@ HTML_TEMPLATE = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Knot Resolver Stats Dashboard</title>
-    <script src="https://cdn.tailwindcss.com"></script>
-    <script src="https://cdn.jsdelivr.net/npm/chart.js@4.4.0/dist/chart.umd.min.js"></script>
-    <link rel="preconnect" href="https://fonts.googleapis.com">
-    <link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>
-    <link href="https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700&display=swap" rel="stylesheet">
+    <link href="{{ asset_url('tailwind.css') }}" rel="stylesheet">
+    <script src="{{ asset_url('chart.umd.min.js') }}"></script>
     <style>
+        {{ font_faces|safe }}
         body {
-            font-family: 'Inter', sans-serif;
+            font-family: 'Inter', system-ui, -apple-system, 'Segoe UI', sans-serif;
             background-color: #f7fafc; /* gray-100 */
         }
         /* Custom card styling */
@@ -183,6 +290,32 @@ HTML_TEMPLATE = """
         .hosts-table-row:hover {
             background-color: #f7fafc;
         }
+        .hosts-viewport {
+            max-height: 32rem;
+            overflow-y: auto;
+        }
+        .hosts-cell {
+            height: 44px; /* Fixed, so rows out of view can be replaced by spacers */
+            padding: 0 1rem;
+            border-bottom: 1px solid #e5e7eb;
+            white-space: nowrap;
+        }
+        .hosts-cell .host-input {
+            padding: 0.125rem 0.5rem;
+        }
+        .hosts-toolbar {
+            display: flex;
+            flex-wrap: wrap;
+            align-items: center;
+            gap: 0.5rem;
+        }
+        .hosts-toolbar .hosts-search {
+            flex: 1 1 16rem;
+            width: auto;
+        }
+        .hosts-toolbar .hosts-select {
+            width: auto;
+        }
         .host-action-btn {
             padding: 0.25rem 0.5rem;
             border-radius: 0.25rem;
@@ -266,13 +399,27 @@ HTML_TEMPLATE = """
         </div>
 
         <div id="dashboard-content" style="display: none;">
+            <div id="stale-notice" class="mb-4 p-3 rounded bg-yellow-100 text-yellow-800" style="display: none;"></div>
+            <div id="target-errors" class="mb-4 p-3 rounded bg-yellow-100 text-yellow-800" style="display: none;"></div>
+
             <div class="instance-selector">
                 <label for="instance-select" class="sr-only">Select Instance:</label>
                 <select id="instance-select" class="instance-select">
                     </select>
             </div>
 
+            <div id="rates-container" class="stats-grid mb-6">
+                </div>
+
             <div class="charts-grid">
+                <div class="chart-card" style="grid-column: 1 / -1;">
+                    <div class="chart-title">Queries per Second</div>
+                    <canvas id="qpsChart"></canvas>
+                </div>
+                <div class="chart-card" style="grid-column: 1 / -1;">
+                    <div class="chart-title">Answer Latency Percentiles (ms, last {{ latency_window }}s)</div>
+                    <canvas id="latencyChart"></canvas>
+                </div>
                 <div class="chart-card">
                     <div class="chart-title">Answer Status Distribution</div>
                     <canvas id="answerStatusChart"></canvas>
@@ -286,7 +433,7 @@ HTML_TEMPLATE = """
                     <canvas id="answerSourceChart"></canvas>
                 </div>
                 <div class="chart-card">
-                    <div class="chart-title">Answer Latency (ms)</div>
+                    <div class="chart-title">Answer Latency (ms, last {{ latency_window }}s)</div>
                     <canvas id="answerLatencyChart"></canvas>
                 </div>
             </div>
@@ -308,7 +455,24 @@ HTML_TEMPLATE = """
                             Save Changes
                         </button>
                     </div>
-                    <div id="hosts-table-container" class="overflow-x-auto">
+                    <div class="hosts-toolbar mb-4">
+                        <input id="hosts-search" type="search" class="host-input hosts-search" placeholder="Search IP addresses and hostnames">
+                        <select id="hosts-match" class="host-input hosts-select" aria-label="Match">
+                            <option value="substring">Contains</option>
+                            <option value="prefix">Starts with</option>
+                        </select>
+                        <select id="hosts-sort" class="host-input hosts-select" aria-label="Sort by">
+                            <option value="file">File order</option>
+                            <option value="hostname">Hostname</option>
+                            <option value="ip">IP address</option>
+                        </select>
+                        <select id="hosts-order" class="host-input hosts-select" aria-label="Order">
+                            <option value="asc">Ascending</option>
+                            <option value="desc">Descending</option>
+                        </select>
+                        <span id="hosts-count" class="text-gray-500"></span>
+                    </div>
+                    <div id="hosts-table-container" class="overflow-x-auto hosts-viewport">
                         <table class="min-w-full bg-white">
                             <thead>
                                 <tr class="bg-gray-100 text-gray-700">
@@ -331,7 +495,7 @@ HTML_TEMPLATE = """
     </main>
 
     <footer>
-        Auto-refreshing every second.
+        Live updates pushed by the server every second.
     </footer>
 
     <script>
@@ -342,16 +506,35 @@ HTML_TEMPLATE = """
         const dashboardContent = document.getElementById('dashboard-content');
         const instanceSelect = document.getElementById('instance-select');
         const statsTitle = document.getElementById('stats-title');
+        const ratesContainer = document.getElementById('rates-container');
+        const targetErrorsBox = document.getElementById('target-errors');
+        const staleNotice = document.getElementById('stale-notice');
         const statsApiUrl = '/api/stats';
+        const statsStreamUrl = '/api/stats/stream';
+        const historyApiUrl = '/api/history';
+        const latencyApiUrl = '/api/latency';
+        const historyWindow = {{ history_window }}; // Seconds of history the server keeps
 
         let currentInstanceId = 'All'; // Default to 'All'
-        let allStats = {}; // Will hold all instances stats
+        let allStats = {}; // Server-side view for the current selection: {group: {section: {key: value}}}
+        let knownInstances = []; // Every instance id reported by the server, for the selector
+        let allRates = {}; // Per-second rates of the counters in allStats, same shape
+        let allLatency = {}; // Recent answer latency per group: {group: {p50, p90, p99, answers, buckets}}
+        let statsSeq = 0; // "seq" of the snapshot held in allStats, sent back as ?since=; 0 while none is held
+        let statsTimestamp = null; // When the server took that snapshot (seconds since the epoch)
 
         // Chart instances (initialized later)
         let answerStatusChart = null;
         let requestTypeChart = null;
         let answerLatencyChart = null;
         let answerSourceChart = null;
+        let qpsChart = null;
+        let qpsNeedsHistory = true; // Reload the trend from /api/history on the next update
+        let qpsLastTimestamp = null;
+        const qpsMetrics = ['request.udp', 'request.tcp', 'request.dot', 'request.doh'];
+        let latencyChart = null;
+        let latencyLastTimestamp = null;
+        const latencyPercentiles = ['p50', 'p90', 'p99'];
 
         // Chart configuration helper
         const chartColors = {
@@ -454,8 +637,9 @@ HTML_TEMPLATE = """
             });
         }
 
-        function initAnswerLatencyChart(ctx, data) {
-            const answerStats = data.answer || {};
+        // Answers per latency bucket over the server's latency window, not since kresd started
+        function initAnswerLatencyChart(ctx, buckets) {
+            const answerStats = buckets || {};
             const labels = ['<1ms', '<10ms', '<50ms', '<100ms', '<250ms', '<500ms', '<1s', '<1.5s', 'Slow'];
             const chartData = {
                 labels: labels,
@@ -486,8 +670,175 @@ HTML_TEMPLATE = """
             });
         }
 
+        function initQpsChart(ctx) {
+            const colors = [chartColors.blue, chartColors.purple, chartColors.teal, chartColors.indigo];
+            return new Chart(ctx, {
+                type: 'line',
+                data: {
+                    labels: [],
+                    datasets: ['UDP', 'TCP', 'DoT', 'DoH'].map((label, i) => ({
+                        label: label,
+                        data: [],
+                        borderColor: colors[i],
+                        backgroundColor: colors[i],
+                        borderWidth: 2,
+                        pointRadius: 0,
+                        tension: 0.2
+                    }))
+                },
+                options: {
+                    responsive: true,
+                    animation: false,
+                    scales: {
+                        x: { ticks: { maxTicksLimit: 10, autoSkip: true } },
+                        y: { beginAtZero: true, title: { display: true, text: 'Queries / s' } }
+                    },
+                    plugins: { legend: { position: 'top' } }
+                }
+            });
+        }
+
+        function initLatencyChart(ctx) {
+            const colors = [chartColors.green, chartColors.yellow, chartColors.red];
+            return new Chart(ctx, {
+                type: 'line',
+                data: {
+                    labels: [],
+                    datasets: latencyPercentiles.map((label, i) => ({
+                        label: label,
+                        data: [],
+                        borderColor: colors[i],
+                        backgroundColor: colors[i],
+                        borderWidth: 2,
+                        pointRadius: 0,
+                        tension: 0.2
+                    }))
+                },
+                options: {
+                    responsive: true,
+                    animation: false,
+                    scales: {
+                        x: { ticks: { maxTicksLimit: 10, autoSkip: true } },
+                        y: { beginAtZero: true, title: { display: true, text: 'ms' } }
+                    },
+                    plugins: { legend: { position: 'top' } }
+                }
+            });
+        }
+
         // --- Data Update Functions ---
 
+        function formatTime(timestamp) {
+            return new Date(timestamp * 1000).toLocaleTimeString();
+        }
+
+        // Replace the QPS trend with the server-side history for the current view
+        async function loadQpsHistory() {
+            const query = viewQuery();
+            try {
+                const response = await fetch(`${historyApiUrl}?metrics=${qpsMetrics.join(',')}&rate=1&${query}`);
+                if (!response.ok) {
+                    throw new Error(`HTTP error! Status: ${response.status}`);
+                }
+                const data = await response.json();
+                if (query !== viewQuery()) {
+                    return; // Selection changed while loading
+                }
+                const series = data.series[currentInstanceId] || {};
+                qpsChart.data.labels = data.timestamps.map(formatTime);
+                qpsChart.data.datasets.forEach((dataset, i) => {
+                    dataset.data = series[qpsMetrics[i]] || data.timestamps.map(() => null);
+                });
+                qpsLastTimestamp = data.timestamps.length > 0 ? data.timestamps[data.timestamps.length - 1] : null;
+                qpsChart.update('none');
+            } catch (error) {
+                console.error("Error loading QPS history:", error);
+            }
+        }
+
+        // Replace the latency percentile trend with the server-side series for the current view
+        async function loadLatencyHistory() {
+            const query = viewQuery();
+            try {
+                const response = await fetch(`${latencyApiUrl}?${query}`);
+                if (!response.ok) {
+                    throw new Error(`HTTP error! Status: ${response.status}`);
+                }
+                const data = await response.json();
+                if (query !== viewQuery()) {
+                    return; // Selection changed while loading
+                }
+                const series = data.series[currentInstanceId] || {};
+                latencyChart.data.labels = data.timestamps.map(formatTime);
+                latencyChart.data.datasets.forEach((dataset, i) => {
+                    dataset.data = series[latencyPercentiles[i]] || data.timestamps.map(() => null);
+                });
+                latencyLastTimestamp = data.timestamps.length > 0 ? data.timestamps[data.timestamps.length - 1] : null;
+                latencyChart.update('none');
+            } catch (error) {
+                console.error("Error loading latency history:", error);
+            }
+        }
+
+        // Append the latest percentiles to the latency trend, keeping at most one history window of points
+        function appendLatencyPoint(timestamp, latency) {
+            if (timestamp === null || (latencyLastTimestamp !== null && timestamp <= latencyLastTimestamp)) {
+                return;
+            }
+            latencyChart.data.labels.push(formatTime(timestamp));
+            latencyChart.data.datasets.forEach((dataset, i) => {
+                const value = latency[latencyPercentiles[i]];
+                dataset.data.push(value === undefined ? null : value);
+            });
+            while (latencyChart.data.labels.length > historyWindow) {
+                latencyChart.data.labels.shift();
+                latencyChart.data.datasets.forEach(dataset => dataset.data.shift());
+            }
+            latencyLastTimestamp = timestamp;
+            latencyChart.update('none');
+        }
+
+        // Append the latest rates to the QPS trend, keeping at most one history window of points
+        function appendQpsPoint(timestamp, rates) {
+            if (timestamp === null || (qpsLastTimestamp !== null && timestamp <= qpsLastTimestamp)) {
+                return;
+            }
+            const requestRates = rates.request || {};
+            qpsChart.data.labels.push(formatTime(timestamp));
+            qpsChart.data.datasets.forEach((dataset, i) => {
+                const value = requestRates[qpsMetrics[i].split('.')[1]];
+                dataset.data.push(value === undefined ? null : value);
+            });
+            while (qpsChart.data.labels.length > historyWindow) {
+                qpsChart.data.labels.shift();
+                qpsChart.data.datasets.forEach(dataset => dataset.data.shift());
+            }
+            qpsLastTimestamp = timestamp;
+            qpsChart.update('none');
+        }
+
+        // Headline per-second rates and latency percentiles for the current view
+        function renderRates(rates, latency) {
+            const answerRates = rates.answer || {};
+            const requestRates = rates.request || {};
+            const cacheRates = rates.cache || {};
+            const external = ['udp', 'tcp', 'dot', 'doh', 'xdp'].filter(key => key in requestRates);
+            const cards = [
+                ['Queries / s', external.length > 0 ? external.reduce((sum, key) => sum + requestRates[key], 0) : undefined],
+                ['Answers / s', answerRates.total],
+                ['SERVFAIL / s', answerRates.servfail],
+                ['Cache lookups / s', cacheRates.lookup],
+                ['Cache hit % (now)', cacheRates.hit_percent_calculated],
+                ...latencyPercentiles.map(name => [`${name} latency (ms)`, latency[name]]),
+            ];
+            ratesContainer.innerHTML = cards.map(([label, value]) => `
+                <div class="stat-card">
+                    <div class="stat-key">${label}</div>
+                    <div class="stat-value">${value === undefined || value === null ? '&ndash;' : (label.includes('%') ? `${value.toFixed(2)}%` : value.toLocaleString(undefined, { maximumFractionDigits: 1 }))}</div>
+                </div>
+            `).join('');
+        }
+
         function updateChartData(chart, newData) {
             if (chart) {
                 chart.data.datasets[0].data = newData;
@@ -519,7 +870,7 @@ HTML_TEMPLATE = """
 
         // Function to populate the instance selector dropdown
         function populateInstanceSelector(instances) {
-            const previouslySelected = instanceSelect.value || currentInstanceId; // Remember what was selected
+            const previouslySelected = currentInstanceId; // Remember what was selected
             instanceSelect.innerHTML = ''; // Clear existing options
 
             // Add the "All" option first
@@ -536,85 +887,21 @@ HTML_TEMPLATE = """
                 instanceSelect.appendChild(option);
             });
 
-            // Try to re-select the previously selected option
+            // Try to re-select the previously selected option; updateDashboard() handles
+            // switching the view over to 'All' if it has disappeared
             if (Array.from(instanceSelect.options).some(opt => opt.value === previouslySelected)) {
                  instanceSelect.value = previouslySelected;
-                 currentInstanceId = previouslySelected; // Update currentInstanceId if it changed
             } else {
-                // If the previous selection isn't valid anymore, default to 'All'
                 instanceSelect.value = 'All';
-                currentInstanceId = 'All';
             }
         }
 
-        // Function to aggregate stats from all instances
-        function aggregateStats(allInstancesData) {
-            const aggregated = {};
-            const instanceIds = Object.keys(allInstancesData);
-
-            if (instanceIds.length === 0) {
-                return {}; // Return empty if no instances
-            }
-
-            // Deep clone the structure of the first instance to initialize aggregation
-            // This helps ensure all sections and keys are present
-            const firstInstanceData = allInstancesData[instanceIds[0]];
-            for (const section in firstInstanceData) {
-                aggregated[section] = {};
-                for (const key in firstInstanceData[section]) {
-                     // Initialize numeric keys to 0, keep others as null/undefined for now
-                     aggregated[section][key] = (typeof firstInstanceData[section][key] === 'number') ? 0 : null;
-                }
-            }
-
-
-            // Sum numeric stats across all instances
-            instanceIds.forEach(id => {
-                const instanceData = allInstancesData[id];
-                for (const section in instanceData) {
-                    if (!aggregated[section]) aggregated[section] = {}; // Ensure section exists
-                    for (const key in instanceData[section]) {
-                        const value = instanceData[section][key];
-                        if (typeof value === 'number') {
-                             // Initialize if null or undefined in aggregated structure
-                            if (aggregated[section][key] === null || aggregated[section][key] === undefined) {
-                                aggregated[section][key] = 0;
-                            }
-                            aggregated[section][key] = (aggregated[section][key] || 0) + value;
-                        } else if (aggregated[section][key] === null || aggregated[section][key] === undefined) {
-                            // If it's the first time seeing a non-numeric stat, just take the value
-                            // (doesn't make sense to aggregate strings, etc.) - maybe show 'Multiple'?
-                            // For simplicity, let's keep it simple and just init to 0 for numbers.
-                            // We might need more sophisticated handling for specific non-numeric stats later.
-                             if (aggregated[section][key] === null) { // Only set if it's still null
-                                // aggregated[section][key] = value; // Or maybe keep it null/indicate mixed?
-                             }
-                        }
-                    }
-                }
-            });
-
-             // Post-processing: Calculate percentages, ratios if needed based on aggregated sums
-            if (aggregated.cache && aggregated.cache.hit_ratio_compute) {
-                 const hits = aggregated.cache.hit || 0;
-                 const totalLookups = aggregated.cache.lookup || 0;
-                 aggregated.cache.hit_percent = totalLookups > 0 ? (hits / totalLookups) * 100 : 0;
-                 // Remove the compute flag if it exists
-                 delete aggregated.cache.hit_ratio_compute;
-            }
-             // Example: Calculate cache hit percent if applicable
-            if (aggregated.cache && aggregated.cache.hasOwnProperty('hit') && aggregated.cache.hasOwnProperty('lookup')) {
-                 const hits = aggregated.cache.hit || 0;
-                 const lookups = aggregated.cache.lookup || 0;
-                 // Use a more specific key like 'hit_percent_calculated' to avoid conflict
-                 aggregated.cache.hit_percent_calculated = lookups > 0 ? (hits / lookups * 100) : 0;
-            }
-
-
-            return aggregated;
+        // Query string selecting the server-side view for the current selection:
+        // the aggregate of all instances, or a single instance
+        function viewQuery() {
+            return currentInstanceId === 'All' ? 'group_by=all' : `instance=${encodeURIComponent(currentInstanceId)}`;
         }
 
-
         // Function to render raw stats for current instance or aggregated view
         function renderRawStats(dataToRender) {
             statsContainer.innerHTML = ''; // Clear previous raw stats
@@ -658,8 +945,8 @@ HTML_TEMPLATE = """
             });
         }
 
-        // Function to update the dashboard with data from the selected instance or 'All'
-        function updateDashboard(allInstancesData) {
+        // Function to update the dashboard with the view for the selected instance or 'All'
+        function updateDashboard(viewData) {
             // Hide loading/error
             errorMessage.textContent = '';
             loadingState.style.display = 'none';
@@ -674,30 +961,19 @@ HTML_TEMPLATE = """
                 // Don't change hostsEditorSection visibility - let the tab handler manage it
             }
 
-            allStats = allInstancesData; // Store the latest full data
-            const instanceIds = Object.keys(allInstancesData);
-
             // Update instance selector (only if instance list changed?) - safer to update always
-             populateInstanceSelector(instanceIds);
-
-            let dataToDisplay;
-            let titleSuffix = '';
+            populateInstanceSelector(knownInstances);
 
-            if (currentInstanceId === 'All') {
-                dataToDisplay = aggregateStats(allInstancesData);
-                titleSuffix = ' (Aggregated)';
-            } else {
-                dataToDisplay = allInstancesData[currentInstanceId];
-                if (!dataToDisplay) {
-                     // This case should ideally be handled by populateInstanceSelector defaulting to 'All'
-                     console.warn(`Selected instance "${currentInstanceId}" not found in data, defaulting to aggregated view.`);
-                     currentInstanceId = 'All';
-                     instanceSelect.value = 'All';
-                     dataToDisplay = aggregateStats(allInstancesData);
-                     titleSuffix = ' (Aggregated - Fallback)';
-                } else {
-                    titleSuffix = ` (${currentInstanceId})`;
+            // The server already aggregated the view; it holds a single group keyed by the selection
+            let dataToDisplay = viewData[currentInstanceId];
+            const titleSuffix = currentInstanceId === 'All' ? ' (Aggregated)' : ` (${currentInstanceId})`;
+            if (!dataToDisplay) {
+                if (currentInstanceId !== 'All') {
+                    console.warn(`Selected instance "${currentInstanceId}" not found in data, defaulting to aggregated view.`);
+                    selectInstance('All');
+                    return;
                 }
+                dataToDisplay = {}; // No instances reported yet
             }
 
              // Update the title for the raw stats section
@@ -733,16 +1009,17 @@ HTML_TEMPLATE = """
                 Math.max(0, (answerStats.total || 0) - (answerStats.cached || 0) - (answerStats.stale || 0)) // Ensure non-negative
             ];
 
+            const latencyBuckets = (allLatency[currentInstanceId] || {}).buckets || {}; // Recent answers only
             const answerLatencyData = [
-                answerStats['1ms'] || 0,
-                answerStats['10ms'] || 0,
-                answerStats['50ms'] || 0,
-                answerStats['100ms'] || 0,
-                answerStats['250ms'] || 0,
-                answerStats['500ms'] || 0,
-                answerStats['1000ms'] || 0,
-                answerStats['1500ms'] || 0,
-                answerStats.slow || 0
+                latencyBuckets['1ms'] || 0,
+                latencyBuckets['10ms'] || 0,
+                latencyBuckets['50ms'] || 0,
+                latencyBuckets['100ms'] || 0,
+                latencyBuckets['250ms'] || 0,
+                latencyBuckets['500ms'] || 0,
+                latencyBuckets['1000ms'] || 0,
+                latencyBuckets['1500ms'] || 0,
+                latencyBuckets.slow || 0
             ];
 
             // --- Initialize or Update Charts ---
@@ -751,7 +1028,9 @@ HTML_TEMPLATE = """
                     answerStatusChart = initAnswerStatusChart(document.getElementById('answerStatusChart').getContext('2d'), dataToDisplay);
                     requestTypeChart = initRequestTypeChart(document.getElementById('requestTypeChart').getContext('2d'), dataToDisplay);
                     answerSourceChart = initAnswerSourceChart(document.getElementById('answerSourceChart').getContext('2d'), dataToDisplay);
-                    answerLatencyChart = initAnswerLatencyChart(document.getElementById('answerLatencyChart').getContext('2d'), dataToDisplay);
+                    answerLatencyChart = initAnswerLatencyChart(document.getElementById('answerLatencyChart').getContext('2d'), latencyBuckets);
+                    qpsChart = initQpsChart(document.getElementById('qpsChart').getContext('2d'));
+                    latencyChart = initLatencyChart(document.getElementById('latencyChart').getContext('2d'));
                 } catch (e) {
                     console.error("Error initializing charts:", e);
                     showError("Error initializing charts. Check console for details.");
@@ -767,6 +1046,21 @@ HTML_TEMPLATE = """
                     // Don't necessarily show a full error screen, but log it.
                 }
             }
+
+            // --- Rates and QPS trend ---
+            const ratesToDisplay = allRates[currentInstanceId] || {};
+            const latencyToDisplay = allLatency[currentInstanceId] || {};
+            renderRates(ratesToDisplay, latencyToDisplay);
+            if (qpsChart) {
+                if (qpsNeedsHistory) {
+                    qpsNeedsHistory = false;
+                    loadQpsHistory();
+                    loadLatencyHistory();
+                } else {
+                    appendQpsPoint(statsTimestamp, ratesToDisplay);
+                    appendLatencyPoint(statsTimestamp, latencyToDisplay);
+                }
+            }
         }
 
         // Function to show error state
@@ -778,10 +1072,65 @@ HTML_TEMPLATE = """
             console.error("Error fetching/processing stats:", error);
         }
 
+        // Deep-merge a delta into target; null values mark removed keys
+        function mergeDelta(target, changes) {
+            for (const key in changes) {
+                const value = changes[key];
+                if (value === null) {
+                    delete target[key];
+                } else if (typeof value === 'object' && typeof target[key] === 'object' && target[key] !== null) {
+                    mergeDelta(target[key], value);
+                } else {
+                    target[key] = value;
+                }
+            }
+        }
+
+        // Apply a full or delta update from /api/stats?since= or the event stream.
+        // Returns false if a delta was computed against a snapshot we no longer hold.
+        function applyStatsUpdate(update) {
+            if (update.full) {
+                allStats = update.stats;
+                allRates = update.rates;
+            } else if (update.since === statsSeq) {
+                update.removed.forEach(id => {
+                    delete allStats[id];
+                    delete allRates[id];
+                });
+                mergeDelta(allStats, update.changed);
+                mergeDelta(allRates, update.rates);
+            } else {
+                return false;
+            }
+            statsSeq = update.seq;
+            statsTimestamp = update.timestamp;
+            knownInstances = update.instances;
+            allLatency = update.latency || {};
+            renderTargetErrors(update.target_errors);
+            renderStaleness(update);
+            return true;
+        }
+
+        // Say how old the numbers are while the server keeps serving its last good snapshot
+        function renderStaleness(update) {
+            staleNotice.style.display = update.stale ? 'block' : 'none';
+            if (update.stale) {
+                staleNotice.textContent = `Showing the last stats received, ${Math.round(update.age)}s old: ${update.stale_error}`;
+            }
+        }
+
+        // Show which resolvers failed their latest scrape while the others still report
+        function renderTargetErrors(targetErrors) {
+            const names = Object.keys(targetErrors || {});
+            targetErrorsBox.style.display = names.length ? 'block' : 'none';
+            targetErrorsBox.textContent = names.map(name => `${name}: ${targetErrors[name]}`).join(' | ');
+        }
+
         // Function to fetch stats from the Flask backend
         async function fetchStats() {
             try {
-                const response = await fetch(statsApiUrl);
+                const query = viewQuery();
+                const response = await fetch(`${statsApiUrl}?${query}&since=${statsSeq}`);
                 if (!response.ok) {
                     let errorDetails = `HTTP error! Status: ${response.status}`;
                     try {
@@ -794,26 +1143,37 @@ HTML_TEMPLATE = """
                 if (data.error) {
                     throw new Error(data.error);
                 }
-                 if (typeof data !== 'object' || data === null || Object.keys(data).length === 0) {
-                    // Handle case where backend returns valid JSON but it's empty or not an object
+                if (query !== viewQuery() || !applyStatsUpdate(data)) {
+                    return; // Selection changed or raced with a stream update; the next poll catches up
+                }
+                if (knownInstances.length === 0) {
+                    // Handle case where backend returns valid JSON but no instances
                     throw new Error("Received empty or invalid data structure from backend.");
                 }
-                updateDashboard(data); // Call the main update function
+                updateDashboard(allStats); // Call the main update function
             } catch (error) {
                 showError(error.message);
             }
         }
 
+        // Switch to another view: drop the stats we hold and resubscribe for the new selection
+        function selectInstance(instanceId) {
+            currentInstanceId = instanceId;
+            instanceSelect.value = instanceId;
+            allStats = {};
+            allRates = {};
+            allLatency = {};
+            statsSeq = 0;
+            qpsNeedsHistory = true;
+            restartStream();
+            if (pollTimer !== null) {
+                fetchStatsIfActive();
+            }
+        }
+
         // Handle instance selection change
         instanceSelect.addEventListener('change', function() {
-            currentInstanceId = this.value;
-            // Re-render the dashboard immediately with the stored data for the new selection
-            if (allStats && Object.keys(allStats).length > 0) {
-                updateDashboard(allStats);
-            } else {
-                // If allStats is empty for some reason, trigger a fetch
-                fetchStats();
-            }
+            selectInstance(this.value);
         });
 
         // Track which tab is active
@@ -826,22 +1186,107 @@ HTML_TEMPLATE = """
             }
         }
 
-        // Fetch stats immediately on load
-        fetchStats();
+        // Fallback: poll every 1000ms (1 second) while the event stream is unavailable
+        let pollTimer = null;
+
+        function startPolling() {
+            if (pollTimer === null) {
+                fetchStatsIfActive();
+                pollTimer = setInterval(fetchStatsIfActive, 1000);
+            }
+        }
+
+        function stopPolling() {
+            if (pollTimer !== null) {
+                clearInterval(pollTimer);
+                pollTimer = null;
+            }
+        }
+
+        let statsSource = null;
+
+        // Subscribe to stats pushed by the server; EventSource reconnects on its own after transient errors
+        function startStream() {
+            if (!window.EventSource) {
+                startPolling();
+                return;
+            }
+            const source = new EventSource(`${statsStreamUrl}?${viewQuery()}`);
+            statsSource = source;
+            source.onopen = () => stopPolling();
+            source.onmessage = (event) => {
+                const data = JSON.parse(event.data);
+                if (data.error) {
+                    if (activeTab === 'dashboard') {
+                        showError(data.error);
+                    }
+                    return;
+                }
+                if (!applyStatsUpdate(data)) {
+                    // Our base diverged (e.g. a fallback poll landed in between); reconnect for a full snapshot
+                    statsSeq = 0;
+                    restartStream();
+                    return;
+                }
+                if (activeTab === 'dashboard') {
+                    updateDashboard(allStats);
+                }
+            };
+            source.onerror = () => {
+                startPolling();
+                if (source.readyState === EventSource.CLOSED) {
+                    // The server refused the stream outright; keep polling and retry later
+                    setTimeout(() => {
+                        if (statsSource === source) {
+                            restartStream();
+                        }
+                    }, 30000);
+                }
+            };
+        }
 
-        // Set interval to fetch stats every 1000ms (1 second)
-        setInterval(fetchStatsIfActive, 1000);
+        function restartStream() {
+            if (statsSource !== null) {
+                statsSource.close();
+                statsSource = null;
+            }
+            startStream();
+        }
+
+        // The stream delivers the current snapshot immediately on connect
+        startStream();
 
         // --- Hosts Editor Functionality ---
         const hostsEditorSection = document.getElementById('hosts-editor-section');
         const dashboardTab = document.getElementById('dashboard-tab');
         const hostsTab = document.getElementById('hosts-tab');
         const hostsTableBody = document.getElementById('hosts-table-body');
+        const hostsViewport = document.getElementById('hosts-table-container');
         const addHostBtn = document.getElementById('add-host-btn');
         const saveHostsBtn = document.getElementById('save-hosts-btn');
         const hostsStatus = document.getElementById('hosts-status');
+        const hostsSearch = document.getElementById('hosts-search');
+        const hostsMatch = document.getElementById('hosts-match');
+        const hostsSort = document.getElementById('hosts-sort');
+        const hostsOrder = document.getElementById('hosts-order');
+        const hostsCount = document.getElementById('hosts-count');
+
+        const hostsPageSize = 200;
+        const hostRowHeight = 44; // px, the height .hosts-cell gives every row
+        const hostRowOverscan = 10; // Rows rendered beyond each edge of the viewport
 
-        let currentHosts = [];
+        // Only the rows in view are in the DOM; the rest of the table is two spacers
+        let hostsRows = []; // Rows of the current search loaded so far, as {index, ip, hostname}
+        let hostsTotal = 0; // How many rows the current search matches
+        let hostsCursor = null; // Cursor of the next page; null once everything is loaded
+        let hostsVersion = null; // Version of the hosts file the edits below refer to
+        let hostsLoading = false;
+        let hostsQueryId = 0; // Bumped per search, so pages of an abandoned one are dropped
+        let hostsDisplay = []; // hostsRows with the edits below applied, as {key, ip, hostname}
+        let hostEdits = new Map(); // File index -> edited {ip, hostname}, or null once deleted
+        let addedHosts = []; // New {ip, hostname} entries, listed above the file's
+        let editingKey = null; // Key of the row being edited: a file index or 'new-<n>'
+        let editDraft = null;
         let hostsChanged = false;
 
         // Tab navigation
@@ -867,18 +1312,65 @@ HTML_TEMPLATE = """
             fetchHosts();
         });
 
-        // Fetch hosts from the API
-        async function fetchHosts() {
-            try {
-                hostsTableBody.innerHTML = '<tr><td colspan="3" class="py-4 text-center text-gray-500">Loading hosts...</td></tr>';
+        function escapeHtml(text) {
+            return String(text).replace(/[&<>"']/g, c => ({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'})[c]);
+        }
+
+        // Start a new search from its first page
+        function fetchHosts() {
+            hostsQueryId++;
+            hostsRows = [];
+            hostsTotal = 0;
+            hostsCursor = null;
+            hostsLoading = false;
+            hostsViewport.scrollTop = 0;
+            hostsTableBody.innerHTML = '<tr><td colspan="3" class="py-4 text-center text-gray-500">Loading hosts...</td></tr>';
+            loadMoreHosts();
+        }
 
-                const response = await fetch('/api/hosts');
+        // Fetch the next page of the current search from the API
+        async function loadMoreHosts() {
+            if (hostsLoading || (hostsRows.length > 0 && hostsCursor === null)) {
+                return;
+            }
+            hostsLoading = true;
+            const queryId = hostsQueryId;
+            const params = new URLSearchParams({
+                q: hostsSearch.value.trim(),
+                match: hostsMatch.value,
+                sort: hostsSort.value,
+                order: hostsOrder.value,
+                limit: hostsPageSize,
+            });
+            if (hostsCursor !== null) {
+                params.set('cursor', hostsCursor);
+            }
+            try {
+                const response = await fetch(`/api/hosts?${params}`);
+                if (queryId !== hostsQueryId) {
+                    return;
+                }
+                if (response.status === 409) {
+                    fetchHosts(); // The file changed under our cursor: start over
+                    return;
+                }
                 if (!response.ok) {
                     throw new Error(`HTTP error! Status: ${response.status}`);
                 }
 
                 const data = await response.json();
-                currentHosts = data.hosts || [];
+                if (queryId !== hostsQueryId) {
+                    return;
+                }
+                if (hostEdits.size === 0) {
+                    hostsVersion = data.version;
+                } else if (data.version !== hostsVersion) {
+                    showHostsStatus('The hosts file changed on disk since you started editing it.', 'error');
+                }
+                hostsRows.push(...data.hosts);
+                hostsTotal = data.total;
+                hostsCursor = data.next_cursor;
+                hostsLoading = false;
                 renderHostsTable();
 
                 if (data.message) {
@@ -889,87 +1381,132 @@ HTML_TEMPLATE = """
                 showHostsStatus(`Failed to load hosts: ${error.message}`, 'error');
                 hostsTableBody.innerHTML = `<tr><td colspan="3" class="py-4 text-center text-red-500">
                     Error loading hosts. Please try again.</td></tr>`;
+            } finally {
+                if (queryId === hostsQueryId) {
+                    hostsLoading = false;
+                }
             }
         }
 
-        // Render the hosts table
+        // Rebuild the list of rows to show after the loaded rows or the edits changed
         function renderHostsTable() {
-            hostsTableBody.innerHTML = '';
+            hostsDisplay = addedHosts.map((host, n) => ({ key: `new-${n}`, ip: host.ip, hostname: host.hostname }));
+            hostsRows.forEach(row => {
+                const edit = hostEdits.get(row.index);
+                if (edit !== null) {
+                    hostsDisplay.push({ key: row.index, ...(edit || row) });
+                }
+            });
+            const deleted = hostsRows.length - (hostsDisplay.length - addedHosts.length);
+            const total = hostsTotal - deleted + addedHosts.length;
+            hostsCount.textContent = `${total} ${total === 1 ? 'host' : 'hosts'}`;
+            renderHostsWindow();
+        }
 
-            if (currentHosts.length === 0) {
-                hostsTableBody.innerHTML = `<tr><td colspan="3" class="py-4 text-center text-gray-500">
-                    No hosts entries found. Click "Add Host" to create one.</td></tr>`;
+        // Render just the rows in view, and fetch more once the end of the loaded ones comes close
+        function renderHostsWindow() {
+            if (hostsDisplay.length === 0 && hostsCursor === null) {
+                const message = hostsSearch.value.trim() ? 'No hosts match this search.' : 'No hosts entries found. Click "Add Host" to create one.';
+                hostsTableBody.innerHTML = `<tr><td colspan="3" class="py-4 text-center text-gray-500">${message}</td></tr>`;
                 return;
             }
+            const viewportRows = Math.ceil((hostsViewport.clientHeight || 512) / hostRowHeight);
+            const first = Math.max(0, Math.floor(hostsViewport.scrollTop / hostRowHeight) - hostRowOverscan);
+            const last = Math.min(hostsDisplay.length, first + viewportRows + 2 * hostRowOverscan);
+            const unloaded = hostsCursor === null ? 0 : hostsTotal - hostsRows.length;
 
-            currentHosts.forEach((host, index) => {
-                const row = document.createElement('tr');
-                row.className = 'hosts-table-row';
-                row.innerHTML = `
-                    <td class="py-2 px-4 border-b">${host.ip}</td>
-                    <td class="py-2 px-4 border-b">${host.hostname}</td>
-                    <td class="py-2 px-4 border-b text-center">
-                        <button class="host-action-btn host-edit-btn" data-index="${index}">Edit</button>
-                        <button class="host-action-btn host-delete-btn" data-index="${index}">Delete</button>
-                    </td>
-                `;
-                hostsTableBody.appendChild(row);
-            });
+            let html = `<tr style="height: ${first * hostRowHeight}px"></tr>`;
+            for (let position = first; position < last; position++) {
+                html += renderHostRow(hostsDisplay[position]);
+            }
+            html += `<tr style="height: ${(hostsDisplay.length - last + unloaded) * hostRowHeight}px"></tr>`;
+            hostsTableBody.innerHTML = html;
 
-            // Add event listeners to the new buttons
-            document.querySelectorAll('.host-edit-btn').forEach(btn => {
-                btn.addEventListener('click', () => editHost(parseInt(btn.dataset.index)));
-            });
+            if (last + hostRowOverscan >= hostsDisplay.length && hostsCursor !== null) {
+                loadMoreHosts();
+            }
+        }
 
-            document.querySelectorAll('.host-delete-btn').forEach(btn => {
-                btn.addEventListener('click', () => deleteHost(parseInt(btn.dataset.index)));
-            });
+        function renderHostRow(row) {
+            if (row.key === editingKey) {
+                return `<tr class="hosts-table-row" data-key="${row.key}">
+                    <td class="hosts-cell">
+                        <input type="text" class="host-input ip-input" value="${escapeHtml(editDraft.ip)}" placeholder="IP Address">
+                    </td>
+                    <td class="hosts-cell">
+                        <input type="text" class="host-input hostname-input" value="${escapeHtml(editDraft.hostname)}" placeholder="Hostname">
+                    </td>
+                    <td class="hosts-cell text-center">
+                        <button class="host-action-btn host-save-btn bg-green-600 text-white hover:bg-green-700">Save</button>
+                        <button class="host-action-btn host-cancel-btn bg-gray-500 text-white hover:bg-gray-600">Cancel</button>
+                    </td>
+                </tr>`;
+            }
+            return `<tr class="hosts-table-row" data-key="${row.key}">
+                <td class="hosts-cell">${escapeHtml(row.ip)}</td>
+                <td class="hosts-cell">${escapeHtml(row.hostname)}</td>
+                <td class="hosts-cell text-center">
+                    <button class="host-action-btn host-edit-btn">Edit</button>
+                    <button class="host-action-btn host-delete-btn">Delete</button>
+                </td>
+            </tr>`;
+        }
+
+        function hostRowKey(element) {
+            const key = element.closest('tr').dataset.key;
+            return key.startsWith('new-') ? key : Number(key);
         }
 
+        // Rows are re-rendered while scrolling, so their buttons are handled on the table body
+        hostsTableBody.addEventListener('click', (event) => {
+            const button = event.target.closest('button');
+            if (!button) {
+                return;
+            }
+            const key = hostRowKey(button);
+            if (button.classList.contains('host-edit-btn')) {
+                editHost(key);
+            } else if (button.classList.contains('host-delete-btn')) {
+                deleteHost(key);
+            } else if (button.classList.contains('host-save-btn')) {
+                saveHostEdit(key);
+            } else if (button.classList.contains('host-cancel-btn')) {
+                cancelHostEdit();
+            }
+        });
+
+        hostsTableBody.addEventListener('input', (event) => {
+            if (event.target.classList.contains('ip-input')) {
+                editDraft.ip = event.target.value;
+            } else if (event.target.classList.contains('hostname-input')) {
+                editDraft.hostname = event.target.value;
+            }
+        });
+
+        hostsViewport.addEventListener('scroll', () => requestAnimationFrame(renderHostsWindow));
+
         // Add a new host
         function addHost() {
-            const newHost = { ip: '', hostname: '' };
-            currentHosts.push(newHost);
-            renderHostsTable();
+            addedHosts.push({ ip: '', hostname: '' });
+            hostsViewport.scrollTop = 0;
 
             // Switch to edit mode for the new host
-            editHost(currentHosts.length - 1);
+            editHost(`new-${addedHosts.length - 1}`);
             hostsChanged = true;
         }
 
         // Edit an existing host
-        function editHost(index) {
-            const host = currentHosts[index];
-            const rows = hostsTableBody.querySelectorAll('tr');
-            const row = rows[index];
-
-            row.innerHTML = `
-                <td class="py-2 px-4 border-b">
-                    <input type="text" class="host-input ip-input" value="${host.ip}" placeholder="IP Address">
-                </td>
-                <td class="py-2 px-4 border-b">
-                    <input type="text" class="host-input hostname-input" value="${host.hostname}" placeholder="Hostname">
-                </td>
-                <td class="py-2 px-4 border-b text-center">
-                    <button class="host-action-btn host-save-btn bg-green-600 text-white hover:bg-green-700">Save</button>
-                    <button class="host-action-btn host-cancel-btn bg-gray-500 text-white hover:bg-gray-600">Cancel</button>
-                </td>
-            `;
-
-            const saveBtn = row.querySelector('.host-save-btn');
-            const cancelBtn = row.querySelector('.host-cancel-btn');
-
-            saveBtn.addEventListener('click', () => saveHostEdit(index, row));
-            cancelBtn.addEventListener('click', () => cancelHostEdit());
+        function editHost(key) {
+            const row = typeof key === 'string' ? addedHosts[Number(key.slice(4))] : hostsDisplay.find(row => row.key === key);
+            editingKey = key;
+            editDraft = { ip: row.ip, hostname: row.hostname };
+            renderHostsTable();
         }
 
         // Save host edit
-        function saveHostEdit(index, row) {
-            const ipInput = row.querySelector('.ip-input');
-            const hostnameInput = row.querySelector('.hostname-input');
-
-            const ip = ipInput.value.trim();
-            const hostname = hostnameInput.value.trim();
+        function saveHostEdit(key) {
+            const ip = editDraft.ip.trim();
+            const hostname = editDraft.hostname.trim();
 
             // Basic validation
             if (!ip || !hostname) {
@@ -978,41 +1515,75 @@ HTML_TEMPLATE = """
             }
 
             // Save changes
-            currentHosts[index] = { ip, hostname };
+            if (typeof key === 'string') {
+                addedHosts[Number(key.slice(4))] = { ip, hostname };
+            } else {
+                hostEdits.set(key, { ip, hostname });
+            }
+            editingKey = null;
             hostsChanged = true;
             renderHostsTable();
         }
 
-        // Cancel host edit
+        // Cancel host edit, dropping a new host that was never filled in
         function cancelHostEdit() {
+            if (typeof editingKey === 'string') {
+                const n = Number(editingKey.slice(4));
+                if (!addedHosts[n].ip && !addedHosts[n].hostname) {
+                    addedHosts.splice(n, 1);
+                }
+            }
+            editingKey = null;
             renderHostsTable();
         }
 
         // Delete a host
-        function deleteHost(index) {
+        function deleteHost(key) {
             if (confirm('Are you sure you want to delete this host entry?')) {
-                currentHosts.splice(index, 1);
+                if (typeof key === 'string') {
+                    addedHosts.splice(Number(key.slice(4)), 1);
+                } else {
+                    hostEdits.set(key, null);
+                }
+                editingKey = null;
                 hostsChanged = true;
                 renderHostsTable();
             }
         }
 
-        // Save all hosts changes
+        // Save all hosts changes: send just the edits, as one batch against the version they were made on
         async function saveAllHosts() {
+            const changes = [];
+            hostEdits.forEach((edit, index) => {
+                changes.push(edit === null ? { op: 'delete', index } : { op: 'update', index, ...edit });
+            });
+            addedHosts.filter(host => host.ip && host.hostname).forEach(host => changes.push({ op: 'add', ...host }));
+            if (changes.length === 0) {
+                showHostsStatus('No changes to save', 'info');
+                return;
+            }
             try {
                 const response = await fetch('/api/hosts', {
-                    method: 'POST',
+                    method: 'PATCH',
                     headers: {
                         'Content-Type': 'application/json'
                     },
-                    body: JSON.stringify({ hosts: currentHosts })
+                    body: JSON.stringify({ version: hostsVersion, changes })
                 });
 
                 const data = await response.json();
 
                 if (response.ok) {
                     showHostsStatus(data.message || 'Hosts file updated successfully', 'success');
+                    hostEdits = new Map();
+                    addedHosts = [];
+                    editingKey = null;
                     hostsChanged = false;
+                    hostsVersion = data.version;
+                    fetchHosts();
+                    watchHostsReload(data.reload);
+                } else if (response.status === 412) {
+                    throw new Error('The hosts file changed on disk since you started editing it; reload the Hosts Editor and redo your changes');
                 } else {
                     throw new Error(data.error || 'Failed to update hosts file');
                 }
@@ -1022,6 +1593,34 @@ HTML_TEMPLATE = """
             }
         }
 
+        // Follow the Knot Resolver reload a save scheduled until one that started after it has finished
+        async function watchHostsReload(reload) {
+            const requestedAt = reload && reload.requested_at;
+            if (!requestedAt) return;
+            const giveUpAt = Date.now() + 60000;
+            while (Date.now() < giveUpAt) {
+                await new Promise(resolve => setTimeout(resolve, 1000));
+                let status;
+                try {
+                    status = await (await fetch('/api/hosts/reload')).json();
+                } catch (error) {
+                    continue;
+                }
+                const last = status.last;
+                if (last && last.started_at >= requestedAt) {
+                    const together = last.coalesced > 1 ? ` (${last.coalesced} saves applied together)` : '';
+                    if (last.success && last.mode === 'control') {
+                        showHostsStatus(`Hints applied to ${last.workers.length} kresd workers in ${last.duration_ms} ms${together}`, 'success');
+                    } else if (last.success) {
+                        showHostsStatus(`Knot Resolver reloaded in ${last.duration_ms} ms${together}`, 'success');
+                    } else {
+                        showHostsStatus(`Failed to reload Knot Resolver: ${last.error}`, 'error');
+                    }
+                    return;
+                }
+            }
+        }
+
         // Show status message
         function showHostsStatus(message, type) {
             hostsStatus.textContent = message;
@@ -1047,6 +1646,13 @@ HTML_TEMPLATE = """
         addHostBtn.addEventListener('click', addHost);
         saveHostsBtn.addEventListener('click', saveAllHosts);
 
+        let hostsSearchTimer = null;
+        hostsSearch.addEventListener('input', () => {
+            clearTimeout(hostsSearchTimer);
+            hostsSearchTimer = setTimeout(fetchHosts, 250); // Search once typing pauses
+        });
+        [hostsMatch, hostsSort, hostsOrder].forEach(select => select.addEventListener('change', fetchHosts));
+
         // Check for unsaved changes when leaving the page
         window.addEventListener('beforeunload', (event) => {
             if (hostsChanged) {
@@ -1060,121 +1666,3042 @@ HTML_TEMPLATE = """
 </html>
 """
 
-# --- Flask Routes ---
+# --- Stage Timings ---
 
-@app.route('/')
-def index():
-    """Renders the main HTML page."""
-    return render_template_string(HTML_TEMPLATE, knot_resolver_url=KNOT_RESOLVER_STATS_URL)
+class StageTimings:
+    """Always-on fixed-bucket histograms of how long each pipeline stage takes.
 
-@app.route('/api/stats')
-def get_stats():
-    """Fetches stats from Knot Resolver and returns as JSON."""
-    try:
-        response = requests.get(KNOT_RESOLVER_STATS_URL, timeout=0.5) # Short timeout for responsiveness
-        response.raise_for_status() # Raises HTTPError for bad responses (4xx or 5xx)
-        stats_data = response.json()
-
-        # Basic validation: Check if it's a dictionary (expected format)
-        if not isinstance(stats_data, dict):
-             app.logger.warning(f"Received non-dictionary data from {KNOT_RESOLVER_STATS_URL}")
-             return jsonify({"error": "Received unexpected data format from Knot Resolver."}), 500
-
-        return jsonify(stats_data)
-
-    except requests.exceptions.ConnectionError:
-        app.logger.error(f"Connection refused to {KNOT_RESOLVER_STATS_URL}")
-        return jsonify({"error": f"Connection refused. Is Knot Resolver webmgmt running at {KNOT_RESOLVER_STATS_URL}?"}), 503 # Service Unavailable
-    except requests.exceptions.Timeout:
-        app.logger.warning(f"Request timed out for {KNOT_RESOLVER_STATS_URL}")
-        return jsonify({"error": "Request timed out fetching stats from Knot Resolver."}), 504 # Gateway Timeout
-    except requests.exceptions.HTTPError as e:
-         app.logger.error(f"HTTP error fetching stats: {e}")
-         return jsonify({"error": f"HTTP error {e.response.status_code} from Knot Resolver: {e.response.reason}"}), e.response.status_code if e.response.status_code >= 500 else 500
-    except requests.exceptions.RequestException as e:
-        app.logger.error(f"General request error fetching stats: {e}")
-        return jsonify({"error": f"Failed to fetch stats: {str(e)}"}), 500 # Internal Server Error
-    except json.JSONDecodeError:
-        app.logger.error(f"Failed to decode JSON from {KNOT_RESOLVER_STATS_URL}")
-        return jsonify({"error": "Failed to decode JSON response from Knot Resolver."}), 500 # Internal Server Error
-    except Exception as e:
-        app.logger.error(f"Unexpected error in /api/stats: {e}", exc_info=True) # Log traceback for unexpected errors
-        return jsonify({"error": f"An unexpected server error occurred."}), 500 # Internal Server Error
+    Recording costs a bisect and a few additions under an uncontended lock,
+    so every scrape and request is timed; percentiles are only estimated
+    when someone asks for them.
+    """
 
-@app.route('/api/hosts', methods=['GET'])
-def get_hosts():
-    """Fetch contents of the hosts file."""
-    try:
-        if not os.path.exists(HOSTS_FILE_PATH):
-            return jsonify({"hosts": [], "message": "Hosts file does not exist yet. It will be created when you add entries."}), 200
-
-        with open(HOSTS_FILE_PATH, 'r') as file:
-            content = file.read()
-
-        # Parse hosts file into structured data
-        hosts = []
-        for line in content.splitlines():
-            line = line.strip()
-            if line and not line.startswith('#'):
-                parts = line.split()
-                if len(parts) >= 2:
-                    hosts.append({
-                        "ip": parts[0],
-                        "hostname": parts[1]
-                    })
-
-        return jsonify({"hosts": hosts}), 200
-    except Exception as e:
-        app.logger.error(f"Error reading hosts file: {e}", exc_info=True)
-        return jsonify({"error": f"Failed to read hosts file: {str(e)}"}), 500
+    def __init__(self, buckets=TIMING_BUCKETS):
+        self.buckets = buckets
+        self._stages = {} # stage -> [bucket counts (last one is +Inf), sum of seconds]
+        self._adopted = {} # stage -> (bucket counts, sum) reported by the collector process
+        self._lock = threading.Lock()
 
-@app.route('/api/hosts', methods=['POST'])
-def update_hosts():
-    """Update the hosts file with new content."""
-    try:
-        from flask import request
+    def observe(self, stage, seconds):
+        slot = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][slot] += 1
+            histogram[1] += seconds
+
+    def since(self, stage, started):
+        """Records the time from `started` (a time.perf_counter() value) until now."""
+        self.observe(stage, time.perf_counter() - started)
 
-        hosts_data = request.json.get('hosts', [])
+    def histograms(self):
+        """Returns {stage: (bucket counts, sum)} copied under the lock, including adopted ones."""
+        with self._lock:
+            local = {stage: (list(counts), total) for stage, (counts, total) in self._stages.items()}
+        return {**self._adopted, **local}
 
-        # Validate the data
-        for host in hosts_data:
-            if 'ip' not in host or 'hostname' not in host:
-                return jsonify({"error": "Each host must have both IP and hostname"}), 400
+    def adopt(self, histograms, prefix='collector_'):
+        """Replaces the histograms reported by another process, named with `prefix`."""
+        self._adopted = {prefix + stage: (counts, total) for stage, (counts, total) in histograms.items()}
 
-        # Format hosts data into file content
-        content = ""
-        for host in hosts_data:
-            content += f"{host['ip']} {host['hostname']}\n"
+    def summary(self):
+        """Returns the /api/debug/timings body: per-stage counts, sums and estimated percentiles."""
+        stages = {}
+        for stage, (counts, total) in sorted(self.histograms().items()):
+            count = sum(counts)
+            stages[stage] = {
+                "count": count,
+                "sum_seconds": round(total, 6),
+                "mean_ms": round(total / count * 1000, 3) if count else None,
+                **{f"p{quantile}_ms": self._percentile(counts, count, quantile) for quantile in (50, 90, 99)},
+                "buckets": counts,
+            }
+        return {"bucket_bounds_seconds": list(self.buckets) + ["+Inf"], "stages": stages}
 
-        # Create directory if it doesn't exist
-        os.makedirs(os.path.dirname(HOSTS_FILE_PATH), exist_ok=True)
+    def _percentile(self, counts, count, quantile):
+        """Interpolates a percentile in ms within its bucket, as latency_percentiles() does for kresd's."""
+        if not count:
+            return None
+        target = count * quantile / 100
+        cumulative = 0
+        for slot, bucket_count in enumerate(counts):
+            if bucket_count and cumulative + bucket_count >= target:
+                lower = self.buckets[slot - 1] if slot > 0 else 0.0
+                if slot == len(self.buckets):
+                    return round(lower * 1000, 3) # Open-ended bucket: report its lower bound
+                upper = self.buckets[slot]
+                return round((lower + (upper - lower) * (target - cumulative) / bucket_count) * 1000, 3)
+            cumulative += bucket_count
 
-        # Write the content to the file
-        with open(HOSTS_FILE_PATH, 'w') as file:
-            file.write(content)
 
-        # Reload Knot Resolver to apply changes
-        try:
-            subprocess.run(['/usr/bin/sudo', '/usr/bin/systemctl', 'reload', 'knot-resolver'], check=True)
-            reload_success = True
-        except (subprocess.SubprocessError, FileNotFoundError) as e:
-            app.logger.warning(f"Failed to reload Knot Resolver: {e}")
-            reload_success = False
-
-        return jsonify({
-            "success": True,
-            "message": "Hosts file updated successfully" +
-                       ("" if reload_success else " but failed to reload Knot Resolver")
-        }), 200
+timings = StageTimings()
 
-    except Exception as e:
-        app.logger.error(f"Error updating hosts file: {e}", exc_info=True)
-        return jsonify({"error": f"Failed to update hosts file: {str(e)}"}), 500
+# --- Counter Schema ---
+
+NAN = float('nan')
+_NAN_ROW = array.array('d', [NAN])
+_MISSING = object()
+
+
+def json_number(value):
+    """Converts a stored double for JSON output: NaN becomes None and whole numbers become ints."""
+    if value != value:
+        return None
+    return int(value) if value.is_integer() else value
+
+
+# One successful scrape: instances maps instance id -> (row, extras), where row
+# holds the numeric stats as doubles laid out by the CounterSchema (NaN where an
+# instance lacks a column) and extras holds any non-numeric values, or None.
+# rates has the same shape, holding per-second rates of the counter columns;
+# latency maps instance id -> answers per latency bucket over the last LATENCY_WINDOW;
+# target_errors maps the name of each resolver that failed this scrape to its error;
+# body is the upstream response bytes when they are the per-instance tree as is, else None
+Snapshot = collections.namedtuple('Snapshot', 'seq timestamp instances rates latency target_errors body')
+
+
+class CounterSchema:
+    """Interns flattened section.key stat names to column indexes.
+
+    The schema is learned from the first scrape and only grows when kresd
+    reports a key it has not seen before. Columns are never reordered or
+    removed, so a row packed under an older schema stays valid: columns past
+    its end are simply absent. Only the thread packing scrapes adds columns;
+    the derived ratios have theirs from the start, so readers never do.
+    """
+
+    def __init__(self):
+        self.columns = [] # column index -> (section, key)
+        self.index = {} # section -> {key: column index}
+        self.summable = [] # column index -> whether the column may be summed across instances
+        self.counters = [] # column index -> whether the column is a monotonic counter (rates apply)
+        self._lock = threading.Lock()
+        for section, key, _, _ in DERIVED_RATIOS:
+            self.column(section, key)
+
+    def column(self, section, key):
+        """Returns the column index for section.key, adding the column if it is new."""
+        keys = self.index.get(section)
+        if keys is not None and key in keys:
+            return keys[key]
+        with self._lock:
+            keys = self.index.setdefault(section, {})
+            if key not in keys:
+                # Per-instance ratios can't be summed; derived ones are recomputed from the sums
+                is_ratio = any(marker in key for marker in RATIO_KEY_MARKERS)
+                is_gauge = any(marker in f"{section}.{key}" for marker in GAUGE_KEY_MARKERS)
+                # Flags first, index last: whoever can see the column can look up its flags
+                self.summable.append(not is_ratio)
+                self.counters.append(not is_ratio and not is_gauge)
+                self.columns.append((section, key))
+                keys[key] = len(self.columns) - 1
+            return keys[key]
+
+    def lookup(self, section, key):
+        """Returns the column index for section.key, or None if it has never been seen."""
+        return self.index.get(section, {}).get(key)
+
+    def pack(self, instance_data):
+        """Packs one instance's {section: {key: value}} into (row, extras)."""
+        row = _NAN_ROW * len(self.columns)
+        extras = None
+        for section, values in instance_data.items():
+            if not isinstance(values, dict):
+                extras = extras or {}
+                extras[(section, None)] = values
+                continue
+            keys = self.index.get(section, {})
+            for key, value in values.items():
+                if value.__class__ is not int and value.__class__ is not float: # Excludes bool
+                    extras = extras or {}
+                    extras[(section, key)] = value
+                    continue
+                col = keys.get(key)
+                if col is None:
+                    col = self.column(section, key)
+                    keys = self.index[section]
+                if col >= len(row):
+                    row.extend(_NAN_ROW * (col + 1 - len(row)))
+                row[col] = value
+        return row, extras
+
+    def unpack(self, row, extras=None):
+        """Rebuilds {section: {key: value}} from a packed row and its extras."""
+        columns = self.columns
+        data = {}
+        for col, value in enumerate(row):
+            if value != value: # NaN: the instance doesn't report this column
+                continue
+            section, key = columns[col]
+            values = data.get(section)
+            if values is None:
+                values = data[section] = {}
+            values[key] = json_number(value)
+        if extras:
+            for (section, key), value in extras.items():
+                if key is None:
+                    data[section] = value
+                else:
+                    data.setdefault(section, {})[key] = value
+        return data
+
+    def aggregate(self, rows):
+        """Sums packed rows column by column and computes derived ratios from the sums."""
+        total = _NAN_ROW * max((len(row) for row in rows), default=0)
+        summable = self.summable
+        for row in rows:
+            for col, value in enumerate(row):
+                if value == value and summable[col]:
+                    current = total[col]
+                    total[col] = value if current != current else current + value
+
+        for section, key, numerator, denominator in DERIVED_RATIOS:
+            num_col = self.lookup(section, numerator)
+            den_col = self.lookup(section, denominator)
+            if num_col is None or den_col is None or num_col >= len(total) or den_col >= len(total):
+                continue
+            num, den = total[num_col], total[den_col]
+            if num != num or den != den:
+                continue
+            col = self.lookup(section, key) # Registered when the schema was created
+            if col >= len(total):
+                total.extend(_NAN_ROW * (col + 1 - len(total)))
+            total[col] = num / den * 100 if den > 0 else 0
+        return total
+
+    def diff(self, old, new):
+        """Returns {section: {key: value}} for the columns that differ between two (row, extras) pairs.
+
+        Values that disappeared map to None.
+        """
+        (old_row, old_extras), (new_row, new_extras) = old, new
+        columns = self.columns
+        changes = {}
+        old_len = len(old_row)
+        new_len = len(new_row)
+        for col in range(max(old_len, new_len)):
+            before = old_row[col] if col < old_len else NAN
+            after = new_row[col] if col < new_len else NAN
+            if before == after or (before != before and after != after):
+                continue
+            section, key = columns[col]
+            changes.setdefault(section, {})[key] = json_number(after)
+
+        if old_extras != new_extras:
+            old_extras = old_extras or {}
+            new_extras = new_extras or {}
+            for (section, key), value in new_extras.items():
+                if old_extras.get((section, key), _MISSING) != value:
+                    if key is None:
+                        changes[section] = value
+                    else:
+                        changes.setdefault(section, {})[key] = value
+            for section, key in old_extras.keys() - new_extras.keys():
+                if key is None:
+                    changes[section] = None
+                else:
+                    changes.setdefault(section, {})[key] = None
+        return changes
+
+
+# --- Stats Views ---
+
+GROUP_BY_CHOICES = ('all', 'host', 'worker')
+ALL_GROUP = 'All'
+RATIO_KEY_MARKERS = ('percent', 'ratio') # Keys holding ratios rather than counts
+GAUGE_KEY_MARKERS = ('rss', 'concurrent', 'memory', 'usage', # Stats that go up and down rather than count
+                     'predict.queue', 'predict.learned', 'predict.epoch')
+RESET_KEYS = [('answer', 'total'), ('worker', 'queries')] # Counters that only go back when kresd restarts
+# (section, derived key, numerator key, denominator key) computed from aggregated sums
+DERIVED_RATIOS = [
+    ('cache', 'hit_percent_calculated', 'hit', 'lookup'),
+    ('answer', 'cached_percent_calculated', 'cached', 'total'),
+]
+
+
+def split_instance_id(instance_id):
+    """Splits an instance id into (host, worker).
+
+    Ids namespaced as "host/worker" are split on the first slash; bare ids
+    come from the only configured target.
+    """
+    host, sep, worker = instance_id.partition('/')
+    if sep:
+        return host, worker
+    return stats_poller.targets[0].name, instance_id
+
+
+def group_of(instance_id, group_by):
+    """Returns the group an instance belongs to for ?group_by=all|host|worker."""
+    if group_by == 'all':
+        return ALL_GROUP
+    host, worker = split_instance_id(instance_id)
+    return host if group_by == 'host' else worker
+
+
+def build_view(schema, instances, instance=None, group_by=None):
+    """Selects and groups a snapshot's instances into {group: (row, extras)}.
+
+    `instance` restricts the view to one instance; `group_by` aggregates the
+    selected instances into a single 'All' group or one group per host or
+    worker. With neither, the per-instance mapping is returned unchanged.
+    """
+    if instance is not None:
+        instances = {instance: instances[instance]} if instance in instances else {}
+    if group_by is None:
+        return instances
+
+    members = {}
+    for instance_id, (row, _) in instances.items():
+        members.setdefault(group_of(instance_id, group_by), []).append(row)
+    return {group: (schema.aggregate(rows), None) for group, rows in members.items()}
+
+
+def unpack_view(schema, view):
+    """Expands a view into the {group: {section: {key: value}}} JSON shape."""
+    return {group: schema.unpack(row, extras) for group, (row, extras) in view.items()}
+
+
+def diff_view(schema, old, new):
+    """Builds the delta body fields between two views."""
+    changed = {}
+    for group, packed in new.items():
+        if group not in old:
+            changed[group] = schema.unpack(*packed)
+            continue
+        group_changes = schema.diff(old[group], packed)
+        if group_changes:
+            changed[group] = group_changes
+    return {
+        "changed": changed,
+        "added": [group for group in new if group not in old],
+        "removed": [group for group in old if group not in new],
+    }
+
+
+def parse_view_args(args):
+    """Reads ?instance= and ?group_by= into a view key, raising ValueError for bad input."""
+    instance = args.get('instance') or None
+    group_by = args.get('group_by') or None
+    if group_by is not None and group_by not in GROUP_BY_CHOICES:
+        raise ValueError(f"group_by must be one of: {', '.join(GROUP_BY_CHOICES)}")
+    if instance is None and group_by is None:
+        return None
+    return instance, group_by
+
+def parse_since(token):
+    """Reads a ?since= or Last-Event-ID token into (epoch, seq), raising ValueError for bad input.
+
+    Tokens are "<epoch>-<seq>" as handed out in "seq", or "0" for a client
+    holding no snapshot yet, which is (None, 0).
+    """
+    if token == "0":
+        return None, 0
+    match = re.fullmatch(r'([0-9a-f]+)-([0-9]+)', token)
+    if match is None:
+        raise ValueError("since must be the \"seq\" of a /api/stats response, or 0")
+    return match[1], int(match[2])
+
+def since_token(epoch, seq):
+    """Formats (epoch, seq) as parse_since() reads it."""
+    return f"{epoch}-{seq}" if epoch is not None else str(seq)
+
+# --- Rates ---
+
+class RateEngine:
+    """Turns successive counter rows into per-second rate rows, instance by instance.
+
+    One of the RESET_KEYS going backwards means the instance restarted (for
+    example when the hosts editor reloads knot-resolver); all of that
+    instance's counters are then treated as having restarted from zero. Any
+    other counter going backwards on its own gets no rate for that sample,
+    so rates never go negative or spike. Instances get rates from their
+    second sample onwards and are forgotten once they stop reporting.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self._previous = {} # instance id -> (timestamp, row) of its last sample
+
+    def update(self, timestamp, instances):
+        """Returns {instance id: (rate row, None)} for one snapshot's {instance id: (row, extras)}."""
+        counters = self.schema.counters
+        reset_columns = [col for col in (self.schema.lookup(*key) for key in RESET_KEYS) if col is not None]
+        rates = {}
+        for instance_id, (row, _) in instances.items():
+            rate_row = _NAN_ROW * len(row)
+            previous = self._previous.get(instance_id)
+            self._previous[instance_id] = (timestamp, row)
+            if previous is not None and timestamp > previous[0]:
+                previous_timestamp, previous_row = previous
+                elapsed = timestamp - previous_timestamp
+                width = min(len(row), len(previous_row))
+                reset = any(row[col] < previous_row[col] for col in reset_columns if col < width)
+                for col in range(width):
+                    if counters[col]:
+                        current, before = row[col], previous_row[col]
+                        if current == current and before == before and (reset or current >= before):
+                            rate_row[col] = round((current if reset else current - before) / elapsed, 3)
+            rates[instance_id] = (rate_row, None)
+
+        for instance_id in [i for i in self._previous if i not in instances]:
+            del self._previous[instance_id]
+        return rates
+
+
+def counter_rates(timestamps, values, counters, resets=()):
+    """Converts per-column counter samples into per-second rates.
+
+    `values` holds one list of samples per column and `counters` flags the
+    columns that are counters; other columns come back as NaN. `resets`
+    holds the samples of the RESET_KEYS: as in RateEngine, a drop in one of
+    them marks a restart from zero, and any other counter dropping on its
+    own gets no rate for that sample.
+    """
+    rates = [[NAN] * len(timestamps) for _ in values]
+    for i in range(1, len(timestamps)):
+        elapsed = timestamps[i] - timestamps[i - 1]
+        if elapsed <= 0:
+            continue
+        reset = any(column[i] < column[i - 1] for column in resets)
+        for col, column in enumerate(values):
+            current, before = column[i], column[i - 1]
+            if counters[col] and current == current and before == before and (reset or current >= before):
+                rates[col][i] = round((current if reset else current - before) / elapsed, 3)
+    return rates
+
+# --- History ---
+
+class HistoryRing:
+    """Fixed-size in-memory history of every counter of every instance.
+
+    Each (instance, column) pair gets a preallocated array of `capacity`
+    doubles used as a ring buffer, all sharing one ring of timestamps, so
+    memory stays bounded by instances x columns x capacity however long the
+    dashboard runs. Instances that stop reporting are dropped once their
+    last sample has aged out.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._timestamps = _NAN_ROW * capacity
+        self._series = {} # instance id -> list of per-column rings
+        self._last_seen = {} # instance id -> append count when it last reported
+        self._count = 0 # Total appends so far; the next slot is _count % capacity
+        self._lock = threading.Lock()
+
+    def append(self, timestamp, instances):
+        """Records one snapshot's {instance id: (row, extras)} at `timestamp`."""
+        with self._lock:
+            slot = self._count % self.capacity
+            self._timestamps[slot] = timestamp
+            for instance_id, (row, _) in instances.items():
+                rings = self._series.setdefault(instance_id, [])
+                while len(rings) < len(row):
+                    rings.append(_NAN_ROW * self.capacity)
+                for col, value in enumerate(row):
+                    rings[col][slot] = value
+                for col in range(len(row), len(rings)):
+                    rings[col][slot] = NAN
+                self._last_seen[instance_id] = self._count
+
+            for instance_id in [i for i in self._series if i not in instances]:
+                if self._count - self._last_seen[instance_id] >= self.capacity:
+                    del self._series[instance_id]
+                    del self._last_seen[instance_id]
+                else:
+                    for ring in self._series[instance_id]:
+                        ring[slot] = NAN
+            self._count += 1
+
+    def query(self, columns, start):
+        """Returns (timestamps, {instance id: [values per column]}) for samples taken at or after `start`.
+
+        `columns` may contain None for metrics the schema doesn't know; those
+        come back as all-NaN series.
+        """
+        with self._lock:
+            first = max(0, self._count - self.capacity)
+            slots = [i % self.capacity for i in range(first, self._count)]
+            slots = [slot for slot in slots if self._timestamps[slot] >= start]
+            timestamps = [self._timestamps[slot] for slot in slots]
+            missing = [NAN] * len(slots)
+            series = {}
+            for instance_id, rings in self._series.items():
+                series[instance_id] = [
+                    [rings[col][slot] for slot in slots] if col is not None and col < len(rings) else missing
+                    for col in columns
+                ]
+        return timestamps, series
+
+
+def history_view(schema, query, resolution, metrics, window, instance=None, group_by=None, rate=False):
+    """Builds the /api/history body for section.key `metrics` over the last `window` seconds.
+
+    `query` is the query() of a HistoryRing or SeriesStore tier holding
+    samples `resolution` seconds apart. With `rate`, counters are returned as
+    per-second rates instead of raw values. Groups are formed as in
+    build_view(); grouped series are summed per sample, ignoring instances
+    that had no value at that time.
+    """
+    columns = [schema.lookup(*metric.split('.', 1)) if '.' in metric else None for metric in metrics]
+    # Rates also need the counters that tell a restart apart, fetched after the metrics
+    reset_columns = [col for col in (schema.lookup(*key) for key in RESET_KEYS) if col is not None] if rate else []
+    timestamps, series = query(columns + reset_columns, time.time() - window)
+    if instance is not None:
+        series = {instance: series[instance]} if instance in series else {}
+    if rate:
+        counters = [col is not None and schema.counters[col] for col in columns]
+        series = {instance_id: counter_rates(timestamps, values[:len(columns)], counters, values[len(columns):])
+                  for instance_id, values in series.items()}
+
+    if group_by is not None:
+        # Columns that can't be summed (ratios) stay NaN in aggregated series
+        summable = [col is not None and schema.summable[col] for col in columns]
+        grouped = {}
+        for instance_id, values in series.items():
+            group = group_of(instance_id, group_by)
+            if group not in grouped:
+                grouped[group] = [list(column_values) if summable[col] else [NAN] * len(timestamps)
+                                  for col, column_values in enumerate(values)]
+                continue
+            for col, column_values in enumerate(values):
+                if not summable[col]:
+                    continue
+                totals = grouped[group][col]
+                for i, value in enumerate(column_values):
+                    if value == value:
+                        totals[i] = value if totals[i] != totals[i] else totals[i] + value
+        series = grouped
+
+    return {
+        "interval": resolution,
+        "timestamps": timestamps,
+        "series": {
+            group: {metric: [json_number(value) for value in values] for metric, values in zip(metrics, group_values)}
+            for group, group_values in series.items()
+        },
+    }
+
+# --- Latency ---
+
+# kresd's answer.* latency buckets as (key, lower bound ms, upper bound ms); 'slow' is open-ended
+LATENCY_BUCKETS = [
+    ('1ms', 0, 1), ('10ms', 1, 10), ('50ms', 10, 50), ('100ms', 50, 100), ('250ms', 100, 250),
+    ('500ms', 250, 500), ('1000ms', 500, 1000), ('1500ms', 1000, 1500), ('slow', 1500, None),
+]
+
+
+def latency_columns(schema):
+    """Returns the schema column of each latency bucket, None for buckets never reported."""
+    return [schema.lookup('answer', key) for key, _, _ in LATENCY_BUCKETS]
+
+
+def bucket_counts(row, columns):
+    """Reads the latency bucket counters out of a packed row; NaN for absent buckets."""
+    return [row[col] if col is not None and col < len(row) else NAN for col in columns]
+
+
+def bucket_deltas(current, base):
+    """Answers per bucket between two samples of the bucket counters, or None if they can't be compared.
+
+    As in RateEngine, a bucket going backwards means the instance restarted
+    and the current counts are taken as the answers since then.
+    """
+    present = [(now, before) for now, before in zip(current, base) if now == now and before == before]
+    if not present:
+        return None
+    if any(now < before for now, before in present):
+        return [now if now == now else 0.0 for now in current]
+    return [now - before if now == now and before == before else 0.0 for now, before in zip(current, base)]
+
+
+def latency_percentiles(counts, quantiles=LATENCY_QUANTILES):
+    """Estimates latency percentiles in ms from answers per bucket.
+
+    Values are interpolated linearly within the bucket the percentile falls
+    in; percentiles landing in the open-ended 'slow' bucket report its lower
+    bound. Returns {"p50": ms, ...} plus the number of answers and the
+    answers per bucket, with None percentiles when there were no answers.
+    """
+    total = sum(counts) if counts is not None else 0
+    result = {
+        "answers": json_number(float(total)),
+        "buckets": {key: json_number(float(count)) for (key, _, _), count in zip(LATENCY_BUCKETS, counts or [])},
+    }
+    for quantile in quantiles:
+        name = f"p{quantile}"
+        if total <= 0:
+            result[name] = None
+            continue
+        target = total * quantile / 100
+        cumulative = 0.0
+        for count, (_, lower, upper) in zip(counts, LATENCY_BUCKETS):
+            if count > 0 and cumulative + count >= target:
+                value = lower if upper is None else lower + (upper - lower) * (target - cumulative) / count
+                break
+            cumulative += count
+        result[name] = round(value, 2)
+    return result
+
+
+def sum_counts(counts_list):
+    """Adds up answers per bucket across instances, skipping those without counts."""
+    present = [counts for counts in counts_list if counts is not None]
+    if not present:
+        return None
+    return [sum(values) for values in zip(*present)]
+
+
+class LatencyEngine:
+    """Keeps each instance's answers per latency bucket over a sliding window.
+
+    Like RateEngine it works instance by instance from successive snapshots,
+    but compares each sample against the one taken `window` seconds earlier,
+    so the distribution reflects recent answers rather than everything since
+    kresd started.
+    """
+
+    def __init__(self, schema, window=LATENCY_WINDOW):
+        self.schema = schema
+        self.window = window
+        self._samples = {} # instance id -> deque of (timestamp, bucket counters) within the window
+
+    def update(self, timestamp, instances):
+        """Returns {instance id: answers per bucket or None} for one snapshot's {instance id: (row, extras)}."""
+        columns = latency_columns(self.schema)
+        latency = {}
+        for instance_id, (row, _) in instances.items():
+            current = bucket_counts(row, columns)
+            samples = self._samples.setdefault(instance_id, collections.deque())
+            if samples and any(now < before for now, before in zip(current, samples[-1][1])):
+                # Restarted: count from zero as of the previous sample
+                samples.clear()
+                samples.append((timestamp, [0.0] * len(current)))
+            samples.append((timestamp, current))
+            while len(samples) > 2 and samples[1][0] <= timestamp - self.window:
+                samples.popleft()
+            latency[instance_id] = bucket_deltas(current, samples[0][1]) if len(samples) > 1 else None
+
+        for instance_id in [i for i in self._samples if i not in instances]:
+            del self._samples[instance_id]
+        return latency
+
+
+def latency_view(latency, instance=None, group_by=None):
+    """Groups per-instance answers per bucket as build_view() does and estimates percentiles per group."""
+    if instance is not None:
+        latency = {instance: latency[instance]} if instance in latency else {}
+    if group_by is None:
+        return {instance_id: latency_percentiles(counts) for instance_id, counts in latency.items()}
+    members = {}
+    for instance_id, counts in latency.items():
+        members.setdefault(group_of(instance_id, group_by), []).append(counts)
+    return {group: latency_percentiles(sum_counts(counts_list)) for group, counts_list in members.items()}
+
+
+def latency_history(schema, query, resolution, window, span=LATENCY_WINDOW, instance=None, group_by=None):
+    """Builds the /api/latency body: percentile series over the last `window` seconds.
+
+    Each point covers the answers of the `span` seconds before it (at least
+    one sample interval), computed from the same history sources as
+    /api/history. Groups are formed as in build_view().
+    """
+    span = max(span, resolution)
+    start = time.time() - window
+    timestamps, series = query(latency_columns(schema), start - span)
+    if instance is not None:
+        series = {instance: series[instance]} if instance in series else {}
+    first = next((i for i, timestamp in enumerate(timestamps) if timestamp >= start), len(timestamps))
+
+    windowed = {}
+    for instance_id, values in series.items():
+        samples = [list(bucket) for bucket in zip(*values)]
+        counts, base = [], 0
+        for i in range(first, len(timestamps)):
+            while base < i - 1 and timestamps[base + 1] <= timestamps[i] - span:
+                base += 1
+            counts.append(bucket_deltas(samples[i], samples[base]) if base < i else None)
+        group = group_of(instance_id, group_by) if group_by is not None else instance_id
+        windowed.setdefault(group, []).append(counts)
+
+    result = {}
+    for group, members in windowed.items():
+        points = [latency_percentiles(sum_counts(point)) for point in zip(*members)]
+        result[group] = {f"p{quantile}": [point[f"p{quantile}"] for point in points] for quantile in LATENCY_QUANTILES}
+    return {"interval": resolution, "span": span, "timestamps": timestamps[first:], "series": result}
+
+# --- Persistent Store ---
+
+class Segment:
+    """A fixed-width, memory-mapped file of (timestamp, value...) records for one instance and tier.
+
+    The header records the tier resolution, the record width and the
+    section.key name of every column, so segments stay readable after the
+    in-memory schema has grown. The file is preallocated (sparsely) to hold
+    `capacity` records; appends are plain writes into the mapping and the
+    kernel is only asked to write dirty pages back on flush().
+    """
+
+    HEADER = struct.Struct('<4sIdIIII') # magic, version, resolution, width, capacity, header size, metadata length
+    COUNT = struct.Struct('<Q')
+    COUNT_OFFSET = 32
+    META_OFFSET = 64
+    MAGIC = b'KSTS'
+    VERSION = 1
+
+    def __init__(self, path, names, capacity, header_size, count=0, mm=None):
+        self.path = path
+        self.names = names
+        self.width = len(names)
+        self.capacity = capacity
+        self.header_size = header_size
+        self.count = count
+        self._mm = mm
+        self._record_size = (self.width + 1) * 8
+        self._dirty = False
+
+    @classmethod
+    def create(cls, path, resolution, names, capacity):
+        """Creates a new, empty segment file and maps it for appending."""
+        meta = json.dumps({"columns": names}).encode()
+        header_size = (cls.META_OFFSET + len(meta) + 4095) // 4096 * 4096
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w+b') as file:
+            file.truncate(header_size + capacity * (len(names) + 1) * 8)
+            mm = mmap.mmap(file.fileno(), 0)
+        cls.HEADER.pack_into(mm, 0, cls.MAGIC, cls.VERSION, resolution, len(names), capacity, header_size, len(meta))
+        cls.COUNT.pack_into(mm, cls.COUNT_OFFSET, 0)
+        mm[cls.META_OFFSET:cls.META_OFFSET + len(meta)] = meta
+        return cls(path, names, capacity, header_size, mm=mm)
+
+    @classmethod
+    def read(cls, path):
+        """Reads a segment from disk, returning (column names, timestamps, rows) of its records."""
+        with open(path, 'rb') as file:
+            data = file.read()
+        magic, version, _, width, _, header_size, meta_len = cls.HEADER.unpack_from(data, 0)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError(f"{path} is not a stats segment")
+        (count,) = cls.COUNT.unpack_from(data, cls.COUNT_OFFSET)
+        names = json.loads(data[cls.META_OFFSET:cls.META_OFFSET + meta_len])["columns"]
+        values = array.array('d')
+        values.frombytes(data[header_size:header_size + count * (width + 1) * 8])
+        stride = width + 1
+        timestamps = values[::stride]
+        rows = [values[i + 1:i + stride] for i in range(0, len(values), stride)]
+        return names, timestamps, rows
+
+    def append(self, timestamp, row):
+        """Appends a record, returning False if the segment is full or the row is too wide for it."""
+        if self.count >= self.capacity or len(row) > self.width:
+            return False
+        record = array.array('d', [timestamp])
+        record.extend(row)
+        if len(row) < self.width:
+            record.extend(_NAN_ROW * (self.width - len(row)))
+        offset = self.header_size + self.count * self._record_size
+        self._mm[offset:offset + self._record_size] = record.tobytes()
+        self.count += 1
+        self.COUNT.pack_into(self._mm, self.COUNT_OFFSET, self.count) # Publish only after the record is in place
+        self._dirty = True
+        return True
+
+    def flush(self):
+        if self._dirty:
+            self._mm.flush()
+            self._dirty = False
+
+    def close(self):
+        self.flush()
+        self._mm.close()
+
+
+def segment_start(name):
+    """Returns the start timestamp encoded in a segment file name."""
+    return int(name[:-len('.seg')].split('-')[0])
+
+
+class SeriesStore:
+    """Append-only on-disk history of every instance's rows, with automatic rollups.
+
+    Each (resolution, retention, segment span) tier in STORE_TIERS keeps a directory of
+    segment files per instance. The finest tier receives every poll; coarser
+    tiers receive one record per bucket holding the last value of each
+    counter and the mean of each gauge. Segments are flushed in batches every
+    `flush_interval` seconds and deleted whole once they fall out of their
+    tier's retention. Only the local filesystem is needed.
+    """
+
+    def __init__(self, directory, schema, tiers=STORE_TIERS, flush_interval=STORE_FLUSH_INTERVAL):
+        self.directory = directory
+        self.schema = schema
+        self.tiers = tiers
+        self.flush_interval = flush_interval
+        self._segments = {} # (tier index, instance id) -> Segment open for appending
+        self._pending = {} # (tier index, instance id) -> [bucket, last row, gauge sums, sample count]
+        self._last_flush = time.monotonic()
+        self._last_sweep = 0
+        self._unreadable = set() # Segment paths already reported as unreadable
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, timestamp, instances):
+        """Records one snapshot's {instance id: (row, extras)} in every tier."""
+        for instance_id, (row, _) in instances.items():
+            self._write(0, instance_id, timestamp, row)
+            for tier in range(1, len(self.tiers)):
+                self._accumulate(tier, instance_id, timestamp, row)
+
+        # Close the buckets of instances that stopped reporting
+        for tier, instance_id in [key for key in self._pending if key[1] not in instances]:
+            bucket = timestamp // self.tiers[tier][0]
+            if self._pending[(tier, instance_id)][0] < bucket:
+                self._write_bucket(tier, instance_id, self._pending.pop((tier, instance_id)))
+
+        now = time.monotonic()
+        if now - self._last_flush >= self.flush_interval:
+            self.flush()
+        if now - self._last_sweep >= 60:
+            self._last_sweep = now
+            self._sweep(timestamp, instances)
+
+    def flush(self):
+        """Writes dirty pages of every open segment back to disk."""
+        for segment in self._segments.values():
+            segment.flush()
+        self._last_flush = time.monotonic()
+
+    def resolution_for(self, window):
+        """Returns the index and resolution of the finest tier that retains `window` seconds."""
+        for tier, (resolution, retention, _) in enumerate(self.tiers):
+            if retention >= window:
+                return tier, resolution
+        return len(self.tiers) - 1, self.tiers[-1][0]
+
+    def max_window(self):
+        return self.tiers[-1][1]
+
+    def query(self, columns, start, tier=0):
+        """Returns (timestamps, {instance id: [values per column]}) for records at or after `start`.
+
+        `columns` are indexes into the schema (or None), matched to each
+        segment's own columns by name. Instances missing a record at some
+        timestamp get NaN there.
+        """
+        wanted = ['.'.join(self.schema.columns[col]) if col is not None else None for col in columns]
+        samples = {} # instance id -> {timestamp: [values per column]}
+        for instance_id, path in self._segment_paths(tier, start):
+            segment = self._read(path)
+            if segment is None:
+                continue
+            segment_names, timestamps, rows = segment
+            positions = {name: i for i, name in enumerate(segment_names)}
+            lookup = [positions.get(name) if name is not None else None for name in wanted]
+            instance_samples = samples.setdefault(instance_id, {})
+            for timestamp, row in zip(timestamps, rows):
+                if timestamp >= start:
+                    instance_samples[timestamp] = [row[pos] if pos is not None else NAN for pos in lookup]
+
+        timestamps = sorted({timestamp for instance_samples in samples.values() for timestamp in instance_samples})
+        missing = [NAN] * len(columns)
+        series = {}
+        for instance_id, instance_samples in samples.items():
+            records = [instance_samples.get(timestamp, missing) for timestamp in timestamps]
+            series[instance_id] = [[record[col] for record in records] for col in range(len(columns))]
+        return timestamps, series
+
+    def load_recent(self, window):
+        """Yields (timestamp, {instance id: (row, None)}) from the finest tier for the last `window` seconds.
+
+        Columns are mapped onto the schema, teaching it any names it hasn't
+        seen yet, so history can be restored before the first scrape.
+        """
+        start = time.time() - window
+        by_timestamp = {}
+        for instance_id, path in self._segment_paths(0, start):
+            segment = self._read(path)
+            if segment is None:
+                continue
+            names, timestamps, rows = segment
+            columns = [self.schema.column(*name.split('.', 1)) for name in names]
+            for timestamp, row in zip(timestamps, rows):
+                if timestamp < start:
+                    continue
+                packed = _NAN_ROW * (max(columns, default=-1) + 1)
+                for col, value in zip(columns, row):
+                    packed[col] = value
+                by_timestamp.setdefault(timestamp, {})[instance_id] = (packed, None)
+        for timestamp in sorted(by_timestamp):
+            yield timestamp, by_timestamp[timestamp]
+
+    def close(self):
+        for segment in self._segments.values():
+            segment.close()
+        self._segments = {}
+
+    def _read(self, path):
+        """Returns Segment.read(path), or None for a segment that is gone or unreadable, e.g. cut short by a crash."""
+        try:
+            return Segment.read(path)
+        except FileNotFoundError:
+            return None # Removed by a retention sweep since it was listed
+        except (OSError, ValueError, struct.error) as e:
+            if path not in self._unreadable:
+                self._unreadable.add(path)
+                app.logger.warning(f"Skipping unreadable history segment {path}: {e}")
+            return None
+
+    def _tier_directory(self, tier):
+        return os.path.join(self.directory, f"{self.tiers[tier][0]}s")
+
+    def _segment_paths(self, tier, start):
+        """Yields (instance id, path) of the tier's segments that may hold records at or after `start`."""
+        resolution = self.tiers[tier][0]
+        capacity = self._capacity(tier)
+        tier_directory = self._tier_directory(tier)
+        try:
+            instances = os.listdir(tier_directory)
+        except FileNotFoundError:
+            return
+        for quoted in instances:
+            instance_directory = os.path.join(tier_directory, quoted)
+            try:
+                names = sorted(os.listdir(instance_directory))
+            except (FileNotFoundError, NotADirectoryError):
+                continue # Removed by a retention sweep since the tier was listed
+            for name in names:
+                if not name.endswith('.seg'):
+                    continue
+                if segment_start(name) + capacity * resolution >= start:
+                    yield urllib.parse.unquote(quoted), os.path.join(instance_directory, name)
+
+    def _capacity(self, tier):
+        resolution, _, span = self.tiers[tier]
+        return max(1, int(span / resolution))
+
+    def _write(self, tier, instance_id, timestamp, row):
+        key = (tier, instance_id)
+        segment = self._segments.get(key)
+        if segment is None or not segment.append(timestamp, row):
+            if segment is not None:
+                segment.close()
+            names = [f"{section}.{column_key}" for section, column_key in self.schema.columns[:len(row)]]
+            path = os.path.join(self._tier_directory(tier), urllib.parse.quote(instance_id, safe=''), f"{int(timestamp)}.seg")
+            if os.path.exists(path): # Restarted within the same second; never overwrite records
+                path = path[:-4] + f"-{os.getpid()}.seg"
+            segment = self._segments[key] = Segment.create(path, self.tiers[tier][0], names, self._capacity(tier))
+            segment.append(timestamp, row)
+
+    def _accumulate(self, tier, instance_id, timestamp, row):
+        key = (tier, instance_id)
+        bucket = timestamp // self.tiers[tier][0]
+        pending = self._pending.get(key)
+        if pending is not None and pending[0] != bucket:
+            self._write_bucket(tier, instance_id, pending)
+            pending = None
+        if pending is None:
+            pending = self._pending[key] = [bucket, row, array.array('d', bytes(8 * len(row))), 0]
+        pending[1] = row
+        sums = pending[2]
+        if len(sums) < len(row):
+            sums.extend(array.array('d', bytes(8 * (len(row) - len(sums)))))
+        counters = self.schema.counters
+        for col, value in enumerate(row):
+            if not counters[col]:
+                sums[col] += value
+        pending[3] += 1
+
+    def _write_bucket(self, tier, instance_id, pending):
+        bucket, last, sums, count = pending
+        row = array.array('d', last)
+        counters = self.schema.counters
+        for col in range(len(row)):
+            if not counters[col]:
+                row[col] = sums[col] / count
+        self._write(tier, instance_id, bucket * self.tiers[tier][0], row)
+
+    def _sweep(self, timestamp, instances):
+        """Deletes segments past their tier's retention and closes those of vanished instances."""
+        for key in [key for key in self._segments if key[1] not in instances]:
+            self._segments.pop(key).close()
+        open_paths = {segment.path for segment in self._segments.values()}
+        for tier, (resolution, retention, _) in enumerate(self.tiers):
+            tier_directory = self._tier_directory(tier)
+            if not os.path.isdir(tier_directory):
+                continue
+            span = self._capacity(tier) * resolution
+            for quoted in os.listdir(tier_directory):
+                instance_directory = os.path.join(tier_directory, quoted)
+                for name in os.listdir(instance_directory):
+                    path = os.path.join(instance_directory, name)
+                    if name.endswith('.seg') and path not in open_paths and segment_start(name) + span < timestamp - retention:
+                        os.remove(path)
+                if not os.listdir(instance_directory):
+                    os.rmdir(instance_directory)
+
+# --- Prometheus Exposition ---
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Derived per-instance gauges as (name, help, numerator, denominator), each a section.key pair
+DERIVED_GAUGES = [
+    ('cache_hit_ratio', 'Cache hits per cache lookup since kresd started.', ('cache', 'hit'), ('cache', 'lookup')),
+    ('answer_cached_ratio', 'Answers served from cache per answer since kresd started.', ('answer', 'cached'), ('answer', 'total')),
+]
+_METRIC_NAME_INVALID = re.compile(r'[^a-zA-Z0-9_]')
+
+
+def metric_name(*parts):
+    """Joins name parts under METRICS_PREFIX, replacing characters Prometheus doesn't allow."""
+    return _METRIC_NAME_INVALID.sub('_', '_'.join((METRICS_PREFIX,) + parts))
+
+
+def metric_labels(**labels):
+    """Formats keyword arguments as a Prometheus label set."""
+    values = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, values)) + '}'
+
+
+def metric_value(value):
+    return repr(int(value)) if value.is_integer() else repr(value)
+
+
+def render_metrics(schema, snapshot, targets):
+    """Renders a snapshot in the Prometheus text exposition format.
+
+    Every numeric stat becomes one metric family, counter or gauge as the
+    schema classifies it, with one sample per instance labelled by host and
+    worker. Derived ratio gauges, the latency percentiles, the dashboard's
+    own stage timings and per-target scrape health follow. `snapshot` may be None after a failed scrape, in
+    which case only the health gauges are rendered.
+    """
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        if not samples:
+            return
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(f"{name}{labels} {value}" for labels, value in samples)
+
+    if snapshot is not None:
+        instance_labels = {instance_id: dict(zip(("host", "worker"), split_instance_id(instance_id)))
+                           for instance_id in snapshot.instances}
+        label_sets = {instance_id: metric_labels(**labels) for instance_id, labels in instance_labels.items()}
+
+        for col, (section, key) in enumerate(schema.columns):
+            samples = []
+            for instance_id, (row, _) in snapshot.instances.items():
+                if col < len(row) and row[col] == row[col]:
+                    samples.append((label_sets[instance_id], metric_value(row[col])))
+            family(metric_name(section, key), 'counter' if schema.counters[col] else 'gauge',
+                   f"kresd {section}.{key}.", samples)
+
+        for name, help_text, numerator, denominator in DERIVED_GAUGES:
+            num_col, den_col = schema.lookup(*numerator), schema.lookup(*denominator)
+            if num_col is None or den_col is None:
+                continue
+            samples = []
+            for instance_id, (row, _) in snapshot.instances.items():
+                if num_col < len(row) and den_col < len(row) and row[num_col] == row[num_col] and row[den_col] > 0:
+                    samples.append((label_sets[instance_id], metric_value(row[num_col] / row[den_col])))
+            family(metric_name(name), 'gauge', help_text, samples)
+
+        samples = []
+        for instance_id, counts in snapshot.latency.items():
+            percentiles = latency_percentiles(counts)
+            for quantile in LATENCY_QUANTILES:
+                value = percentiles[f"p{quantile}"]
+                if value is not None:
+                    labels = metric_labels(**instance_labels[instance_id], quantile=quantile / 100)
+                    samples.append((labels, metric_value(round(value / 1000, 6))))
+        family(metric_name('answer_latency_seconds'), 'gauge',
+               f"Answer latency percentiles estimated from the answer buckets over the last {LATENCY_WINDOW}s.", samples)
+
+    histograms = timings.histograms()
+    if histograms:
+        name = metric_name('dashboard_stage_seconds')
+        lines.append(f"# HELP {name} Time the dashboard spends in each stage of scraping and serving stats.")
+        lines.append(f"# TYPE {name} histogram")
+        for stage, (counts, total) in sorted(histograms.items()):
+            cumulative = 0
+            for bound, count in zip(list(timings.buckets) + ['+Inf'], counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{metric_labels(stage=stage, le=bound)} {cumulative}")
+            labels = metric_labels(stage=stage)
+            lines.append(f"{name}_sum{labels} {metric_value(round(total, 6))}")
+            lines.append(f"{name}_count{labels} {cumulative}")
+
+    family(metric_name('target_up'), 'gauge', "Whether the last scrape of the resolver's webmgmt endpoint succeeded.",
+           [(metric_labels(target=target.name), '1' if target.healthy else '0') for target in targets])
+    family(metric_name('target_scrape_duration_seconds'), 'gauge', "Duration of the last scrape of the resolver.",
+           [(metric_labels(target=target.name), metric_value(target.last_duration))
+            for target in targets if target.last_duration is not None])
+    lines.append('')
+    return '\n'.join(lines)
+
+# --- JSON Codec ---
+
+if orjson is not None:
+    def json_dumps(value):
+        """Serializes `value` to compact JSON bytes."""
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+
+    json_loads = orjson.loads # Its JSONDecodeError subclasses json.JSONDecodeError
+else:
+    def json_dumps(value):
+        """Serializes `value` to compact JSON bytes."""
+        return json.dumps(value, separators=(',', ':')).encode()
+
+    json_loads = json.loads
+
+# --- Scrape Targets ---
+
+class ScrapeTarget:
+    """One resolver's webmgmt endpoint, scraped with its own timeout, and its health.
+
+    A circuit breaker keeps a failing resolver from being hit every poll:
+    after BREAKER_THRESHOLD consecutive failures it opens and the target is
+    skipped for an exponentially growing, jittered backoff, then a single
+    half-open probe decides whether to close it again or back off further.
+    """
+
+    def __init__(self, name, url, timeout=POLL_TIMEOUT):
+        self.name = name
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.pending = None # Future of a scrape still in flight
+        self.healthy = None # Unknown until the first scrape completes
+        self.last_error = None
+        self.last_success = None
+        self.last_duration = None
+        self.consecutive_failures = 0
+        self.breaker = 'closed' # 'closed', 'open' (skipped until retry_at) or 'half-open' (one probe allowed)
+        self.retry_at = None # Wall-clock time of the next probe while open
+        self._retry_at = None # The same on the monotonic clock
+        self._backoff = 0 # Current backoff in seconds; 0 while closed
+        self._logged = {} # message -> [monotonic time last logged, repeats suppressed since]
+
+    def ready(self):
+        """Returns whether a scrape may go out now, moving an open breaker to half-open once its backoff is over."""
+        if self.breaker == 'open' and time.monotonic() >= self._retry_at:
+            self.breaker = 'half-open'
+        return self.breaker != 'open'
+
+    def rejection(self):
+        """Returns the (payload, HTTP status, body) reported for a scrape skipped while the breaker is open."""
+        retry_in = max(0, self._retry_at - time.monotonic())
+        return {"error": f"Not scraping {self.url} for another {retry_in:.0f}s after "
+                         f"{self.consecutive_failures} failures; last error: {self.last_error}"}, 503, None
+
+    def fetch(self):
+        """Performs a single scrape, records the outcome and returns (payload, HTTP status, body).
+
+        `body` is the raw response the payload was decoded from, or None when
+        the scrape failed.
+        """
+        started = time.monotonic()
+        payload, status, body = self._fetch()
+        self.last_duration = time.monotonic() - started
+        self.healthy = status == 200
+        if self.healthy:
+            if self.breaker != 'closed':
+                self._log(logging.INFO, f"{self.url} is answering again after {self.consecutive_failures} failures")
+                self._logged.clear()
+            self.last_success = time.time()
+            self.last_error = None
+            self.consecutive_failures = 0
+            self.breaker = 'closed'
+            self.retry_at = self._retry_at = None
+            self._backoff = 0
+        else:
+            self.last_error = payload["error"]
+            self.consecutive_failures += 1
+            if self.breaker == 'half-open' or self.consecutive_failures >= BREAKER_THRESHOLD:
+                self._open()
+        return payload, status, body
+
+    def _open(self):
+        """Opens the breaker for the next backoff: doubled each time, with half of it jittered."""
+        self._backoff = min(BACKOFF_MAX, self._backoff * 2 or BACKOFF_INITIAL)
+        delay = self._backoff / 2 + random.uniform(0, self._backoff / 2) # Keeps workers and targets from probing in step
+        self.breaker = 'open'
+        self._retry_at = time.monotonic() + delay
+        self.retry_at = time.time() + delay
+        self._log(logging.WARNING, f"Backing off {self.url} for up to {self._backoff:.0f}s after {self.consecutive_failures} failures")
+
+    def _log(self, level, message, **kwargs):
+        """Logs `message` unless it was already logged within LOG_REPEAT_INTERVAL, counting the repeats left out."""
+        now = time.monotonic()
+        last = self._logged.get(message)
+        if last is not None and now - last[0] < LOG_REPEAT_INTERVAL:
+            last[1] += 1
+            return
+        self._logged[message] = [now, 0]
+        if last is not None and last[1]:
+            message = f"{message} (repeated {last[1]} times)"
+        app.logger.log(level, message, **kwargs)
+
+    def restore_health(self, health):
+        """Adopts health reported by the collector process, for workers that don't scrape themselves."""
+        for field in ('healthy', 'last_error', 'last_success', 'last_duration', 'consecutive_failures', 'breaker', 'retry_at'):
+            setattr(self, field, health[field])
+
+    def health(self):
+        return {
+            "name": self.name,
+            "url": self.url,
+            "timeout": self.timeout,
+            "healthy": self.healthy,
+            "last_error": self.last_error,
+            "last_success": self.last_success,
+            "last_duration": self.last_duration,
+            "consecutive_failures": self.consecutive_failures,
+            "breaker": self.breaker,
+            "retry_at": self.retry_at,
+        }
+
+    def _fetch(self):
+        try:
+            started = time.perf_counter()
+            response = self.session.get(self.url, timeout=self.timeout) # Short timeout for responsiveness
+            timings.since('upstream_request', started)
+            response.raise_for_status() # Raises HTTPError for bad responses (4xx or 5xx)
+            started = time.perf_counter()
+            body = response.content
+            stats_data = json_loads(body)
+            timings.since('json_decode', started)
+
+            # Basic validation: a dictionary of instances, each a dictionary of sections
+            if not isinstance(stats_data, dict) or not all(isinstance(data, dict) for data in stats_data.values()):
+                self._log(logging.WARNING, f"Received data not keyed by instance from {self.url}")
+                return {"error": "Received unexpected data format from Knot Resolver."}, 500, None
+
+            return stats_data, 200, body
+
+        except requests.exceptions.ConnectionError:
+            self._log(logging.ERROR, f"Connection refused to {self.url}")
+            return {"error": f"Connection refused. Is Knot Resolver webmgmt running at {self.url}?"}, 503, None # Service Unavailable
+        except requests.exceptions.Timeout:
+            self._log(logging.WARNING, f"Request timed out for {self.url}")
+            return {"error": "Request timed out fetching stats from Knot Resolver."}, 504, None # Gateway Timeout
+        except requests.exceptions.HTTPError as e:
+            self._log(logging.ERROR, f"HTTP error fetching stats: {e}")
+            return {"error": f"HTTP error {e.response.status_code} from Knot Resolver: {e.response.reason}"}, e.response.status_code if e.response.status_code >= 500 else 500, None
+        except requests.exceptions.RequestException as e:
+            self._log(logging.ERROR, f"General request error fetching stats: {e}")
+            return {"error": f"Failed to fetch stats: {str(e)}"}, 500, None # Internal Server Error
+        except json.JSONDecodeError:
+            self._log(logging.ERROR, f"Failed to decode JSON from {self.url}")
+            return {"error": "Failed to decode JSON response from Knot Resolver."}, 500, None # Internal Server Error
+        except Exception as e:
+            self._log(logging.ERROR, f"Unexpected error polling stats: {e}", exc_info=True) # Log traceback for unexpected errors
+            return {"error": "An unexpected server error occurred."}, 500, None # Internal Server Error
+
+
+def build_targets():
+    """Creates the ScrapeTargets from KNOT_RESOLVER_TARGETS, or KNOT_RESOLVER_STATS_URL alone.
+
+    Unnamed targets are named after their URL's host, or host:port where
+    several of them share a host. Raises ValueError if two targets still end
+    up with the same name, as their instance ids would overwrite each other.
+    """
+    configured = KNOT_RESOLVER_TARGETS or [{"url": KNOT_RESOLVER_STATS_URL}]
+    unnamed_hosts = collections.Counter(urllib.parse.urlsplit(target["url"]).hostname
+                                        for target in configured if not target.get("name"))
+    targets = []
+    for target in configured:
+        url = urllib.parse.urlsplit(target["url"])
+        name = target.get("name")
+        if not name:
+            name = url.hostname if unnamed_hosts[url.hostname] == 1 else url.netloc.rpartition('@')[2]
+        name = name or target["url"]
+        if any(other.name == name for other in targets):
+            raise ValueError(f"Two scrape targets are named {name!r}; give them distinct names in KNOT_RESOLVER_TARGETS")
+        targets.append(ScrapeTarget(name, target["url"], target.get("timeout", POLL_TIMEOUT)))
+    return targets
+
+# --- Response Encoding ---
+
+# Content-Encoding -> compression function, in order of preference
+COMPRESSORS = {'gzip': lambda data: gzip.compress(data, GZIP_LEVEL, mtime=0)}
+if zstandard is not None:
+    COMPRESSORS = {'zstd': lambda data: zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data), **COMPRESSORS}
+
+
+class EncodedBody:
+    """A serialized response body and its compressed encodings.
+
+    Each encoding is compressed the first time a client asks for it and
+    then shared by every client served from the same snapshot.
+    """
+
+    __slots__ = ('identity', 'compressible', '_encodings')
+
+    def __init__(self, identity, compressible=True):
+        self.identity = identity
+        self.compressible = compressible # False for already-compressed data such as fonts
+        self._encodings = {}
+
+    def encode(self, encoding):
+        """Returns the body in `encoding`: 'identity' or a COMPRESSORS key."""
+        if encoding == 'identity':
+            return self.identity
+        body = self._encodings.get(encoding)
+        if body is None:
+            started = time.perf_counter()
+            body = self._encodings.setdefault(encoding, COMPRESSORS[encoding](self.identity))
+            timings.since(f'compress_{encoding}', started)
+        return body
+
+
+def negotiate_encoding(body, accept_encodings):
+    """Picks the best encoding of an EncodedBody the client's Accept-Encoding allows."""
+    if not body.compressible or len(body.identity) < COMPRESS_MIN_SIZE:
+        return 'identity'
+    return accept_encodings.best_match(list(COMPRESSORS)) or 'identity'
+
+# --- Snapshot Channel ---
+
+class SnapshotChannel:
+    """Hands each scrape from the collector process to the HTTP workers through a shared mmap file.
+
+    The file holds a header page followed by the latest message. The single
+    writer guards every publish with a sequence lock: the generation count
+    is odd while the message is being replaced, and readers simply retry if
+    it was odd or changed while they copied the message out. Readers never
+    block the writer or each other, and the file only grows.
+    """
+
+    HEADER = struct.Struct('<4sIQQQ4s') # magic, version, generation, seq, message length, epoch
+    HEADER_SIZE = 4096
+    GENERATION_OFFSET = 8
+    MAGIC = b'KSCH'
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._mm = None
+        self._generation = 0
+
+    @classmethod
+    def create(cls, path, epoch, capacity=1 << 20):
+        """Creates (or resets) the channel file for the collector to publish into."""
+        channel = cls(path)
+        channel._file = open(path, 'w+b')
+        channel._file.truncate(cls.HEADER_SIZE + capacity)
+        channel._mm = mmap.mmap(channel._file.fileno(), 0)
+        cls.HEADER.pack_into(channel._mm, 0, cls.MAGIC, cls.VERSION, 0, 0, 0, bytes.fromhex(epoch))
+        return channel
+
+    def resume(self):
+        """Takes over publishing from an earlier writer of this channel; returns the last seq it published."""
+        if os.fstat(self._file.fileno()).st_size != len(self._mm):
+            self._mm.close() # That writer grew the file
+            self._mm = mmap.mmap(self._file.fileno(), 0)
+        generation, seq = struct.unpack_from('<QQ', self._mm, self.GENERATION_OFFSET)
+        # A writer that died mid-publish left the generation odd; the next publish moves on from there
+        self._generation = generation + generation % 2
+        return seq
+
+    def publish(self, seq, message):
+        """Replaces the published message with `message` (bytes) as scrape `seq`."""
+        if self.HEADER_SIZE + len(message) > len(self._mm):
+            size = self.HEADER_SIZE + max(len(message), 2 * (len(self._mm) - self.HEADER_SIZE))
+            self._mm.close()
+            self._file.truncate(size)
+            self._mm = mmap.mmap(self._file.fileno(), 0)
+        self._set_generation(self._generation + 1)
+        self._mm[self.HEADER_SIZE:self.HEADER_SIZE + len(message)] = message
+        struct.pack_into('<QQ', self._mm, self.GENERATION_OFFSET + 8, seq, len(message))
+        self._set_generation(self._generation + 1)
+
+    def seq(self):
+        """Returns the seq of the latest published message (0 before the first), without copying it."""
+        self._map()
+        return struct.unpack_from('<Q', self._mm, self.GENERATION_OFFSET + 8)[0]
+
+    def read(self, timeout=None):
+        """Returns (seq, epoch, message bytes) of the latest published message.
+
+        Raises TimeoutError if a publish doesn't complete within `timeout`
+        seconds, as happens when the collector dies halfway through one.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            self._map()
+            magic, version, generation, seq, length, epoch = self.HEADER.unpack_from(self._mm, 0)
+            if magic != self.MAGIC or version != self.VERSION:
+                raise ValueError(f"{self.path} is not a snapshot channel")
+            if generation % 2 == 0:
+                if self.HEADER_SIZE + length > len(self._mm):
+                    self._remap() # The collector grew the file for a larger message
+                    continue
+                message = self._mm[self.HEADER_SIZE:self.HEADER_SIZE + length]
+                if struct.unpack_from('<Q', self._mm, self.GENERATION_OFFSET)[0] == generation:
+                    return seq, epoch.hex(), message
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"{self.path} stayed mid-publish for {timeout}s")
+            time.sleep(0.001) # Mid-publish; try again once the collector is done
+
+    def _set_generation(self, generation):
+        self._generation = generation
+        struct.pack_into('<Q', self._mm, self.GENERATION_OFFSET, generation)
+
+    def _map(self):
+        if self._mm is None:
+            self._remap()
+
+    def _remap(self):
+        if self._mm is not None:
+            self._mm.close()
+        with open(self.path, 'rb') as file:
+            self._mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+# --- Stats Poller ---
+
+class StatsPoller:
+    """Scrapes Knot Resolver on a background thread and keeps the latest snapshot.
+
+    Every client is served from the same in-memory snapshot, so the upstream
+    webmgmt endpoint sees one request per POLL_INTERVAL no matter how many
+    dashboard tabs are open. Successful snapshots are numbered, packed into
+    columnar rows and the last few are retained so clients can ask for only
+    what changed since theirs.
+    """
+
+    def __init__(self, targets, interval=POLL_INTERVAL, history=DELTA_HISTORY):
+        self.targets = targets
+        self.interval = interval
+        self.timeout = max(target.timeout for target in targets) # Budget for one round of scrapes
+        self.schema = CounterSchema()
+        self.history = HistoryRing(max(1, int(HISTORY_WINDOW / interval)))
+        self.rates = RateEngine(self.schema)
+        self.latency = LatencyEngine(self.schema)
+        self.store = None
+        self.channel = None # SnapshotChannel shared with the other processes in multi-worker mode
+        self.follower = False # Whether snapshots are read from the channel instead of scraped
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(targets), thread_name_prefix="stats-scrape")
+        self._lock = threading.Lock()
+        self._updated = threading.Condition(self._lock)
+        self._ready = threading.Event()
+        self._thread = None
+        self._seq = 0 # Incremented on every scrape so subscribers can tell snapshots apart
+        # (error payload, HTTP status) if the most recent scrape failed, else None
+        self._error = ({"error": "Stats have not been fetched yet."}, 503)
+        self._history = collections.OrderedDict() # seq -> Snapshot of recent successful scrapes
+        self._history_size = history
+        self._attempted = None # When the most recent scrape, successful or not, finished
+        self._encoded = {} # (since, view), 'metrics' or a request key -> EncodedBody for the current snapshot
+        self._stale_encoded = {} # (since, view) -> EncodedBody of a stale envelope, rebuilt as its age moves on
+        self._stale_second = None # Age in whole seconds the envelopes in _stale_encoded were built at
+        self._epoch = os.urandom(4).hex() # Keeps ETags and seqs of one run from matching those of another
+        self._views = {} # (seq, view) -> aggregated view of a retained snapshot
+        self._restored_until = None # Timestamp of the newest snapshot restored from the store
+
+    def start(self):
+        """Starts the polling thread, or the channel-following one in a worker process, if not already running."""
+        with self._lock:
+            if self._thread is None:
+                self._open_store()
+                target = self._follow if self.follower else self._run
+                self._thread = threading.Thread(target=target, name="stats-poller", daemon=True)
+                self._thread.start()
+
+    def history_source(self, window):
+        """Returns (query function, resolution) of the finest history that covers `window` seconds."""
+        if window <= HISTORY_WINDOW or self.store is None:
+            return self.history.query, self.interval
+        tier, resolution = self.store.resolution_for(window)
+        return functools.partial(self.store.query, tier=tier), resolution
+
+    def max_history_window(self):
+        return self.store.max_window() if self.store is not None else HISTORY_WINDOW
+
+    def _open_store(self):
+        """Opens the on-disk history store, if configured, and restores recent history from it."""
+        if not HISTORY_STORE_DIR:
+            return
+        try:
+            self.store = SeriesStore(HISTORY_STORE_DIR, self.schema)
+            for timestamp, instances in self.store.load_recent(HISTORY_WINDOW):
+                self.history.append(timestamp, instances)
+                self._restored_until = timestamp
+            atexit.register(self.store.flush)
+        except OSError as e:
+            app.logger.warning(f"History will not persist across restarts; cannot use {HISTORY_STORE_DIR}: {e}")
+            self.store = None
+
+    def wait_for_update(self, last_seq, timeout):
+        """Blocks until a scrape newer than last_seq exists; returns its seq, or None on timeout."""
+        with self._updated:
+            if not self._updated.wait_for(lambda: self._seq > last_seq, timeout):
+                return None
+            return self._seq
+
+    def etag(self, seq):
+        """Returns the entity tag of bodies built from scrape `seq`."""
+        return since_token(self._epoch, seq)
+
+    def encoded(self, key, build):
+        """Returns (EncodedBody, ETag) of build() for the current scrape, calling it at most once per scrape.
+
+        For responses such as /api/history that depend on the request but,
+        like the snapshot bodies, only change when a new scrape lands.
+        """
+        with self._lock:
+            seq = self._seq
+            body = self._encoded.get(key)
+        if body is None:
+            started = time.perf_counter()
+            body = EncodedBody(json_dumps(build())) # Outside the lock: history queries take their own
+            timings.since('build_history', started)
+            with self._lock:
+                if self._seq == seq:
+                    self._encoded[key] = body
+        return body, self.etag(seq)
+
+    def encoded_update(self, since=None, view=None):
+        """Returns (EncodedBody of JSON, HTTP status, (epoch, seq), ETag) for a client holding snapshot `since`.
+
+        `view` is an (instance, group_by) pair as accepted by build_view(), or
+        None for the per-instance tree. With since=None the body is that view
+        on its own. Otherwise it is an envelope holding either a delta against
+        the client's snapshot or, when that is no longer retained, the full
+        view; envelopes also carry per-second rates of the counters (in full,
+        or just the changed ones), latency percentiles over LATENCY_WINDOW,
+        and list every instance id for the selector. Bodies are serialized
+        once per snapshot and shared by every client at the same `since` and
+        view. The plain per-instance tree of a single target is upstream's
+        own response, forwarded without re-encoding. `since` is an (epoch,
+        seq) pair from parse_since(); seqs of another run are never a base
+        for a delta, since the same seq may name another snapshot there.
+
+        While scrapes fail, or none has been attempted for OVERDUE_POLLS
+        polls, the last good snapshot keeps being served for up to
+        SERVE_STALE_FOR seconds; envelopes say so with "stale", its "age" and
+        the "stale_error". Only without such a
+        snapshot is the error returned, with seq staying at `since` so the
+        client keeps its base, and no ETag.
+        """
+        self._ready.wait(self.interval + self.timeout)
+        with self._lock:
+            stale, age = self._freshness()
+            if age is None or age > SERVE_STALE_FOR:
+                payload, status = self._error
+                return EncodedBody(json_dumps(payload)), status, since, None
+            base = since
+            if since is not None:
+                epoch, since = since
+                if epoch != self._epoch:
+                    since = 0 # Never retained, so the client gets the full view
+            snapshot = next(reversed(self._history.values()))
+            key = (since if since is None or since in self._history else "full", view)
+            encoded = self._encoded
+            if stale: # Envelopes carry the age, which keeps growing while no scrape lands
+                if self._stale_second != int(age):
+                    self._stale_encoded, self._stale_second = {}, int(age)
+                encoded = self._stale_encoded
+            body = encoded.get(key)
+            if body is None:
+                started = time.perf_counter()
+                current = self._view(snapshot.seq, view)
+                if since is None and view is None and snapshot.body is not None:
+                    body = EncodedBody(snapshot.body) # Nothing to transform: pass upstream's bytes through
+                elif since is None:
+                    body = EncodedBody(json_dumps(unpack_view(self.schema, current)))
+                else:
+                    update = {
+                        "seq": since_token(self._epoch, snapshot.seq),
+                        "timestamp": snapshot.timestamp,
+                        "full": key[0] == "full",
+                        "instances": list(snapshot.instances),
+                        "target_errors": snapshot.target_errors,
+                        "latency": self._latency(snapshot.seq, view),
+                        "stale": stale,
+                        "age": round(age, 3),
+                        "stale_error": self._stale_error() if stale else None,
+                    }
+                    current_rates = self._view(snapshot.seq, view, rates=True)
+                    if update["full"]:
+                        update["stats"] = unpack_view(self.schema, current)
+                        update["rates"] = unpack_view(self.schema, current_rates)
+                    else:
+                        update["since"] = since_token(*base)
+                        update.update(diff_view(self.schema, self._view(since, view), current))
+                        update["rates"] = diff_view(self.schema, self._view(since, view, rates=True), current_rates)["changed"]
+                    body = EncodedBody(json_dumps(update))
+                timings.since('build_stats', started)
+                encoded[key] = body
+            # The seq stays put while stale, but the body doesn't: tag it with the latest attempt,
+            # marked, since a stalled collector leaves even that seq unchanged
+            return body, 200, (self._epoch, snapshot.seq), self.etag(self._seq) + ("-stale" if stale else "")
+
+    def freshness(self):
+        """Returns (stale, age in seconds) of the snapshot /api/stats serves; age is None before the first one."""
+        with self._lock:
+            return self._freshness()
+
+    def _freshness(self):
+        if not self._history:
+            return self._error is not None, None
+        now = time.time()
+        return (self._error is not None or self._overdue(now),
+                now - next(reversed(self._history.values())).timestamp)
+
+    def _overdue(self, now):
+        """Whether no scrape attempt has landed for OVERDUE_POLLS polls, e.g. because the poller died."""
+        return now - self._attempted > OVERDUE_POLLS * self.interval + self.timeout
+
+    def _stale_error(self):
+        if self._error is not None:
+            return self._error[0]["error"]
+        return f"No stats have been fetched for {time.time() - self._attempted:.0f}s."
+
+    def encoded_metrics(self):
+        """Returns the Prometheus exposition of the current snapshot as an EncodedBody, rendered once per scrape."""
+        self._ready.wait(self.interval + self.timeout)
+        with self._lock:
+            body = self._encoded.get('metrics')
+            if body is None:
+                snapshot = next(reversed(self._history.values())) if self._error is None else None
+                started = time.perf_counter()
+                body = self._encoded['metrics'] = EncodedBody(render_metrics(self.schema, snapshot, self.targets).encode())
+                timings.since('render_metrics', started)
+            return body
+
+    def _view(self, seq, view, rates=False):
+        """Returns the view of a retained snapshot's counters or rates, building it at most once."""
+        snapshot = self._history[seq]
+        instances = snapshot.rates if rates else snapshot.instances
+        if view is None:
+            return instances
+        cached = self._views.get((seq, view, rates))
+        if cached is None:
+            cached = self._views[(seq, view, rates)] = build_view(self.schema, instances, *view)
+        return cached
+
+    def _latency(self, seq, view):
+        """Returns the latency percentiles of a retained snapshot for a view, estimating them at most once."""
+        cached = self._views.get((seq, view, 'latency'))
+        if cached is None:
+            cached = self._views[(seq, view, 'latency')] = latency_view(self._history[seq].latency, *(view or (None, None)))
+        return cached
+
+    def _run(self):
+        next_poll = time.monotonic()
+        while True:
+            started = time.perf_counter()
+            payload, status, target_errors, body = self._scrape()
+            timings.since('scrape', started)
+            timestamp = time.time()
+            try:
+                self._ingest(timestamp, payload, status, target_errors, body=body)
+            except Exception as e:
+                app.logger.error(f"Error ingesting stats: {e}", exc_info=True)
+            else:
+                self._publish(timestamp, payload, status, target_errors, body)
+
+            # Keep a steady cadence; skip ticks rather than bunching up if a scrape overran
+            next_poll += self.interval
+            now = time.monotonic()
+            if next_poll < now:
+                next_poll = now
+            time.sleep(next_poll - now)
+
+    def _publish(self, timestamp, payload, status, target_errors, body):
+        """Hands the snapshot just ingested to the workers, if there are any."""
+        if self.channel is None:
+            return
+        started = time.perf_counter()
+        # A JSON header line, then the payload; upstream bytes are forwarded as they came
+        header = {
+            "timestamp": timestamp,
+            "status": status,
+            "target_errors": target_errors,
+            "targets": [target.health() for target in self.targets],
+            "timings": timings.histograms(),
+            "passthrough": body is not None,
+        }
+        self.channel.publish(self._seq, b"%s\n%s" % (json_dumps(header), body if body is not None else json_dumps(payload)))
+        timings.since('publish', started)
+
+    def _follow(self):
+        """Ingests the collector's snapshots from the channel instead of scraping.
+
+        A channel that stops advancing for COLLECTOR_STALL_INTERVALS polls
+        counts as a failed scrape, so the last snapshot is served as stale
+        until the collector publishes again.
+        """
+        last_seq = 0
+        advanced = time.monotonic()
+        stalled = False
+        stall_after = COLLECTOR_STALL_INTERVALS * self.interval + self.timeout
+        while True:
+            message = None
+            if self.channel.seq() != last_seq:
+                started = time.perf_counter()
+                try:
+                    seq, epoch, message = self.channel.read(timeout=self.interval)
+                except TimeoutError:
+                    pass # Left mid-publish; the collector may have died
+            if message is None:
+                if not stalled and time.monotonic() - advanced > stall_after:
+                    stalled = True
+                    app.logger.error(f"The stats collector has published nothing for {stall_after:g}s")
+                    # Keeps the seq, so workers go on numbering snapshots like the collector
+                    self._ingest(time.time(), {"error": "The stats collector has stopped publishing."}, 503, {},
+                                 self._seq)
+                time.sleep(self.interval / 20)
+                continue
+            last_seq, self._epoch = seq, epoch
+            advanced = time.monotonic()
+            stalled = False
+            try:
+                header, body = message.split(b"\n", 1)
+                header = json_loads(header)
+                payload = json_loads(body)
+                timings.since('channel_read', started)
+                for target, health in zip(self.targets, header["targets"]):
+                    target.restore_health(health)
+                timings.adopt(header["timings"])
+                self._ingest(header["timestamp"], payload, header["status"], header["target_errors"], last_seq,
+                             body if header["passthrough"] else None)
+            except Exception as e:
+                app.logger.error(f"Error ingesting the collector's stats: {e}", exc_info=True)
+
+    def _ingest(self, timestamp, payload, status, target_errors, seq=None, body=None):
+        """Turns one scrape into the next snapshot and wakes everyone waiting for it.
+
+        `seq` is given when following the collector, so that every worker
+        numbers snapshots the same way. `body` is the upstream response the
+        payload was decoded from, if it can be served in place of the payload.
+        """
+        if status == 200:
+            started = time.perf_counter()
+            instances = {instance_id: self.schema.pack(instance_data)
+                         for instance_id, instance_data in payload.items()}
+            timings.since('pack', started)
+            started = time.perf_counter()
+            rates = self.rates.update(timestamp, instances)
+            latency = self.latency.update(timestamp, instances)
+            timings.since('rates', started)
+            # A worker's first snapshots from the channel may already be in the history it restored
+            if self._restored_until is None or timestamp > self._restored_until:
+                started = time.perf_counter()
+                self.history.append(timestamp, instances)
+                timings.since('history_append', started)
+            if self.store is not None and not self.follower: # Only the collector writes the store
+                started = time.perf_counter()
+                try:
+                    self.store.append(timestamp, instances)
+                except OSError as e:
+                    app.logger.error(f"Disabling on-disk history after write failure: {e}")
+                    self.store = None
+                timings.since('store_append', started)
+        with self._updated:
+            self._seq = seq if seq is not None else self._seq + 1
+            self._attempted = timestamp
+            self._encoded = {}
+            self._stale_encoded = {}
+            if status == 200:
+                self._error = None
+                self._history[self._seq] = Snapshot(self._seq, timestamp, instances, rates, latency, target_errors, body)
+                while len(self._history) > self._history_size:
+                    expired, _ = self._history.popitem(last=False)
+                    for view_key in [k for k in self._views if k[0] == expired]:
+                        del self._views[view_key]
+            else:
+                self._error = (payload, status)
+            self._updated.notify_all()
+        self._ready.set()
+
+    def _scrape(self):
+        """Scrapes every target concurrently and merges the results.
+
+        Returns (payload, HTTP status, {target name: error}, body), where body
+        is the upstream response itself when it can stand in for the payload
+        (a single target), else None. A target still busy with an earlier
+        scrape isn't asked again, one whose circuit breaker is open isn't
+        contacted at all, and one that misses this round's budget is reported
+        as timed out without holding up the others. With several targets,
+        instance ids are namespaced "target/instance" and the scrape only
+        fails if every target did.
+        """
+        futures = {}
+        results = {}
+        for target in self.targets:
+            if target.pending is None:
+                if not target.ready():
+                    results[target] = target.rejection()
+                    continue
+                target.pending = self._executor.submit(target.fetch)
+            futures[target] = target.pending
+        concurrent.futures.wait(futures.values(), timeout=self.timeout)
+
+        for target, future in futures.items():
+            if future.done():
+                target.pending = None
+                results[target] = future.result()
+            else:
+                results[target] = ({"error": f"Request timed out fetching stats from {target.url}."}, 504, None)
+
+        if len(self.targets) == 1:
+            payload, status, body = results[self.targets[0]]
+            return payload, status, {}, body
+
+        merged = {}
+        target_errors = {}
+        for target, (payload, status, _) in results.items():
+            if status == 200:
+                for instance_id, instance_data in payload.items():
+                    merged[f"{target.name}/{instance_id}"] = instance_data
+            else:
+                target_errors[target.name] = payload["error"]
+        if len(target_errors) == len(self.targets):
+            return {"error": "; ".join(f"{name}: {error}" for name, error in target_errors.items())}, 503, target_errors, None
+        return merged, 200, target_errors, None
+
+
+
+stats_poller = StatsPoller(build_targets())
+
+# --- Static Assets ---
+
+class StaticAssets:
+    """The files in STATIC_DIR, loaded once and served under content-hashed names.
+
+    A file's URL changes whenever its content does, so responses can be
+    cached forever. Vendored assets that haven't been downloaded yet fall
+    back to their VENDOR_ASSETS URL.
+    """
+
+    def __init__(self, directory):
+        self._urls = {} # file name -> URL to reference it by
+        self._files = {} # hashed file name -> (EncodedBody, content type, digest)
+        if not os.path.isdir(directory):
+            return
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if not os.path.isfile(path):
+                continue
+            with open(path, 'rb') as file:
+                data = file.read()
+            digest = hashlib.sha256(data).hexdigest()[:16]
+            stem, extension = os.path.splitext(name)
+            hashed = f"{stem}.{digest}{extension}"
+            content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            body = EncodedBody(data, compressible=content_type.startswith('text/') or content_type.endswith('javascript'))
+            self._files[hashed] = (body, content_type, digest)
+            self._urls[name] = f"/static/{hashed}"
+
+    def url(self, name):
+        """Returns the URL to reference an asset by."""
+        url = self._urls.get(name)
+        if url is None:
+            url = VENDOR_ASSETS[name]
+            app.logger.warning(f"{name} is not vendored; the page will load it from {url} (run with --vendor)")
+        return url
+
+    def get(self, hashed):
+        """Returns (EncodedBody, content type, digest) for a hashed file name, or None."""
+        return self._files.get(hashed)
+
+    def font_faces(self):
+        """Returns @font-face rules for the vendored Inter weights."""
+        rules = []
+        for weight in (400, 600, 700):
+            url = self._urls.get(f"inter-latin-{weight}-normal.woff2")
+            if url is not None:
+                rules.append(f"@font-face {{ font-family: 'Inter'; font-weight: {weight}; font-display: swap; "
+                             f"src: url({url}) format('woff2'); }}")
+        return '\n'.join(rules)
+
+
+def vendor_assets(directory=STATIC_DIR):
+    """Downloads VENDOR_ASSETS into `directory`, so the page works without internet access."""
+    os.makedirs(directory, exist_ok=True)
+    for name, url in VENDOR_ASSETS.items():
+        response = requests.get(url, timeout=30)
+        response.raise_for_status()
+        with open(os.path.join(directory, name), 'wb') as file:
+            file.write(response.content)
+        print(f"Vendored {name} ({len(response.content)} bytes) from {url}")
+
+
+def render_index(assets):
+    """Renders the dashboard page once; nothing in it changes while the app runs."""
+    template = app.jinja_env.from_string(HTML_TEMPLATE)
+    page = template.render(
+        knot_resolver_url=', '.join(target.url for target in stats_poller.targets),
+        history_window=int(HISTORY_WINDOW / POLL_INTERVAL),
+        latency_window=LATENCY_WINDOW,
+        asset_url=assets.url,
+        font_faces=assets.font_faces(),
+    ).encode()
+    return EncodedBody(page), hashlib.sha256(page).hexdigest()[:16]
+
+
+static_assets = StaticAssets(STATIC_DIR)
+index_page, index_etag = render_index(static_assets)
+
+# --- Hosts Index ---
+
+HOSTS_SORTS = ('file', 'hostname', 'ip')
+HOSTS_MATCHES = ('substring', 'prefix')
+HOSTS_QUERY_CACHE = 32 # Recent search results kept per version of the hosts file
+HOSTS_OPS = ('add', 'update', 'delete')
+HOSTS_COPY_CHUNK = 1 << 16 # Bytes copied at a time from the old hosts file into its replacement
+
+
+def parse_hosts(lines):
+    """Parses hosts file lines, as bytes, in one pass, skipping blanks and comments.
+
+    Returns (entries, spans): entries are (ip, hostname) pairs and spans[i]
+    is the number of bytes from the end of entry i-1's line (or the start of
+    the file) to the end of entry i's, which lets a rewrite find the lines
+    it changes without parsing the file again.
+    """
+    entries = []
+    spans = array.array('q')
+    span = 0
+    for line in lines:
+        span += len(line)
+        parts = line.split(None, 2) # The rest of the line (aliases, comments) is never split
+        if len(parts) >= 2 and parts[0][0] != 0x23: # '#'
+            entries.append((parts[0].decode(errors='replace'), parts[1].decode(errors='replace')))
+            spans.append(span)
+            span = 0
+    return entries, spans
+
+
+def host_line(ip, hostname, rest=b''):
+    """Formats one hosts file line as bytes."""
+    return f"{ip} {hostname} ".encode() + rest + b"\n" if rest else f"{ip} {hostname}\n".encode()
+
+
+def ip_sort_key(ip):
+    """Orders addresses numerically, IPv4 before IPv6, and anything unparsable after both by its text."""
+    for family, rank in ((socket.AF_INET, 4), (socket.AF_INET6, 6)):
+        try:
+            return (rank, socket.inet_pton(family, ip), '')
+        except OSError:
+            pass
+    return (7, b'', ip)
+
+
+def valid_ip(ip):
+    return ip_sort_key(ip)[0] != 7
+
+
+def write_atomically(path, lines):
+    """Streams `lines`, as bytes, into a temporary file next to `path`, then renames it over `path`.
+
+    Readers see either the old file or the complete new one, never a partial
+    write. The old file's permissions and, where allowed, ownership are kept.
+    Returns the os.stat_result of the new file.
+    """
+    directory = os.path.dirname(path) or '.'
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.")
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.writelines(lines)
+            file.flush()
+            try:
+                old = os.stat(path)
+                os.fchmod(file.fileno(), old.st_mode & 0o7777)
+                try:
+                    os.fchown(file.fileno(), old.st_uid, old.st_gid)
+                except PermissionError:
+                    pass
+            except FileNotFoundError:
+                os.fchmod(file.fileno(), 0o644)
+            os.fsync(file.fileno())
+            written = os.fstat(file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+    return written
+
+
+class HostsIndex:
+    """The hosts file, parsed into memory once per change on disk.
+
+    Requests only stat the file: it is re-read when its device, inode, size
+    or mtime differ from those of the parsed copy, which catches both
+    in-place edits and replacement by rename. The full /api/hosts body is
+    serialized once per version of the file and shared by every request.
+    Sort orders, the prefix index and recent search results are built on
+    first use and dropped with the version they were built from.
+
+    Writes go through write() and mutate(), which replace the file
+    atomically while holding a flock on its directory, so writers in other
+    worker processes take turns.
+    """
+
+    MISSING_MESSAGE = "Hosts file does not exist yet. It will be created when you add entries."
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock() # Held, with the directory lock, while the file is rewritten
+        self._signature = _MISSING # Stat fields of the parsed copy; None while the file doesn't exist
+        self._entries = [] # (ip, hostname) pairs in file order
+        self._spans = array.array('q') # Bytes up to the end of each entry's line, as returned by parse_hosts()
+        self._version = None
+        self._body = None # EncodedBody of the /api/hosts response, built on first use
+        self._orders = {} # sort -> (entry positions in that order, rank of each position)
+        self._lowered = None # (lowercased ips, lowercased hostnames), for searching
+        self._prefixes = None # [(sorted lowercased values, their entry positions)] per field
+        self._queries = collections.OrderedDict() # (search, match, sort, descending) -> positions, LRU
+
+    def load(self):
+        """Returns (entries, version) of the current file; entries are (ip, hostname) pairs in file order."""
+        with self._lock:
+            self._refresh()
+            return self._entries, self._version
+
+    def encoded(self):
+        """Returns (EncodedBody of the /api/hosts response, version) of the current file."""
+        with self._lock:
+            self._refresh()
+            if self._body is None:
+                started = time.perf_counter()
+                response = {"hosts": [{"ip": ip, "hostname": hostname} for ip, hostname in self._entries],
+                            "version": self._version}
+                if self._signature is None:
+                    response["message"] = self.MISSING_MESSAGE
+                self._body = EncodedBody(json_dumps(response))
+                timings.since('hosts_serialize', started)
+            return self._body, self._version
+
+    def query(self, search=None, match='substring', sort='file', descending=False):
+        """Returns (entries, positions, version): the positions of the entries matching `search`, in order.
+
+        `search` is matched case-insensitively against both the IP address
+        and the hostname, as a substring or, with match='prefix', a prefix.
+        """
+        with self._lock:
+            self._refresh()
+            key = (search, match, sort, descending)
+            positions = self._queries.get(key)
+            if positions is not None:
+                self._queries.move_to_end(key)
+                return self._entries, positions, self._version
+            started = time.perf_counter()
+            order, rank = self._order(sort)
+            if not search:
+                positions = order
+            elif match == 'prefix':
+                found = set()
+                for values, value_positions in self._prefix_index():
+                    lo = bisect.bisect_left(values, search)
+                    hi = bisect.bisect_left(values, search + '\U0010ffff')
+                    found.update(value_positions[lo:hi])
+                positions = sorted(found, key=rank.__getitem__)
+            else:
+                ips, hostnames = self._lowercased()
+                positions = [i for i in order if search in hostnames[i] or search in ips[i]]
+            if descending:
+                positions = positions[::-1]
+            self._queries[key] = positions
+            if len(self._queries) > HOSTS_QUERY_CACHE:
+                self._queries.popitem(last=False)
+            timings.since('hosts_query', started)
+            return self._entries, positions, self._version
+
+    def write(self, hosts):
+        """Replaces the whole file with `hosts`, (ip, hostname) pairs; returns the set of pairs it added or removed."""
+        hosts = list(hosts)
+        with self._locked_for_writing():
+            before, _ = self.load()
+            write_atomically(self.path, (host_line(ip, hostname) for ip, hostname in hosts))
+        return set(before).symmetric_difference(hosts)
+
+    def mutate(self, version, updates, adds):
+        """Applies changes to the file if it is still at `version`, streaming it into its replacement.
+
+        `updates` maps entry positions to a new (ip, hostname), or None to
+        delete the entry; `adds` are (ip, hostname) pairs to append. The
+        changed lines are located from the parsed spans, so only they are
+        looked at: everything between them, comments and blank lines
+        included, is copied over in chunks, and an updated entry keeps the
+        rest of its line. The index is updated in place rather than re-read.
+        Returns (new version, positions of the added entries, set of (ip,
+        hostname) pairs removed or added), or None if the file is no longer
+        at `version`. Raises ValueError for positions the file doesn't have.
+        """
+        with self._locked_for_writing():
+            with self._lock:
+                self._refresh()
+                if version != self._version:
+                    return None
+                signature, entries, spans = self._signature, self._entries, self._spans
+            missing = [position for position in updates if not 0 <= position < len(entries)]
+            if missing:
+                raise ValueError(f"No host entry at index {', '.join(map(str, sorted(missing)))}")
+
+            started = time.perf_counter()
+            lengths = {} # position -> (length of its old line, length of its new one)
+            newline_added = 0 # Whether a newline had to end the file's last line before the additions
+            source = open(self.path, 'rb') if signature is not None else None
+            try:
+                if source is not None and self._stat_signature(os.fstat(source.fileno())) != signature:
+                    return None # Replaced by someone else since it was stat'ed
+
+                def copy(size):
+                    while size > 0:
+                        chunk = source.read(min(size, HOSTS_COPY_CHUNK))
+                        size -= len(chunk)
+                        yield chunk
+
+                def spliced():
+                    nonlocal newline_added
+                    copied = 0 # Entries whose lines have been copied or replaced
+                    last_byte = b"\n"
+                    for position in sorted(updates):
+                        size = sum(spans[copied:position + 1])
+                        # The changed line is within the last two chunks; earlier ones go out untouched
+                        yield from copy(size - 2 * HOSTS_COPY_CHUNK)
+                        tail = source.read(min(size, 2 * HOSTS_COPY_CHUNK))
+                        line_start = tail.rfind(b"\n", 0, len(tail) - 1) + 1
+                        if line_start == 0 and size > len(tail):
+                            raise RuntimeError(f"A line of {self.path} is longer than {2 * HOSTS_COPY_CHUNK} bytes")
+                        yield tail[:line_start]
+                        old_line = tail[line_start:]
+                        update = updates[position]
+                        new_line = b""
+                        if update is not None:
+                            parts = old_line.split(None, 2)
+                            new_line = host_line(*update, parts[2].rstrip() if len(parts) > 2 else b'')
+                            yield new_line
+                        lengths[position] = (len(old_line), len(new_line))
+                        copied = position + 1
+                    while source is not None:
+                        chunk = source.read(HOSTS_COPY_CHUNK)
+                        if not chunk:
+                            break
+                        last_byte = chunk[-1:]
+                        yield chunk
+                    if adds and last_byte != b"\n":
+                        newline_added = 1
+                        yield b"\n"
+                    for ip, hostname in adds:
+                        yield host_line(ip, hostname)
+
+                written = write_atomically(self.path, spliced())
+            finally:
+                if source is not None:
+                    source.close()
+
+            trailing = signature[2] - sum(spans) if signature is not None else 0 # Bytes after the last entry's line
+            touched = {entries[position] for position in updates}
+            touched.update(update for update in updates.values() if update is not None)
+            touched.update(adds)
+            entries, spans = list(entries), array.array('q', spans)
+            for position in sorted(updates, reverse=True):
+                old_length, new_length = lengths[position]
+                if updates[position] is None:
+                    if position + 1 < len(spans): # What preceded the line now precedes the next entry's
+                        spans[position + 1] += spans[position] - old_length
+                    del entries[position]
+                    del spans[position]
+                else:
+                    entries[position] = updates[position]
+                    spans[position] += new_length - old_length
+            if newline_added and not trailing:
+                spans[-1] += 1 # It ended the last entry's line
+            first_added = len(entries)
+            for ip, hostname in adds:
+                entries.append((ip, hostname))
+                spans.append(len(host_line(ip, hostname)))
+            if adds: # Whatever followed the last entry's line now precedes the first added one
+                spans[first_added] += written.st_size - sum(spans)
+            timings.since('hosts_rewrite', started)
+            with self._lock:
+                self._install(self._stat_signature(written), entries, spans)
+                return self._version, list(range(len(entries) - len(adds), len(entries))), touched
+
+    @contextlib.contextmanager
+    def _locked_for_writing(self):
+        """Serializes writers: this process's threads by a lock, other processes by a flock on the directory."""
+        directory = os.path.dirname(self.path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        with self._write_lock:
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd) # Releases the flock
+
+    def _order(self, sort):
+        """Returns (positions sorted by `sort`, rank of each position in that order), building it once."""
+        cached = self._orders.get(sort)
+        if cached is None:
+            entries = self._entries
+            if sort == 'hostname':
+                order = sorted(range(len(entries)), key=lambda i: (entries[i][1].lower(), i))
+            elif sort == 'ip':
+                order = sorted(range(len(entries)), key=lambda i: (ip_sort_key(entries[i][0]), i))
+            else:
+                order = range(len(entries))
+                cached = self._orders[sort] = (order, order) # Each position is its own rank
+                return cached
+            rank = array.array('l', [0]) * len(entries)
+            for position, i in enumerate(order):
+                rank[i] = position
+            cached = self._orders[sort] = (order, rank)
+        return cached
+
+    def _lowercased(self):
+        if self._lowered is None:
+            self._lowered = ([ip.lower() for ip, _ in self._entries], [hostname.lower() for _, hostname in self._entries])
+        return self._lowered
+
+    def _prefix_index(self):
+        """Returns each field's lowercased values sorted, with their entry positions, for bisecting prefixes."""
+        if self._prefixes is None:
+            self._prefixes = []
+            for values in self._lowercased():
+                order = sorted(range(len(values)), key=values.__getitem__)
+                self._prefixes.append(([values[i] for i in order], order))
+        return self._prefixes
+
+    def _refresh(self):
+        """Re-reads the file if it changed since it was parsed. Called with the lock held."""
+        try:
+            signature = self._stat_signature(os.stat(self.path))
+        except FileNotFoundError:
+            signature = None
+        if signature == self._signature:
+            return
+        started = time.perf_counter()
+        entries, spans = [], array.array('q')
+        if signature is not None:
+            try:
+                with open(self.path, 'rb') as file:
+                    signature = self._stat_signature(os.fstat(file.fileno())) # Of the file actually read
+                    entries, spans = parse_hosts(file)
+            except FileNotFoundError: # Replaced between the stat and the open
+                signature = None
+        self._install(signature, entries, spans)
+        timings.since('hosts_parse', started)
+
+    def _install(self, signature, entries, spans):
+        """Makes the entries read from or written to the file with `signature` current. Called with the lock held."""
+        self._signature = signature
+        self._entries = entries
+        self._spans = spans
+        self._version = "missing" if signature is None else "%x-%x-%x" % signature[1:]
+        self._body = None
+        self._orders = {}
+        self._lowered = None
+        self._prefixes = None
+        self._queries.clear()
+
+    @staticmethod
+    def _stat_signature(stat):
+        return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def parse_hosts_args(args):
+    """Reads the /api/hosts search, sort and paging arguments, raising ValueError for bad input.
+
+    Returns None when none is given, meaning the whole file is wanted.
+    """
+    if not any(name in args for name in ('q', 'match', 'sort', 'order', 'limit', 'cursor')):
+        return None
+    match = args.get('match') or 'substring'
+    if match not in HOSTS_MATCHES:
+        raise ValueError(f"match must be one of: {', '.join(HOSTS_MATCHES)}")
+    sort = args.get('sort') or 'file'
+    if sort not in HOSTS_SORTS:
+        raise ValueError(f"sort must be one of: {', '.join(HOSTS_SORTS)}")
+    order = args.get('order') or 'asc'
+    if order not in ('asc', 'desc'):
+        raise ValueError("order must be asc or desc")
+    limit_error = f"limit must be a whole number between 1 and {HOSTS_PAGE_SIZE * 10}"
+    try:
+        limit = int(args.get('limit') or HOSTS_PAGE_SIZE)
+    except ValueError:
+        raise ValueError(limit_error)
+    if not 0 < limit <= HOSTS_PAGE_SIZE * 10:
+        raise ValueError(limit_error)
+    cursor = None
+    if args.get('cursor'):
+        try:
+            version, offset = base64.urlsafe_b64decode(args['cursor']).decode().rsplit(':', 1)
+            cursor = (version, int(offset))
+            if cursor[1] < 0:
+                raise ValueError(offset)
+        except (ValueError, UnicodeDecodeError):
+            raise ValueError("cursor is not one returned by /api/hosts")
+    return (args.get('q', '').strip().lower() or None, match, sort, order == 'desc', limit, cursor)
+
+
+def parse_host(change):
+    """Returns the validated (ip, hostname) of a change, raising ValueError for bad input."""
+    ip, hostname = change.get('ip'), change.get('hostname')
+    if not isinstance(ip, str) or not isinstance(hostname, str) or not ip.strip() or not hostname.strip():
+        raise ValueError("Each host must have both IP and hostname")
+    ip, hostname = ip.strip(), hostname.strip()
+    if not valid_ip(ip):
+        raise ValueError(f"{ip!r} is not an IP address")
+    if any(c.isspace() or c == '#' for c in hostname):
+        raise ValueError(f"{hostname!r} is not a hostname")
+    return ip, hostname
+
+
+def parse_hosts_changes(body):
+    """Reads a PATCH /api/hosts body into ({position: (ip, hostname) or None}, [(ip, hostname)]).
+
+    Raises ValueError for bad input.
+    """
+    if not isinstance(body, dict):
+        raise ValueError("Expected a JSON object")
+    changes = [body] if 'op' in body else body.get('changes')
+    if not isinstance(changes, list) or not changes:
+        raise ValueError("Expected a change or a non-empty list of changes")
+    updates = {}
+    adds = []
+    for change in changes:
+        op = change.get('op') if isinstance(change, dict) else None
+        if op not in HOSTS_OPS:
+            raise ValueError(f"op must be one of: {', '.join(HOSTS_OPS)}")
+        if op == 'add':
+            adds.append(parse_host(change))
+            continue
+        position = change.get('index')
+        if not isinstance(position, int) or isinstance(position, bool):
+            raise ValueError(f"{op} needs the index of the entry")
+        if position in updates:
+            raise ValueError(f"More than one change to the entry at index {position}")
+        updates[position] = parse_host(change) if op == 'update' else None
+    return updates, adds
+
+
+def hosts_page(query):
+    """Returns one page of hosts for parsed /api/hosts arguments, or None if its cursor is out of date."""
+    search, match, sort, descending, limit, cursor = query
+    entries, positions, version = hosts_index.query(search, match, sort, descending)
+    offset = 0
+    if cursor is not None:
+        cursor_version, offset = cursor
+        if cursor_version != version:
+            return None
+    end = offset + limit
+    page = {
+        "hosts": [{"index": i, "ip": entries[i][0], "hostname": entries[i][1]} for i in positions[offset:end]],
+        "total": len(positions),
+        "next_cursor": base64.urlsafe_b64encode(f"{version}:{end}".encode()).decode() if end < len(positions) else None,
+        "version": version,
+    }
+    if version == "missing":
+        page["message"] = HostsIndex.MISSING_MESSAGE
+    return page
+
+
+hosts_index = HostsIndex(HOSTS_FILE_PATH)
+
+# --- Resolver Reloads ---
+
+def lua_string(text):
+    """Quotes `text` as a Lua string literal."""
+    return "'" + text.replace('\\', '\\\\').replace("'", "\\'").replace('\n', '\\n') + "'"
+
+
+class ReloadScheduler:
+    """Reloads Knot Resolver after hosts edits, off the request thread.
+
+    Edits arriving within `window` seconds of each other share one reload,
+    run by a background thread once they stop, or `max_delay` after the first
+    of them so a steady stream of edits still gets applied. With a state file,
+    the workers of a multi-worker server take turns reloading, report the same
+    last reload, and skip a reload another worker's already covered.
+
+    With a `control_dir`, a reload instead pushes the hints the edits touched
+    to every kresd control socket in it, concurrently: each touched (ip,
+    hostname) pair is set if `hosts` still has it and deleted otherwise, so
+    the outcome follows the file however edits from several workers interleave.
+    """
+
+    APPLIED = 'knotstats: hints applied' # What a line of pushed hints returns when none of it raised
+
+    def __init__(self, command, window=RELOAD_DEBOUNCE, max_delay=RELOAD_MAX_DELAY,
+                 timeout=RELOAD_TIMEOUT, state_path=None, control_dir=None, hosts=None,
+                 control_timeout=KRESD_CONTROL_TIMEOUT):
+        self.command = command
+        self.window = window
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.state_path = state_path
+        self.control_dir = control_dir
+        self.hosts = hosts
+        self.control_timeout = control_timeout
+        self._wake = threading.Condition()
+        self._thread = None
+        self._pending = 0 # Edits waiting for a reload
+        self._first = self._latest = None # time.monotonic() of the oldest and newest of them
+        self._requested_at = None # Wall-clock time of the newest of them
+        self._touched = set() # (ip, hostname) pairs they added or removed
+        self._running = False
+        self._state = {"reloads": 0, "last": None} # Used without a usable state file, and mirrors it otherwise
+        self._state_failed = False # Whether the state file has been reported unusable
+
+    def request(self, touched=()):
+        """Schedules a reload covering an edit just made, which added or removed the `touched` pairs.
+
+        Returns status() for it.
+        """
+        with self._wake:
+            now = time.monotonic()
+            if not self._pending:
+                self._first = now
+            self._pending += 1
+            self._touched.update(touched)
+            self._latest = now
+            self._requested_at = requested_at = time.time()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='resolver-reload', daemon=True)
+                self._thread.start()
+            self._wake.notify()
+        return {**self.status(), "requested_at": requested_at}
+
+    def status(self):
+        """Returns the /api/hosts/reload body: what is waiting or running, and how the last reload went."""
+        with self._wake:
+            pending = self._pending
+            status = {
+                "pending": pending,
+                "due_in": round(max(0.0, self._due() - time.monotonic()), 3) if pending else None,
+                "requested_at": self._requested_at if pending else None,
+                "running": self._running,
+            }
+        return {**status, **self._read_state()}
+
+    def _due(self):
+        return min(self._latest + self.window, self._first + self.max_delay)
+
+    def _run(self):
+        while True:
+            with self._wake:
+                while not self._pending or time.monotonic() < self._due():
+                    self._wake.wait(self._due() - time.monotonic() if self._pending else None)
+                coalesced, requested_at, touched = self._pending, self._requested_at, self._touched
+                self._pending = 0
+                self._touched = set()
+                self._running = True
+            try:
+                self._reload(coalesced, requested_at, touched)
+            except Exception as e:
+                app.logger.error(f"Error reloading Knot Resolver: {e}", exc_info=True)
+            finally:
+                with self._wake:
+                    self._running = False
+
+    def _reload(self, coalesced, requested_at, touched):
+        """Applies `coalesced` edits, the newest made at `requested_at`, to Knot Resolver and records how it went."""
+        with self._locked_state() as state:
+            last = state["last"]
+            if self.control_dir is None and last and requested_at <= last["started_at"] <= time.time():
+                last["coalesced"] += coalesced # Another worker's reload started after these edits were written
+                return
+            started_at, started = time.time(), time.perf_counter()
+            if self.control_dir is None:
+                outcome = {"mode": "reload", "error": self._run_command()}
+            else:
+                outcome = {"mode": "control", **self._push_hints(touched)}
+            duration = time.perf_counter() - started
+            timings.observe('resolver_reload', duration)
+            if outcome["error"] is not None:
+                app.logger.warning(f"Failed to reload Knot Resolver: {outcome['error']}")
+            state["reloads"] += 1
+            state["last"] = {
+                "success": outcome["error"] is None,
+                "coalesced": coalesced,
+                "requested_at": requested_at,
+                "started_at": started_at,
+                "duration_ms": round(duration * 1000, 1),
+                **outcome,
+            }
+
+    def _run_command(self):
+        """Runs the reload command; returns None, or what went wrong."""
+        try:
+            subprocess.run(self.command, check=True, capture_output=True, timeout=self.timeout)
+        except subprocess.CalledProcessError as e:
+            return (e.stderr or b'').decode(errors='replace').strip() or str(e)
+        except (subprocess.SubprocessError, OSError) as e:
+            return str(e)
+        return None
+
+    def _push_hints(self, touched):
+        """Sends the `touched` hints to every kresd control socket at once; returns the outcome per worker."""
+        present = set(self.hosts.load()[0]) if touched else set()
+        changes = [("set" if pair in present else "del", pair) for pair in sorted(touched)]
+        lines = []
+        for start in range(0, len(changes), KRESD_CONTROL_BATCH):
+            calls = " ".join(f"hints.{action}({lua_string(f'{hostname} {ip}')})"
+                             for action, (ip, hostname) in changes[start:start + KRESD_CONTROL_BATCH])
+            lines.append(f"(function() {calls} return {lua_string(self.APPLIED)} end)()")
+        hints = {"set": sum(action == "set" for action, _ in changes), "deleted": sum(action == "del" for action, _ in changes)}
+        try:
+            sockets = sorted(os.path.join(self.control_dir, name) for name in os.listdir(self.control_dir))
+        except OSError as e:
+            return {"error": f"Cannot list kresd control sockets: {e}", "hints": hints, "workers": []}
+        if not sockets:
+            return {"error": f"No kresd control sockets in {self.control_dir}", "hints": hints, "workers": []}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(sockets)) as executor:
+            workers = list(executor.map(functools.partial(self._send_hints, lines=lines), sockets))
+        failed = [worker for worker in workers if not worker["success"]]
+        error = None
+        if failed:
+            error = f"{len(failed)} of {len(workers)} kresd workers failed; {failed[0]['socket']}: {failed[0]['error']}"
+        return {"error": error, "hints": hints, "workers": workers}
+
+    def _send_hints(self, path, lines):
+        """Sends `lines` of Lua to the kresd control socket at `path`, reading kresd's length-prefixed replies."""
+        started = time.perf_counter()
+        error = None
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                connection.settimeout(self.control_timeout)
+                connection.connect(path)
+                connection.sendall(b"__binary\n" + b"".join(line.encode() + b"\n" for line in lines))
+                replies = connection.makefile('rb')
+                for _ in lines:
+                    header = replies.read(4)
+                    if len(header) < 4:
+                        raise ConnectionError("kresd closed the control socket")
+                    reply = replies.read(struct.unpack('>I', header)[0]).decode(errors='replace')
+                    if self.APPLIED not in reply:
+                        error = reply.strip() or "kresd sent an empty reply"
+                        break
+        except OSError as e:
+            error = str(e) or type(e).__name__
+        return {
+            "socket": os.path.basename(path),
+            "success": error is None,
+            "error": error,
+            "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+        }
+
+    @contextlib.contextmanager
+    def _locked_state(self):
+        """Yields the reload state for updating, holding the state file's lock so workers reload one at a time.
+
+        Without a usable state file the state is kept in this process, and
+        reloads go ahead all the same.
+        """
+        lock = self._open_lock()
+        if lock is None:
+            yield self._state # Only this object's thread reloads
+            return
+        with lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = self._read_state()
+            yield state
+            self._state = state
+            try:
+                write_atomically(self.state_path, [json_dumps(state)]) # Readers never wait for a running reload
+            except OSError as e:
+                self._report_state_failure(e)
+
+    def _open_lock(self):
+        if self.state_path is None:
+            return None
+        try:
+            private_directory(os.path.dirname(self.state_path) or '.')
+            return open(self.state_path + '.lock', 'ab')
+        except OSError as e:
+            self._report_state_failure(e)
+            return None
+
+    def _read_state(self):
+        if self.state_path is not None:
+            try:
+                with open(self.state_path, 'rb') as file:
+                    return json_loads(file.read())
+            except (OSError, ValueError):
+                pass
+        return dict(self._state)
+
+    def _report_state_failure(self, error):
+        if not self._state_failed:
+            self._state_failed = True
+            app.logger.warning(f"Keeping Knot Resolver reload status in this process only: {error}")
+
+
+def private_directory(path):
+    """Creates `path` if needed and checks that no other user can write to it; raises PermissionError if they can."""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o022:
+        raise PermissionError(f"{path} is not a directory only this user can write to")
+
+
+def reload_state_path():
+    """Returns RELOAD_STATE_PATH, or its default: a private directory's file with several workers, else None."""
+    if RELOAD_STATE_PATH is not None or WORKERS <= 1:
+        return RELOAD_STATE_PATH
+    return os.path.join(f"/dev/shm/knotstats-{os.getuid()}", "reload.json")
+
+
+resolver_reloads = ReloadScheduler(RELOAD_COMMAND, state_path=reload_state_path(),
+                                   control_dir=KRESD_CONTROL_DIR if HOSTS_APPLY == 'control' else None, hosts=hosts_index)
+
+# --- Flask Routes ---
+
+def encoded_response(body, etag=None, status=200, content_type='application/json'):
+    """Sends an EncodedBody in the encoding the client prefers.
+
+    With an `etag`, clients already holding that representation get 304.
+    Each encoding gets its own ETag, as its bytes differ.
+    """
+    encoding = negotiate_encoding(body, request.accept_encodings)
+    if etag is not None and encoding != 'identity':
+        etag = f"{etag}-{encoding}"
+    if etag is not None and request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body.encode(encoding), status=status, content_type=content_type)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    if etag is not None:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache' # Cacheable, but revalidate every time
+    return response
+
+@app.route('/')
+def index():
+    """Serves the main HTML page, rendered at startup."""
+    return encoded_response(index_page, index_etag, content_type='text/html; charset=utf-8')
+
+@app.route('/static/<filename>')
+def get_static(filename):
+    """Serves a vendored or bundled asset by its content-hashed name; these never change."""
+    asset = static_assets.get(filename)
+    if asset is None:
+        abort(404)
+    body, content_type, digest = asset
+    response = encoded_response(body, digest, content_type=content_type)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@app.route('/api/stats')
+def get_stats():
+    """Returns the latest stats snapshot collected by the background poller.
+
+    Pass ?since=<seq> (the "seq" of the last response you applied, or 0 for
+    none yet) to receive only the counters that changed since then. ?instance=<id> restricts the
+    stats to one instance and ?group_by=all|host|worker aggregates them.
+    Responses carry an ETag per snapshot; If-None-Match gets 304 until the
+    next scrape lands. While Knot Resolver is slow or down the last good
+    snapshot is still answered with at once, marked with an Age header and
+    X-Stats-Stale (and in the body, except for the plain per-instance tree).
+    """
+    stats_poller.start()
+    since = request.args.get('since')
+    try:
+        view = parse_view_args(request.args)
+        since = parse_since(since) if since is not None else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    body, status, seq, etag = stats_poller.encoded_update(since, view)
+    response = encoded_response(body, etag, status)
+    if seq is not None:
+        response.headers['X-Stats-Seq'] = since_token(*seq)
+    if status == 200:
+        stale, age = stats_poller.freshness()
+        response.headers['Age'] = str(round(age))
+        if stale:
+            response.headers['X-Stats-Stale'] = '1'
+    return response
+
+@app.route('/api/stats/stream')
+def stream_stats():
+    """Pushes every new stats snapshot to the client as Server-Sent Events.
+
+    The first event carries the full stats and later events are deltas, in
+    the same format as /api/stats?since=<seq>, and the same view arguments
+    are accepted. Reconnecting clients resume from their Last-Event-ID.
+    """
+    stats_poller.start()
+    try:
+        view = parse_view_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        base_seq = parse_since(request.headers.get('Last-Event-ID', "0"))
+    except ValueError:
+        base_seq = None, 0 # Not one of ours; start over with the full stats
+
+    def events():
+        nonlocal base_seq
+        last_seq = 0
+        yield f"retry: {int(POLL_INTERVAL * 1000)}\n\n"
+        while True:
+            seq = stats_poller.wait_for_update(last_seq, SSE_KEEPALIVE)
+            if seq is None:
+                yield ": keep-alive\n\n" # Lets proxies and dead connections time out
+                continue
+            last_seq = seq
+            body, status, base_seq, _ = stats_poller.encoded_update(base_seq, view)
+            if status == 200:
+                yield b"id: %s\ndata: %s\n\n" % (since_token(*base_seq).encode(), body.identity)
+            else:
+                yield b"data: %s\n\n" % body.identity
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    """Times each request by endpoint; streamed responses are timed until their first byte."""
+    started = g.get('request_started')
+    if started is not None and request.endpoint is not None:
+        timings.since(f"request_{request.endpoint}", started)
+    return response
+
+@app.route('/api/debug/timings')
+def get_timings():
+    """Reports per-stage timing histograms of the scrape and serve pipeline, with estimated percentiles."""
+    return jsonify(timings.summary())
+
+@app.route('/metrics')
+def get_metrics():
+    """Exposes the shared snapshot to Prometheus, so scrapers never add upstream load."""
+    stats_poller.start()
+    return encoded_response(stats_poller.encoded_metrics(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+@app.route('/api/targets')
+def get_targets():
+    """Reports the scrape health of every configured resolver."""
+    stats_poller.start()
+    return jsonify({"targets": [target.health() for target in stats_poller.targets]})
+
+@app.route('/api/history')
+def get_history():
+    """Returns recent per-poll values of the requested counters.
+
+    ?metrics=section.key,... selects the counters, ?window=<seconds> limits how
+    far back to go, ?rate=1 returns per-second rates of counters, and
+    ?instance= / ?group_by= work as for /api/stats. Windows longer than the
+    in-memory HISTORY_WINDOW are served from the coarsest-needed on-disk tier.
+    Bodies are built once per scrape and conditional GETs work as for /api/stats.
+    """
+    stats_poller.start()
+    metrics = [metric for metric in request.args.get('metrics', '').split(',') if metric]
+    if not metrics:
+        return jsonify({"error": "metrics is required, e.g. ?metrics=answer.total,request.udp"}), 400
+    window = request.args.get('window', HISTORY_WINDOW, type=float)
+    if window <= 0:
+        return jsonify({"error": "window must be a positive number of seconds"}), 400
+    try:
+        view = parse_view_args(request.args) or (None, None)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    rate = request.args.get('rate', '0') not in ('', '0', 'false')
+    window = min(window, stats_poller.max_history_window())
+    query, resolution = stats_poller.history_source(window)
+    return encoded_response(*stats_poller.encoded(
+        ('history', tuple(metrics), window, view, rate),
+        lambda: history_view(stats_poller.schema, query, resolution, metrics, window, *view, rate=rate)))
+
+@app.route('/api/latency')
+def get_latency():
+    """Returns p50/p90/p99 answer latency series estimated from the answer.* buckets.
+
+    Each point covers the ?span=<seconds> (default LATENCY_WINDOW) before it;
+    ?window=, ?instance= and ?group_by= work as for /api/history.
+    """
+    stats_poller.start()
+    window = request.args.get('window', HISTORY_WINDOW, type=float)
+    span = request.args.get('span', LATENCY_WINDOW, type=float)
+    if window <= 0 or span <= 0:
+        return jsonify({"error": "window and span must be positive numbers of seconds"}), 400
+    try:
+        view = parse_view_args(request.args) or (None, None)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    window = min(window, stats_poller.max_history_window())
+    query, resolution = stats_poller.history_source(window + span)
+    return encoded_response(*stats_poller.encoded(
+        ('latency', window, span, view),
+        lambda: latency_history(stats_poller.schema, query, resolution, window, span, *view)))
+
+@app.route('/api/hosts', methods=['GET'])
+def get_hosts():
+    """Fetch contents of the hosts file.
+
+    Without arguments the whole file is returned, served from the in-memory
+    hosts index; the ETag names the version of the file, so If-None-Match
+    gets 304 until it changes. Otherwise one page is returned: ?q= searches
+    IP addresses and hostnames (?match=substring|prefix), ?sort=file|hostname|ip
+    and ?order=asc|desc order the results, and ?limit= caps the page. Pass
+    the "next_cursor" of a page as ?cursor= for the next one; cursors of an
+    older version of the file get 409.
+    """
+    try:
+        query = parse_hosts_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        if query is None:
+            body, version = hosts_index.encoded()
+            return encoded_response(body, version)
+        page = hosts_page(query)
+        if page is None:
+            return jsonify({"error": "The hosts file changed since this cursor was issued; start again from the first page."}), 409
+        return encoded_response(EncodedBody(json_dumps(page)))
+    except Exception as e:
+        app.logger.error(f"Error reading hosts file: {e}", exc_info=True)
+        return jsonify({"error": f"Failed to read hosts file: {str(e)}"}), 500
+
+def hosts_updated_message(reload):
+    """Describes a successful hosts write and when the Knot Resolver reload it scheduled will run."""
+    return f"Hosts file updated successfully; Knot Resolver picks it up in {reload['due_in']:g}s"
+
+@app.route('/api/hosts/reload')
+def get_hosts_reload():
+    """Reports pending hosts reloads and how the last one went."""
+    return jsonify(resolver_reloads.status())
+
+@app.route('/api/hosts', methods=['POST'])
+def update_hosts():
+    """Update the hosts file with new content."""
+    body = request.get_json(silent=True)
+    hosts_data = body.get('hosts', []) if isinstance(body, dict) else None
+    if not isinstance(hosts_data, list):
+        return jsonify({"error": "Expected {\"hosts\": [...]}"}), 400
+
+    # Validate every entry before anything is written
+    try:
+        hosts = [parse_host(host if isinstance(host, dict) else {}) for host in hosts_data]
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Replace the file atomically, streaming the entries into it
+    try:
+        touched = hosts_index.write(hosts)
+    except Exception as e:
+        app.logger.error(f"Error updating hosts file: {e}", exc_info=True)
+        return jsonify({"error": f"Failed to update hosts file: {str(e)}"}), 500
+
+    # Reload Knot Resolver to apply changes, together with any other edits close by
+    reload = resolver_reloads.request(touched)
+
+    return jsonify({
+        "success": True,
+        "message": hosts_updated_message(reload),
+        "reload": reload
+    }), 200
+
+@app.route('/api/hosts', methods=['PATCH'])
+def patch_hosts():
+    """Add, edit or delete individual hosts file entries.
+
+    The body is one change or {"changes": [...]} applied together, each
+    {"op": "add", "ip": ..., "hostname": ...}, {"op": "update", "index": ...,
+    "ip": ..., "hostname": ...} or {"op": "delete", "index": ...}, where index
+    is the entry's "index" in /api/hosts at the version being changed. That
+    version must be sent as If-Match or "version"; if the file has changed
+    since, nothing is applied and 412 returns the current version.
+    """
+    body = request.get_json(silent=True)
+    try:
+        updates, adds = parse_hosts_changes(body)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    version = next(iter(request.if_match), None) or body.get('version')
+    if not isinstance(version, str) or not version:
+        return jsonify({"error": "Send the version being changed as If-Match or \"version\""}), 428
+    for encoding in COMPRESSORS:
+        version = version.removesuffix(f"-{encoding}") # If-Match copied from a compressed GET's ETag
+    try:
+        result = hosts_index.mutate(version, updates, adds)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        app.logger.error(f"Error updating hosts file: {e}", exc_info=True)
+        return jsonify({"error": f"Failed to update hosts file: {str(e)}"}), 500
+    if result is None:
+        _, current = hosts_index.load()
+        return jsonify({"error": "The hosts file changed since that version; reload it and try again.",
+                        "version": current}), 412
+    new_version, added, touched = result
+    reload = resolver_reloads.request(touched)
+    response = jsonify({
+        "success": True,
+        "version": new_version,
+        "added": added,
+        "message": hosts_updated_message(reload),
+        "reload": reload
+    })
+    response.set_etag(new_version)
+    return response
+
+
+# --- Multi-worker Serving ---
+
+if gunicorn is not None:
+    class DashboardServer(gunicorn.app.base.BaseApplication):
+        """Runs the Flask app under gunicorn with options given in code rather than on the command line."""
+
+        def __init__(self, application, options):
+            self.application = application
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return self.application
+
+
+def run_collector(channel):
+    """Scrapes, persists and publishes every snapshot; the only process that talks to the resolvers."""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0)) # Exit normally so the store is flushed
+    stats_poller.follower = False # Forked from the server process, which follows
+    stats_poller.channel = channel
+    stats_poller._seq = channel.resume() # A restarted collector numbers on from its predecessor
+    try:
+        stats_poller.start()
+        stats_poller._thread.join()
+    finally:
+        if stats_poller.store is not None:
+            stats_poller.store.flush()
+
+
+def wait_for_exit(pid):
+    """Blocks until process `pid` has exited, whoever reaps it."""
+    try:
+        pidfd = os.pidfd_open(pid)
+    except ProcessLookupError:
+        return
+    except (AttributeError, OSError): # No pidfds here: check on it every second instead
+        while True:
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                return
+            time.sleep(1)
+    try:
+        select.select([pidfd], [], [])
+    finally:
+        os.close(pidfd)
+
+
+class CollectorSupervisor:
+    """Keeps a collector process publishing into `channel`, restarting it whenever it exits.
+
+    Runs in the gunicorn arbiter, which reaps every child it sees exit, the
+    collector included, so exits are noticed through a pidfd rather than by
+    waiting for the child. Restarts back off while the collector keeps dying
+    soon after starting, and the collector is stopped when the arbiter exits.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.pid = None
+        self._owner = os.getpid() # Workers forked later inherit the exit handler but mustn't run it
+        self._lock = threading.Lock()
+        self._stopping = False
+
+    def start(self):
+        self.pid = self._fork()
+        atexit.register(self.stop)
+        threading.Thread(target=self._run, name="collector-supervisor", daemon=True).start()
+
+    def stop(self):
+        if os.getpid() != self._owner:
+            return
+        with self._lock:
+            self._stopping = True
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _run(self):
+        delay = BACKOFF_INITIAL
+        while True:
+            started = time.monotonic()
+            wait_for_exit(self.pid)
+            if self._stopping:
+                return
+            if time.monotonic() - started > 60:
+                delay = BACKOFF_INITIAL
+            app.logger.error(f"The stats collector (pid {self.pid}) exited; restarting it in {delay:g}s")
+            time.sleep(delay)
+            delay = min(delay * 2, BACKOFF_MAX)
+            with self._lock:
+                if self._stopping:
+                    return
+                self.pid = self._fork()
+
+    def _fork(self):
+        pid = os.fork()
+        if pid:
+            return pid
+        code = 1
+        try:
+            run_collector(self.channel)
+            code = 0
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 0
+        except BaseException:
+            app.logger.error("The stats collector failed", exc_info=True)
+        finally:
+            os._exit(code) # Never return into the server that forked it
+
+
+def serve_workers():
+    """Serves with WORKERS gunicorn processes fed by a single collector process.
+
+    The collector is forked before the workers, and the workers only read
+    the snapshots it publishes, so the resolvers see one scrape per
+    POLL_INTERVAL however many workers there are. Every worker numbers
+    snapshots and tags ETags like the collector, so clients can move
+    between workers without losing their delta base. A collector that
+    dies is restarted by a thread of the gunicorn arbiter.
+    """
+    CollectorSupervisor(SnapshotChannel.create(SNAPSHOT_CHANNEL_PATH, stats_poller._epoch)).start()
+    stats_poller.channel = SnapshotChannel(SNAPSHOT_CHANNEL_PATH)
+    stats_poller.follower = True
+    DashboardServer(app, {
+        'bind': f"{LISTEN_HOST}:{LISTEN_PORT}",
+        'workers': WORKERS,
+        'worker_class': 'gthread',
+        'threads': WORKER_THREADS,
+    }).run()
 
 # --- Main Execution ---
 if __name__ == '__main__':
+    if '--vendor' in sys.argv[1:]:
+        vendor_assets()
+        sys.exit()
     print("Starting Flask server for Knot Resolver Stats UI...")
-    print(f"Fetching stats from: {KNOT_RESOLVER_STATS_URL}")
-    print("Access the UI at: http://127.0.0.1:5001")
-    # Use waitress or gunicorn for production instead of Flask's development server
-    app.run(host='0.0.0.0', port=5001, debug=False) # Turn off debug for production/general use
+    print(f"Fetching stats from: {', '.join(target.url for target in stats_poller.targets)} every {POLL_INTERVAL}s")
+    print(f"Access the UI at: http://127.0.0.1:{LISTEN_PORT}")
+    if WORKERS > 1:
+        if gunicorn is None:
+            sys.exit("WORKERS > 1 needs gunicorn: pip install gunicorn")
+        serve_workers()
+    else:
+        stats_poller.start()
+        app.run(host=LISTEN_HOST, port=LISTEN_PORT, debug=False, threaded=True) # Turn off debug for production/general use
@@ -32,10 +32,15 @@
 
 import requests
 import json
-from flask import Flask, render_template_string, jsonify
+import threading
+import time
+from flask import Flask, Response, render_template_string, jsonify, stream_with_context
 
 # --- Configuration ---
 KNOT_RESOLVER_STATS_URL = "http://127.0.0.1:8453/stats"
+POLL_INTERVAL = 1.0 # Seconds between upstream scrapes, shared by all connected clients
+POLL_TIMEOUT = 0.5 # Per-scrape request timeout
+SSE_KEEPALIVE = 15 # Seconds between keep-alive comments on idle event streams
 # --- Flask App ---
 app = Flask(__name__)
 
@@ -192,7 +197,7 @@ HTML_TEMPLATE = """
     </main>
 
     <footer>
-        Auto-refreshing every second.
+        Live updates pushed by the server every second.
     </footer>
 
     <script>
@@ -202,6 +207,7 @@ HTML_TEMPLATE = """
         const errorMessage = document.getElementById('error-message');
         const dashboardContent = document.getElementById('dashboard-content');
         const statsApiUrl = '/api/stats';
+        const statsStreamUrl = '/api/stats/stream';
 
         // Chart instances (initialized later)
         let answerStatusChart = null;
@@ -420,16 +426,140 @@ HTML_TEMPLATE = """
             }
         }
 
-        // Fetch stats immediately on load
-        fetchStats();
+        // Fallback: poll every 1000ms (1 second) while the event stream is unavailable
+        let pollTimer = null;
 
-        // Set interval to fetch stats every 1000ms (1 second)
-        setInterval(fetchStats, 1000);
+        function startPolling() {
+            if (pollTimer === null) {
+                fetchStats();
+                pollTimer = setInterval(fetchStats, 1000);
+            }
+        }
+
+        function stopPolling() {
+            if (pollTimer !== null) {
+                clearInterval(pollTimer);
+                pollTimer = null;
+            }
+        }
+
+        // Subscribe to stats pushed by the server; EventSource reconnects on its own after transient errors
+        function startStream() {
+            if (!window.EventSource) {
+                startPolling();
+                return;
+            }
+            const source = new EventSource(statsStreamUrl);
+            source.onopen = () => stopPolling();
+            source.onmessage = (event) => {
+                const data = JSON.parse(event.data);
+                if (data.error) {
+                    showError(data.error);
+                } else {
+                    updateDashboard(data);
+                }
+            };
+            source.onerror = () => {
+                startPolling();
+                if (source.readyState === EventSource.CLOSED) {
+                    // The server refused the stream outright; keep polling and retry later
+                    setTimeout(startStream, 30000);
+                }
+            };
+        }
+
+        startStream();
     </script>
 </body>
 </html>
 """
 
+# --- Stats Poller ---
+
+class StatsPoller:
+    """Scrapes Knot Resolver on a background thread and keeps the latest snapshot.
+
+    All clients share the snapshot, so upstream load is one request per
+    POLL_INTERVAL regardless of how many dashboards are open.
+    """
+
+    def __init__(self, url, interval=POLL_INTERVAL, timeout=POLL_TIMEOUT):
+        self.url = url
+        self.interval = interval
+        self.timeout = timeout
+        self._session = requests.Session()
+        self._lock = threading.Lock()
+        self._updated = threading.Condition(self._lock)
+        self._ready = threading.Event()
+        self._thread = None
+        self._seq = 0 # Incremented on every scrape so subscribers can tell snapshots apart
+        self._event = None # Cached SSE message for the current snapshot
+        self._snapshot = ({"error": "Stats have not been fetched yet."}, 503)
+
+    def start(self):
+        """Starts the polling thread if it is not already running."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="stats-poller", daemon=True)
+                self._thread.start()
+
+    def snapshot(self):
+        """Returns the latest (payload, status) pair, waiting briefly for the first scrape."""
+        self._ready.wait(self.interval + self.timeout)
+        with self._lock:
+            return self._snapshot
+
+    def wait_for_update(self, last_seq, timeout):
+        """Blocks until a snapshot newer than last_seq exists.
+
+        Returns (seq, SSE message) or None if the timeout expired first.
+        """
+        with self._updated:
+            if not self._updated.wait_for(lambda: self._seq > last_seq, timeout):
+                return None
+            if self._event is None:
+                payload, _ = self._snapshot
+                self._event = f"id: {self._seq}\ndata: {json.dumps(payload)}\n\n"
+            return self._seq, self._event
+
+    def _run(self):
+        next_poll = time.monotonic()
+        while True:
+            snapshot = self._fetch()
+            with self._updated:
+                self._snapshot = snapshot
+                self._seq += 1
+                self._event = None
+                self._updated.notify_all()
+            self._ready.set()
+
+            next_poll += self.interval
+            now = time.monotonic()
+            if next_poll < now:
+                next_poll = now
+            time.sleep(next_poll - now)
+
+    def _fetch(self):
+        """Performs a single scrape and returns (payload, HTTP status)."""
+        try:
+            response = self._session.get(self.url, timeout=self.timeout)
+            response.raise_for_status()
+            return response.json(), 200
+        except requests.exceptions.ConnectionError:
+            return {"error": f"Connection refused. Is Knot Resolver running at {self.url}?"}, 503
+        except requests.exceptions.Timeout:
+            return {"error": "Request timed out."}, 504
+        except requests.exceptions.RequestException as e:
+            return {"error": f"Failed to fetch stats: {str(e)}"}, 500
+        except json.JSONDecodeError:
+            return {"error": "Failed to decode JSON response from Knot Resolver."}, 500
+        except Exception as e:
+            app.logger.error(f"Unexpected error fetching stats: {e}", exc_info=True)
+            return {"error": f"An unexpected server error occurred: {str(e)}"}, 500
+
+
+stats_poller = StatsPoller(KNOT_RESOLVER_STATS_URL)
+
 # --- Flask Routes ---
 
 @app.route('/')
@@ -439,27 +569,34 @@ def index():
 
 @app.route('/api/stats')
 def get_stats():
-    """Fetches stats from Knot Resolver and returns as JSON."""
-    try:
-        response = requests.get(KNOT_RESOLVER_STATS_URL, timeout=0.5)
-        response.raise_for_status()
-        stats_data = response.json()
-        return jsonify(stats_data)
-    except requests.exceptions.ConnectionError:
-        return jsonify({"error": f"Connection refused. Is Knot Resolver running at {KNOT_RESOLVER_STATS_URL}?"}), 503
-    except requests.exceptions.Timeout:
-        return jsonify({"error": "Request timed out."}), 504
-    except requests.exceptions.RequestException as e:
-        return jsonify({"error": f"Failed to fetch stats: {str(e)}"}), 500
-    except json.JSONDecodeError:
-        return jsonify({"error": "Failed to decode JSON response from Knot Resolver."}), 500
-    except Exception as e:
-        app.logger.error(f"Unexpected error fetching stats: {e}", exc_info=True)
-        return jsonify({"error": f"An unexpected server error occurred: {str(e)}"}), 500
+    """Returns the latest stats snapshot collected by the background poller."""
+    stats_poller.start()
+    payload, status = stats_poller.snapshot()
+    return jsonify(payload), status
+
+@app.route('/api/stats/stream')
+def stream_stats():
+    """Pushes every new stats snapshot to the client as Server-Sent Events."""
+    stats_poller.start()
+
+    def events():
+        last_seq = 0
+        yield f"retry: {int(POLL_INTERVAL * 1000)}\n\n"
+        while True:
+            update = stats_poller.wait_for_update(last_seq, SSE_KEEPALIVE)
+            if update is None:
+                yield ": keep-alive\n\n" # Lets proxies and dead connections time out
+                continue
+            last_seq, event = update
+            yield event
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 # --- Main Execution ---
 if __name__ == '__main__':
     print("Starting Flask server for Knot Resolver Stats UI...")
-    print(f"Fetching stats from: {KNOT_RESOLVER_STATS_URL}")
+    print(f"Fetching stats from: {KNOT_RESOLVER_STATS_URL} every {POLL_INTERVAL}s")
+    stats_poller.start()
     print("Access the UI at: http://127.0.0.1:5001")
-    app.run(host='0.0.0.0', port=5001, debug=False)
+    app.run(host='0.0.0.0', port=5001, debug=False, threaded=True)